@@ -9,23 +9,59 @@ from typing import List, Tuple
 from gym import spaces
 import numpy as np
 
+import utils.mdp_utils as mut
+from utils.trajectory import init_trajectory
+
 
 class BaseLinearAgent(object):
-    def __init__(self, feature_dim, num_actions, gamma=0.9, lr=0.1, seed=0):
+    # Number of most recent time steps kept in the trajectory, the online
+    # agents only use t and t+1. Set to None to keep the full episode.
+    traj_window = 2
+    # Whether the agent uses the compiled update kernels (set by the agents
+    # supporting them), which do not need the trajectory
+    use_jit = False
+
+    def __init__(self, feature_dim, num_actions, gamma=0.9, lr=0.1,
+                 dtype=np.float64, update_batch_size=1, seed=0):
         """
         TODO define arguments
+        :param dtype: floating point dtype of the parameters (e.g. float32
+                      to halve the memory of the (|A|, d, d) tensors)
+        :param update_batch_size: number of transitions K to buffer before
+                                  applying them in a single (matrix-matrix)
+                                  update, for the agents supporting it. K=1
+                                  is the usual per-step update
         """
         self.feature_dim = feature_dim  # feature dimension
         self.num_actions = num_actions  # number of discrete actions
         self.gamma = gamma
         self.lr = lr  # step size / learning rate
+        self.dtype = np.dtype(dtype)
+
+        # (Optional) Deferred mini-batch updates, the trajectory needs to
+        # hold the K pending transitions and the next step
+        self.update_batch_size = update_batch_size
+        self.num_pending = 0
+        if self.update_batch_size > 1:
+            self.traj_window = max(self.traj_window,
+                                   self.update_batch_size + 1)
 
         # Saving single-episode trajectory
         self.traj = None
 
+        # Current (S, A), which the compiled (use_jit) updates read directly
+        # instead of going through the trajectory buffers. The features are
+        # not copied, so they must not be modified in place by the caller.
+        self.cur_phi = None
+        self.cur_act = None
+
         # Log
         self.log_dict = None
 
+        # (Expected updates) trace operators of the current model, by decay
+        self._expected_model = None
+        self._expected_ops = {}
+
         # RNG
         self.rng = np.random.default_rng(seed)
 
@@ -37,13 +73,20 @@ class BaseLinearAgent(object):
         """
         # Select action
         cur_act = self._select_action(phi_0)
+        self.cur_phi, self.cur_act = phi_0, cur_act
+        if self.use_jit:
+            return cur_act
 
-        # Initialize trajectory
-        self.traj = {
-            'phi': [phi_0],
-            'a': [cur_act],
-            'r': []
-        }
+        # Initialize trajectory (buffers are re-used across episodes)
+        if self.traj is None:
+            self.traj = init_trajectory(phi_0, window=self.traj_window,
+                                        rew_dtype=self.dtype)
+        else:
+            for buf in self.traj.values():
+                buf.reset()
+        self.traj['phi'].append(phi_0)
+        self.traj['a'].append(cur_act)
+        self.num_pending = 0
 
         return cur_act
 
@@ -61,6 +104,141 @@ class BaseLinearAgent(object):
         # selects action
         pass
 
+    def _add_pending_transition(self, done) -> bool:
+        """
+        Helper for the deferred mini-batch updates, count the newest
+        transition as pending
+        :param done: whether the episode is finished
+        :return: whether the pending transitions should be applied now
+        """
+        self.num_pending += 1
+        return done or (self.num_pending >= self.update_batch_size)
+
+    def _pop_pending_transitions(self, done):
+        """
+        Helper for the deferred mini-batch updates, stack the pending
+        transitions (only the last one can be terminal)
+        :param done: whether the episode is finished
+        :return: cur_phi (K, d), cur_act (K, ), rew (K, ), nex_phi (K, d),
+                 nex_act (K, ), nex_done (K, ) boolean. nex_phi is zero and
+                 nex_act is 0 where nex_done.
+        """
+        t_end = len(self.traj['r'])
+        t_idxs = range(t_end - self.num_pending, t_end)
+
+        cur_phi = np.stack([self.traj['phi'][t] for t in t_idxs])
+        cur_act = np.array([self.traj['a'][t] for t in t_idxs], dtype=int)
+        rew = np.array([self.traj['r'][t] for t in t_idxs], dtype=self.dtype)
+
+        nex_done = np.zeros(self.num_pending, dtype=bool)
+        nex_done[-1] = done
+        nex_phi = np.zeros_like(cur_phi)
+        nex_act = np.zeros(self.num_pending, dtype=int)
+        for j, t in enumerate(t_idxs):
+            if not nex_done[j]:
+                nex_phi[j] = self.traj['phi'][t + 1]
+                nex_act[j] = self.traj['a'][t + 1]
+
+        self.num_pending = 0
+        return cur_phi, cur_act, rew, nex_phi, nex_act, nex_done
+
+    def _init_sf_factors(self, rank) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Helper to initialize rank-k factors of the SF parameters, such that
+        Ws[a] = I + U[a] @ V[a].T. U starts at zero so Ws starts at the
+        identity (as for the dense parameters); V starts with random
+        orthonormal columns.
+        :param rank: integer rank k
+        :return: U, V each of shape (num_actions, feature_dim, rank)
+        """
+        U = np.zeros((self.num_actions, self.feature_dim, rank),
+                     dtype=self.dtype)
+        V = np.empty((self.num_actions, self.feature_dim, rank),
+                     dtype=self.dtype)
+        for a in range(self.num_actions):
+            gauss_mat = self.rng.standard_normal((self.feature_dim, rank))
+            V[a], _ = np.linalg.qr(gauss_mat)
+        return U, V
+
+    @staticmethod
+    def _factorize_sf_param(sf_mat, rank) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Best rank-k factors (truncated SVD) of a (d, d) SF parameter matrix,
+        such that sf_mat ~= I + U @ V.T
+        :param sf_mat: (d, d) SF parameter matrix
+        :param rank: integer rank k
+        :return: U, V each of shape (d, rank)
+        """
+        res_mat = sf_mat - np.identity(np.shape(sf_mat)[0])
+        u_mat, s_vec, vt_mat = np.linalg.svd(res_mat)
+        U = u_mat[:, :rank] * s_vec[:rank]
+        V = np.transpose(vt_mat[:rank, :])
+        return U, V
+
+    @staticmethod
+    def _to_sparse_phi(phi) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Helper to convert a feature vector into its sparse representation
+        :param phi: either a dense (d, ) feature vector, or an already
+                    sparse (indices, values) tuple
+        :return: tuple of (nnz, ) active indices and (nnz, ) values
+        """
+        if isinstance(phi, tuple):
+            return phi
+        phi_idxs = np.flatnonzero(phi)
+        return phi_idxs, phi[phi_idxs]
+
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features, e.g. of every state for
+        evaluation. Generic fallback looping over compute_Q_value, agents
+        override this with a single matrix product.
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values
+        """
+        return np.array([self.compute_Q_value(phi, act) for phi in Phi])
+
+    def expected_update(self, model: dict) -> None:
+        """
+        Apply the expectation of the agent's (online) update under the
+        on-policy state distribution as a single matrix update, i.e. one
+        synchronous (dynamic programming) step standing in for one time
+        step of experience. Only for policy evaluation (single action).
+        :param model: dict from mdp_utils.get_expected_update_model
+        """
+        raise ValueError(
+            f'{type(self).__name__} does not support expected updates'
+        )
+
+    def _expected_trace_operator(self, model: dict, decay) -> np.ndarray:
+        """
+        Helper for the expected updates, the (d, N) operator
+        Phi^T D (I - decay P)^-1 mapping the expected TD errors to the
+        expected trace update direction. Computed once per model and decay.
+        """
+        if self.num_actions != 1:
+            raise ValueError('expected updates require num_actions=1')
+        if model is not self._expected_model:
+            self._expected_model = model
+            self._expected_ops = {}
+        if decay not in self._expected_ops:
+            self._expected_ops[decay] = mut.solve_expected_trace_operator(
+                model, decay
+            )
+        return self._expected_ops[decay]
+
+    @staticmethod
+    def _weighted_rms(err, d_vec) -> float:
+        """
+        Root mean square of the per-state errors under the state
+        distribution d, for logging the expected updates
+        :param err: (N, ) errors, or (N, m) error vectors
+        :param d_vec: (N, ) state distribution
+        """
+        sq_err = np.reshape(err ** 2, (len(d_vec), -1)).sum(axis=1)
+        return float(np.sqrt(d_vec @ sq_err))
+
     def _optimize_model(self) -> None:
         # Optimize
         # Log losses
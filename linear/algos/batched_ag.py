@@ -0,0 +1,582 @@
+# =============================================================================
+# Batched (multi-seed) linear prediction agents. Each agent holds its
+# parameters with a leading seed axis and steps N independent environment
+# copies at once. Per-seed results are identical to the un-batched agents.
+#
+# NOTE: the batched products are written as stacked np.matmul calls with
+#       singleton dimensions, which go through the same BLAS routines as
+#       the single-seed vector-matrix products (np.einsum / np.sum do not).
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+from typing import List, Tuple
+
+import numpy as np
+
+from algos.sf_return_ag import SFReturnAgent
+from algos.td_lambda_ag import SarsaLambdaAgent
+from algos.expt_trace_ag import ExpectedTraceAgent
+from utils.running_stats import RunningStats
+
+
+def _bvecmat(phi, W):
+    """
+    Batched vector-matrix product, phi[n] @ W[n]
+    :param phi: (N, d) batch of vectors
+    :param W: (N, d, k) batch of matrices
+    :return: (N, k)
+    """
+    return np.matmul(phi[:, None, :], W)[:, 0, :]
+
+
+def _bdot(x, y):
+    """
+    Batched vector dot product, np.dot(x[n], y[n])
+    :param x: (N, d)
+    :param y: (N, d)
+    :return: (N, )
+    """
+    return np.matmul(x[:, None, :], y[:, :, None])[:, 0, 0]
+
+
+def _active_feature_groups(phi) -> List[Tuple]:
+    """
+    Group the rows of a batch of features by their number of active
+    (non-zero) features, to contract over the active features only as the
+    un-batched agents do (contracting over zeros changes the rounding)
+    :param phi: (N, d) batch of feature vectors
+    :return: list of (rows, idxs, vals) per group, with the (n_g, ) rows
+             of phi having k active features, and their (n_g, k) active
+             feature indices and values
+    """
+    rows, cols = np.nonzero(phi)
+    counts = np.bincount(rows, minlength=len(phi))
+    groups = []
+    for k in np.unique(counts):
+        g_rows = np.flatnonzero(counts == k)
+        g_idxs = np.reshape(cols[(counts == k)[rows]], (len(g_rows), k))
+        groups.append((g_rows, g_idxs, phi[g_rows[:, None], g_idxs]))
+    return groups
+
+
+class BatchedBaseLinearAgent(object):
+    # Un-batched agent class and the names of its seed-stacked parameters
+    seed_agent_cls = None
+    param_attrs = []
+
+    def __init__(self, feature_dim, num_actions, gamma=0.9, lr=0.1,
+                 dtype=np.float64, seeds=(0,), **agent_kwargs):
+        """
+        :param feature_dim: feature dimension
+        :param num_actions: number of discrete actions
+        :param gamma: discount factor
+        :param lr: step size / learning rate
+        :param dtype: floating point dtype of the parameters
+        :param seeds: list of seeds, one for each of the N batched agents
+        :param agent_kwargs: remaining kwargs of the un-batched agent
+        """
+        self.feature_dim = feature_dim
+        self.num_actions = num_actions
+        self.gamma = gamma
+        self.lr = lr
+        self.dtype = np.dtype(dtype)
+
+        self.seeds = list(seeds)
+        self.num_seeds = len(self.seeds)
+
+        # Current (S, A) for each seed, the only part of the trajectory
+        # used by the online agents
+        self.cur_phi = np.zeros((self.num_seeds, self.feature_dim),
+                                dtype=self.dtype)
+        self.cur_act = np.zeros(self.num_seeds, dtype=int)
+
+        # Log, one dict per seed
+        self.log_dicts = [None] * self.num_seeds
+
+        # RNG, one per seed
+        self.rngs = [np.random.default_rng(s) for s in self.seeds]
+
+        # Per-seed agent views (lazily constructed)
+        self._agent_kwargs = dict(gamma=gamma, lr=lr, dtype=dtype,
+                                  **agent_kwargs)
+        self._seed_agents = [None] * self.num_seeds
+
+    def begin_episode(self, phi_0, mask=None) -> np.ndarray:
+        """
+        Start of episode for the seeds in mask
+        :param phi_0: (N, d) initial features
+        :param mask: (N, ) boolean of the seeds starting an episode, or None
+                     for all seeds
+        :return: (N, ) integer action indices
+        """
+        if mask is None:
+            mask = np.ones(self.num_seeds, dtype=bool)
+        s_idxs = np.flatnonzero(mask)
+
+        # Select action
+        cur_act = self._select_action(phi_0)
+
+        # Initialize current state
+        self.cur_phi[s_idxs] = phi_0[s_idxs]
+        self.cur_act[s_idxs] = cur_act[s_idxs]
+
+        # Reset logs and traces
+        for s_i in s_idxs:
+            self.log_dicts[s_i] = self._new_log_dict()
+        self._reset_traces(s_idxs)
+
+        return cur_act
+
+    def step(self, phi_t: np.ndarray, reward: np.ndarray, done: np.ndarray,
+             mask=None) -> np.ndarray:
+        """
+        Take a step in each of the N environments
+        :param phi_t: (N, d) feature observations
+        :param reward: (N, ) rewards
+        :param done: (N, ) booleans for whether each episode is finished
+        :param mask: (N, ) boolean of the seeds to update, or None for all
+        :return: (N, ) integer action indices
+        """
+        if mask is None:
+            mask = np.ones(self.num_seeds, dtype=bool)
+        s_idxs = np.flatnonzero(mask)
+        reward = np.asarray(reward, dtype=self.dtype)
+        done = np.asarray(done, dtype=bool)
+
+        # Get new action based on state
+        new_act = self._select_action(phi_t)
+
+        # Learning
+        if len(s_idxs) > 0:
+            self._optimize_model(s_idxs, phi_t[s_idxs], new_act[s_idxs],
+                                 reward[s_idxs], done[s_idxs])
+
+        # Advance current state for the non-terminated seeds
+        adv_idxs = s_idxs[~done[s_idxs]]
+        self.cur_phi[adv_idxs] = phi_t[adv_idxs]
+        self.cur_act[adv_idxs] = new_act[adv_idxs]
+
+        return new_act
+
+    def get_agent(self, seed_idx: int):
+        """
+        Get an un-batched agent for a single seed, whose parameters are
+        views into the batched parameters. Used for evaluation and logging.
+        :param seed_idx: index into the seed axis
+        :return: un-batched agent object
+        """
+        if self._seed_agents[seed_idx] is None:
+            agent = self.seed_agent_cls(
+                feature_dim=self.feature_dim,
+                num_actions=self.num_actions,
+                seed=self.seeds[seed_idx],
+                **self._agent_kwargs
+            )
+            for att_str in self.param_attrs:
+                setattr(agent, att_str, getattr(self, att_str)[seed_idx])
+            agent.rng = self.rngs[seed_idx]
+            self._seed_agents[seed_idx] = agent
+
+        agent = self._seed_agents[seed_idx]
+        agent.log_dict = self.log_dicts[seed_idx]
+        return agent
+
+    def _new_log_dict(self) -> dict:
+        return {}
+
+    def _reset_traces(self, s_idxs) -> None:
+        pass
+
+    def _select_action(self, phi) -> np.ndarray:
+        # Policy evaluation only
+        return np.zeros(self.num_seeds, dtype=int)
+
+    def _optimize_model(self, s_idxs, nex_phi, nex_act, rew, done) -> None:
+        pass
+
+
+class BatchedSFReturnAgent(BatchedBaseLinearAgent):
+    seed_agent_cls = SFReturnAgent
+    param_attrs = ['Wr', 'Ws', 'Wv', 'Zv']
+
+    def __init__(self, feature_dim,
+                 num_actions,
+                 gamma=0.9,
+                 lamb=0.8,
+                 eta_trace=0.0,
+                 lr=0.1,
+                 reward_lr=None,
+                 sf_lr=None,
+                 use_true_reward_params=False,
+                 use_true_sf_params=False,
+                 sparse_phi=False,
+                 sf_rank=None,
+                 use_jit=False,
+                 update_batch_size=1,
+                 dtype=np.float64,
+                 seeds=(0,)):
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, seeds=seeds, lamb=lamb,
+                         eta_trace=eta_trace,
+                         reward_lr=reward_lr, sf_lr=sf_lr,
+                         use_true_reward_params=use_true_reward_params,
+                         use_true_sf_params=use_true_sf_params,
+                         sparse_phi=sparse_phi, sf_rank=sf_rank)
+        if use_jit:
+            raise ValueError('use_jit is not batched')
+        if update_batch_size > 1:
+            raise ValueError('update_batch_size is not batched')
+        if sparse_phi:
+            raise ValueError('sparse_phi is not batched')
+        if sf_rank is not None:
+            raise ValueError('sf_rank is not batched')
+
+        self.lamb = lamb
+        self.eta_trace = eta_trace
+        self.value_lr = lr
+        self.reward_lr = lr if reward_lr is None else reward_lr
+        self.sf_lr = lr if sf_lr is None else sf_lr
+
+        # Weights, with leading seed axis
+        N = self.num_seeds
+        self.Wr = np.zeros((N, self.feature_dim), dtype=self.dtype)
+        self.Ws = np.zeros((N, self.num_actions,
+                            self.feature_dim, self.feature_dim),
+                           dtype=self.dtype)
+        self.Wv = np.zeros((N, self.feature_dim), dtype=self.dtype)
+
+        # Trace
+        self.Zv = np.zeros((N, self.feature_dim), dtype=self.dtype)
+
+        # Identity initialization of the SF weights
+        ws_idxs = np.arange(self.feature_dim)
+        self.Ws[:, :, ws_idxs, ws_idxs] = 1.0
+
+        self.use_true_sf_params = use_true_sf_params
+        self.use_true_reward_params = use_true_reward_params
+
+    def _new_log_dict(self) -> dict:
+        return {
+            'reward_errors': RunningStats(),
+            'sf_error_norms': RunningStats(),
+            'value_errors': RunningStats(),
+        }
+
+    def _reset_traces(self, s_idxs) -> None:
+        self.Zv[s_idxs] = self.Zv[s_idxs] * 0.0
+
+    def _optimize_model(self, s_idxs, nex_phi, nex_act, rew, done) -> None:
+        cur_phi = self.cur_phi[s_idxs]  # (n, d)
+        cur_act = self.cur_act[s_idxs]  # (n, )
+        cont = ~done
+
+        # ==
+        # Reward learning
+        if not self.use_true_reward_params:
+            rew_err = rew - _bdot(cur_phi, self.Wr[s_idxs])
+            d_Wr = rew_err[:, None] * cur_phi
+            self.Wr[s_idxs] += self.reward_lr * d_Wr
+
+            for k, s_i in enumerate(s_idxs):
+                self.log_dicts[s_i]['reward_errors'].append(rew_err[k])
+
+        # ==
+        # SF learning
+        if not self.use_true_sf_params:
+            nex_sf = _bvecmat(nex_phi, self.Ws[s_idxs, nex_act])
+            nex_sf = np.where(cont[:, None], nex_sf, 0.0)
+
+            cur_sf = _bvecmat(cur_phi, self.Ws[s_idxs, cur_act])
+            sf_td_err = cur_phi + (self.lamb * self.gamma * nex_sf) - cur_sf
+            d_Ws = cur_phi[:, :, None] * sf_td_err[:, None, :]  # (n, d, d)
+
+            self.Ws[s_idxs, cur_act] += self.sf_lr * d_Ws
+
+            sf_err_norms = np.sqrt(_bdot(sf_td_err, sf_td_err))
+            for k, s_i in enumerate(s_idxs):
+                self.log_dicts[s_i]['sf_error_norms'].append(sf_err_norms[k])
+
+        # ==
+        # Value learning
+        self.Zv[s_idxs] = ((self.eta_trace * self.gamma) * self.Zv[s_idxs]
+                           + cur_phi)
+
+        slr_V = self.compute_successor_return(nex_phi, nex_act, s_idxs)
+        slr_V = np.where(cont, slr_V, 0.0)
+
+        cur_v = _bdot(cur_phi, self.Wv[s_idxs])
+        v_target = rew + (self.gamma * slr_V)
+        v_td_err = v_target - cur_v
+        del_Wv = v_td_err[:, None] * self.Zv[s_idxs]
+
+        self.Wv[s_idxs] += self.value_lr * del_Wv
+
+        for k, s_i in enumerate(s_idxs):
+            self.log_dicts[s_i]['value_errors'].append(v_td_err[k])
+
+    def compute_successor_return(self, phi, act, s_idxs) -> np.ndarray:
+        """
+        Batched lambda successor return value estimate
+        :param phi: (n, d) features
+        :param act: (n, ) actions
+        :param s_idxs: (n, ) seed indices
+        :return: (n, ) values
+        """
+        sf_T = _bvecmat(phi, self.Ws[s_idxs, act])  # (n, d)
+        slr_W = (((1 - self.lamb) * self.Wv[s_idxs])
+                 + (self.lamb * self.Wr[s_idxs]))
+        return _bdot(sf_T, slr_W)
+
+
+class BatchedSarsaLambdaAgent(BatchedBaseLinearAgent):
+    seed_agent_cls = SarsaLambdaAgent
+    param_attrs = ['Wq', 'Z']
+
+    def __init__(self, feature_dim,
+                 num_actions,
+                 gamma=0.9,
+                 lamb=0.8,
+                 lr=0.1,
+                 use_jit=False,
+                 update_batch_size=1,
+                 dtype=np.float64,
+                 seeds=(0,)):
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, seeds=seeds, lamb=lamb)
+        if use_jit:
+            raise ValueError('use_jit is not batched')
+        if update_batch_size > 1:
+            raise ValueError('update_batch_size is not batched')
+        self.lamb = lamb
+
+        # Q function and trace, with leading seed axis
+        N = self.num_seeds
+        self.Wq = np.zeros((N, self.feature_dim, self.num_actions),
+                           dtype=self.dtype)
+        self.Z = np.zeros((N, self.feature_dim, self.num_actions),
+                          dtype=self.dtype)
+
+    def _new_log_dict(self) -> dict:
+        return {
+            'value_errors': RunningStats(),
+        }
+
+    def _reset_traces(self, s_idxs) -> None:
+        self.Z[s_idxs] = self.Z[s_idxs] * 0.0
+
+    def _update_trace(self, s_idxs, cur_phi, cur_act) -> None:
+        grad_Qw = np.zeros((len(s_idxs), self.feature_dim, self.num_actions),
+                           dtype=self.dtype)
+        grad_Qw[np.arange(len(s_idxs)), :, cur_act] = cur_phi
+        self.Z[s_idxs] = (self.lamb * self.gamma) * self.Z[s_idxs] + grad_Qw
+
+    def _td_error(self, s_idxs, cur_phi, cur_act, nex_phi, nex_act, rew,
+                  done) -> np.ndarray:
+        n_range = np.arange(len(s_idxs))
+        Wq = self.Wq[s_idxs]
+
+        nex_q = _bvecmat(nex_phi, Wq)[n_range, nex_act]
+        nex_q = np.where(~done, nex_q, 0.0)
+        cur_q = _bvecmat(cur_phi, Wq)[n_range, cur_act]
+
+        return rew + (self.gamma * nex_q) - cur_q
+
+    def _optimize_model(self, s_idxs, nex_phi, nex_act, rew, done) -> None:
+        cur_phi = self.cur_phi[s_idxs]
+        cur_act = self.cur_act[s_idxs]
+
+        # Update trace
+        self._update_trace(s_idxs, cur_phi, cur_act)
+
+        # Update Q function
+        td_err = self._td_error(s_idxs, cur_phi, cur_act, nex_phi, nex_act,
+                                rew, done)
+        del_Wq = td_err[:, None, None] * self.Z[s_idxs]
+        self.Wq[s_idxs] += self.lr * del_Wq
+
+        for k, s_i in enumerate(s_idxs):
+            self.log_dicts[s_i]['value_errors'].append(td_err[k])
+
+
+class BatchedExpectedTraceAgent(BatchedSarsaLambdaAgent):
+    seed_agent_cls = ExpectedTraceAgent
+    param_attrs = ['Wq', 'Z', 'Z_mix', 'Wz']
+
+    def __init__(self, feature_dim,
+                 num_actions,
+                 gamma=0.9,
+                 lamb=0.8,
+                 lr=0.1,
+                 eta=0.0,
+                 et_param='full',
+                 et_rank=None,
+                 use_jit=False,
+                 dtype=np.float64,
+                 seeds=(0,)):
+        super().__init__(feature_dim, num_actions, gamma=gamma, lamb=lamb,
+                         lr=lr, use_jit=use_jit, dtype=dtype, seeds=seeds)
+        if et_param != 'full':
+            raise ValueError('Only et_param=full is batched')
+        self._agent_kwargs['eta'] = eta
+        self.eta = eta
+        self.value_lr = lr
+        self.et_lr = lr
+
+        # Trace params, with leading seed axis, (N, d, |A|, d) layout as in
+        # the un-batched agent
+        self.Wz = np.zeros((self.num_seeds, self.feature_dim,
+                            self.num_actions, self.feature_dim),
+                           dtype=self.dtype)
+        self.Z_mix = np.zeros((self.num_seeds, self.feature_dim,
+                               self.num_actions), dtype=self.dtype)
+
+    def _new_log_dict(self) -> dict:
+        return {
+            'value_errors': RunningStats(),
+            'et_error_norms': RunningStats(),
+        }
+
+    def _reset_traces(self, s_idxs) -> None:
+        super()._reset_traces(s_idxs)
+        self.Z_mix[s_idxs] = self.Z_mix[s_idxs] * 0.0
+
+    def _optimize_model(self, s_idxs, nex_phi, nex_act, rew, done) -> None:
+        cur_phi = self.cur_phi[s_idxs]
+        cur_act = self.cur_act[s_idxs]
+        n_range = np.arange(len(s_idxs))
+
+        # Update transient trace
+        self._update_trace(s_idxs, cur_phi, cur_act)
+
+        # Expected traces of all actions, only over the active features
+        phi_groups = _active_feature_groups(cur_phi)
+        all_et = self._expected_traces(s_idxs, phi_groups)  # (n, |A|, d)
+
+        # Supervised learning of expected trace
+        et_err = self.Z[s_idxs, :, cur_act] - all_et[n_range, cur_act]
+        for g_rows, g_idxs, g_vals in phi_groups:
+            g_s_idxs = s_idxs[g_rows][:, None]
+            g_err = et_err[g_rows][:, None, :]  # (n_g, 1, d)
+            self.Wz[g_s_idxs, g_idxs, cur_act[g_rows][:, None]] += (
+                self.et_lr * (g_vals[:, :, None] * g_err)
+            )
+
+        # Only the expected trace of the current action has changed
+        all_et[n_range, cur_act] = self._expected_traces(s_idxs, phi_groups,
+                                                         acts=cur_act)
+
+        # Update Q function
+        td_err = self._td_error(s_idxs, cur_phi, cur_act, nex_phi, nex_act,
+                                rew, done)
+
+        # Parameter updates with the (eta-mixture) ET
+        all_et = np.transpose(all_et, (0, 2, 1))  # (n, d, |A|)
+        if self.eta > 0.0:
+            z_mix = (self.eta * self.lamb * self.gamma) * self.Z_mix[s_idxs]
+            z_mix[n_range, :, cur_act] += self.eta * cur_phi
+            z_mix += (1 - self.eta) * all_et
+            self.Z_mix[s_idxs] = z_mix
+            all_et = z_mix
+        del_Wq = td_err[:, None, None] * all_et
+        self.Wq[s_idxs] += self.lr * del_Wq
+
+        et_err_norms = np.sqrt(_bdot(et_err, et_err))
+        for k, s_i in enumerate(s_idxs):
+            self.log_dicts[s_i]['value_errors'].append(td_err[k])
+            self.log_dicts[s_i]['et_error_norms'].append(et_err_norms[k])
+
+    def _expected_traces(self, s_idxs, phi_groups, acts=None) -> np.ndarray:
+        """
+        Expected traces from the active features, see
+        ExpectedTraceAgent.compute_expected_traces
+        :param s_idxs: (n, ) seed indices
+        :param phi_groups: active features, from _active_feature_groups
+        :param acts: (n, ) actions, or None for all actions
+        :return: (n, d) expected traces, or (n, |A|, d) for all actions
+        """
+        d = self.feature_dim
+        if acts is None:
+            et = np.zeros((len(s_idxs), self.num_actions, d),
+                          dtype=self.dtype)
+        else:
+            et = np.zeros((len(s_idxs), d), dtype=self.dtype)
+
+        for g_rows, g_idxs, g_vals in phi_groups:
+            n_g, k = g_idxs.shape
+            # (n_g, k, |A|, d) rows of the active features
+            Wz_rows = self.Wz[s_idxs[g_rows][:, None], g_idxs]
+            if acts is None:
+                g_et = _bvecmat(g_vals, np.reshape(Wz_rows, (n_g, k, -1)))
+                et[g_rows] = np.reshape(g_et, (n_g, self.num_actions, d))
+            else:
+                g_Wz = Wz_rows[np.arange(n_g), :, acts[g_rows]]  # (n_g, k, d)
+                et[g_rows] = _bvecmat(g_vals, g_Wz)
+        return et
+
+
+# ==
+# For testing purposes only
+if __name__ == "__main__":
+    # Check that each seed of the batched agents is bit-identical to the
+    # un-batched agent with that seed (run from linear/ as
+    # `python -m algos.batched_ag`)
+    from envs.boyans_chain import BoyansChainEnv
+    from envs.perf_bin_tree import PerfBinaryTreeEnv
+
+    seeds = [0, 1, 2, 3]
+    num_episodes = 40
+
+    def run_seed_agent(batch_cls, agent_kwargs, env, seed):
+        agent = batch_cls.seed_agent_cls(env.feature_dim, 1, seed=seed,
+                                         **agent_kwargs)
+        for _ in range(num_episodes):
+            act = agent.begin_episode(env.reset())
+            done = False
+            while not done:
+                obs, rew, done, _ = env.step(act)
+                act = agent.step(obs, rew, done)
+        return agent
+
+    def run_batched_agent(batch_cls, agent_kwargs, envs):
+        agent = batch_cls(envs[0].feature_dim, 1, seeds=seeds,
+                          **agent_kwargs)
+        n = len(envs)
+        for _ in range(num_episodes):
+            agent.begin_episode(np.stack([env.reset() for env in envs]))
+            live = np.ones(n, dtype=bool)
+            while np.any(live):
+                obs = np.zeros((n, envs[0].feature_dim))
+                rew, done = np.zeros(n), np.zeros(n, dtype=bool)
+                for i in np.flatnonzero(live):
+                    obs[i], rew[i], done[i], _ = envs[i].step(0)
+                agent.step(obs, rew, done, mask=live)
+                live &= ~done
+        return agent
+
+    env_fns = {
+        'BoyansChainEnv': lambda s: BoyansChainEnv(seed=s),
+        'PerfBinaryTreeEnv(path)': lambda s: PerfBinaryTreeEnv(
+            depth=4, feature_type='path', seed=s),
+    }
+    agent_specs = [
+        (BatchedSFReturnAgent, dict(lamb=0.6, eta_trace=0.4, lr=0.05)),
+        (BatchedSarsaLambdaAgent, dict(lamb=0.6, lr=0.05)),
+        (BatchedExpectedTraceAgent, dict(lamb=0.6, lr=0.05, eta=0.0)),
+        (BatchedExpectedTraceAgent, dict(lamb=0.6, lr=0.05, eta=0.5)),
+    ]
+    for env_name, env_fn in env_fns.items():
+        for batch_cls, agent_kwargs in agent_specs:
+            batch_ag = run_batched_agent(batch_cls, agent_kwargs,
+                                         [env_fn(s) for s in seeds])
+            for i, s in enumerate(seeds):
+                seed_ag = run_seed_agent(batch_cls, agent_kwargs, env_fn(s),
+                                         s)
+                for att_str in batch_cls.param_attrs:
+                    assert np.array_equal(getattr(batch_ag, att_str)[i],
+                                          getattr(seed_ag, att_str)), \
+                        (env_name, batch_cls.__name__, att_str, s)
+                for k, stats in seed_ag.log_dict.items():
+                    assert batch_ag.log_dicts[i][k].sum == stats.sum, \
+                        (env_name, batch_cls.__name__, k, s)
+            print(env_name, batch_cls.__name__, agent_kwargs, 'identical')
@@ -12,6 +12,8 @@ from gym import spaces
 import numpy as np
 
 from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
+import utils.jit_kernels as jk
 
 
 class ExpectedTraceAgent(BaseLinearAgent):
@@ -20,32 +22,81 @@ class ExpectedTraceAgent(BaseLinearAgent):
                  gamma=0.9,
                  lamb=0.8,
                  lr=0.1,
+                 eta=0.0,
+                 et_param='full',
+                 et_rank=None,
+                 use_jit=False,
+                 dtype=np.float64,
                  seed=0):
 
         """
         TODO define arguments
+        :param eta: mixture of the expected (eta=0) and instantaneous
+                    (eta=1) traces used in the Q function update, with the
+                    recursive ET(lambda, eta) trace of van Hasselt et al.,
+                    z_t = (1 - eta) z(S_t) + eta (gamma lamb z_{t-1} + phi_t)
+        :param et_param: parameterization of the expected trace of each
+                         action, z(phi, a) = phi^T Wz[a]. One of
+                         'full': (d, d) matrices, O(|A| * d^2) memory
+                         'diag': diagonal matrices, O(|A| * d) memory
+                         'low_rank': Wz[a] = U[a] @ V[a].T of rank et_rank,
+                                     O(|A| * d * k) memory
+        :param et_rank: rank k of the 'low_rank' expected traces
+        :param use_jit: use the (numba) compiled update kernel if available,
+                        only for the 'full' expected traces
         """
-        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr, seed=seed)
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, seed=seed)
         self.lamb = lamb
-        self.eta = 0.0  # for now use just the full expected trace
+        self.eta = eta
         self.value_lr = lr
         self.et_lr = lr
+        self.use_jit = jk.check_use_jit(use_jit)
 
         # Initialize Q function and trace
-        self.Wq = np.zeros((self.feature_dim, self.num_actions))  # TODO check correct
-        self.Z = np.zeros((self.feature_dim, self.num_actions))  # TODO check correct
-        self.Wz = np.zeros((self.num_actions,
-                            self.feature_dim,
-                            self.feature_dim))  # trace params
+        self.Wq = np.zeros((self.feature_dim, self.num_actions),
+                           dtype=self.dtype)  # TODO check correct
+        self.Z = np.zeros((self.feature_dim, self.num_actions),
+                          dtype=self.dtype)  # TODO check correct
+        # (eta-mixture) trace used in the Q function update, only kept for
+        # eta > 0 (it is the expected trace itself for eta = 0)
+        self.Z_mix = np.zeros((self.feature_dim, self.num_actions),
+                              dtype=self.dtype)
+
+        # Expected trace params
+        self.et_param = et_param
+        self.et_rank = et_rank
+        if self.et_param == 'full':
+            # NOTE: laid out as (d_in, |A|, d_out), so the rows of the
+            #       active features hold the traces of all actions
+            #       contiguously
+            self.Wz = np.zeros((self.feature_dim,
+                                self.num_actions,
+                                self.feature_dim),
+                               dtype=self.dtype)
+        elif self.et_param == 'diag':
+            self.Wz_diag = np.zeros((self.num_actions, self.feature_dim),
+                                    dtype=self.dtype)
+        elif self.et_param == 'low_rank':
+            # U starts at zero, so the expected traces start at zero
+            self.Wz_U, self.Wz_V = self._init_sf_factors(self.et_rank)
+        else:
+            raise ValueError(f'Unknown et_param: {et_param}')
+
+        if self.use_jit and self.et_param != 'full':
+            raise ValueError('use_jit requires et_param=full')
+        # Scratch buffer of the compiled update
+        self._et_buf = np.empty(self.feature_dim, dtype=self.dtype)
 
     def begin_episode(self, phi):
         super().begin_episode(phi)
         self.log_dict = {
-            'value_errors': [],
-            'et_error_norms': [],
+            'value_errors': RunningStats(),
+            'et_error_norms': RunningStats(),
         }
-        # Reset eligibility trace
+        # Reset eligibility traces
         self.Z *= 0.0
+        self.Z_mix *= 0.0
 
     def step(self, phi_t: np.array, reward: float, done: bool) -> int:
         """
@@ -59,6 +110,18 @@ class ExpectedTraceAgent(BaseLinearAgent):
         # Get new action based on state
         new_act = self._select_action(phi_t)
 
+        # (Optional) compiled update, straight from the current (S, A)
+        if self.use_jit:
+            td_err, et_err_norm = jk.expected_trace_step(
+                self.Wq, self.Z, self.Z_mix, self.Wz, self.cur_phi,
+                self.cur_act, phi_t, new_act, reward, done, self.gamma,
+                self.lamb, self.eta, self.lr, self.et_lr, self._et_buf
+            )
+            self.log_dict['value_errors'].append(td_err)
+            self.log_dict['et_error_norms'].append(et_err_norm)
+            self.cur_phi, self.cur_act = phi_t, new_act
+            return new_act
+
         # Save trajectory
         if not done:
             self.traj['phi'].append(phi_t)
@@ -81,20 +144,23 @@ class ExpectedTraceAgent(BaseLinearAgent):
         rew = self.traj['r'][t_idx]
 
         # ==
-        # Update transient trace
-        act_vec = np.zeros(self.num_actions)
-        act_vec[cur_act] = 1.0
-        grad_Qw = np.outer(cur_phi, act_vec)
-
-        self.Z = (self.lamb * self.gamma) * self.Z + grad_Qw
+        # Update transient trace (in place)
+        self.Z *= (self.lamb * self.gamma)
+        self.Z[:, cur_act] += cur_phi
 
         # ==
+        # Expected traces of all actions, only over the active features
+        phi_idxs = np.flatnonzero(cur_phi)
+        phi_vals = cur_phi[phi_idxs]
+        all_et = self.compute_expected_traces(phi_idxs, phi_vals)  # (|A|, d)
+
         # Supervised learning of expected trace  # TODO make sure below is okay
-        cur_et = np.transpose(self.Wz[cur_act]) @ cur_phi  # (d, )
-        et_err = self.Z[:, cur_act] - cur_et  # (d, )
-        d_Wz = np.transpose(np.outer(et_err, cur_phi.T))  # (d, d)
+        et_err = self.Z[:, cur_act] - all_et[cur_act]  # (d, )
+        self._optimize_expected_trace(phi_idxs, phi_vals, cur_act, et_err)
 
-        self.Wz[cur_act] += self.et_lr * d_Wz  # update ET
+        # Only the expected trace of the current action has changed
+        all_et[cur_act] = self.compute_expected_traces(phi_idxs, phi_vals,
+                                                       act=cur_act)
 
         # ==
         # Update Q function
@@ -108,14 +174,14 @@ class ExpectedTraceAgent(BaseLinearAgent):
         cur_q = self.compute_Q_value(cur_phi, cur_act)
         td_err = rew + (self.gamma * nex_q) - cur_q
 
-        # Parameter udpates with ET
-        cur_et = np.matmul(
-            np.transpose(self.Wz, axes=(0, 2, 1)), cur_phi
-        )  # (|A|, d, d) x (d,) -> (|A|, d)
-
-        # Parameter updates
-        del_Wq = td_err * np.transpose(cur_et)
-        self.Wq = self.Wq + (self.lr * del_Wq)
+        # Parameter updates with the (eta-mixture) ET
+        if self.eta > 0.0:
+            self.Z_mix *= (self.eta * self.lamb * self.gamma)
+            self.Z_mix[:, cur_act] += self.eta * cur_phi
+            self.Z_mix += (1 - self.eta) * np.transpose(all_et)
+            self.Wq += self.lr * (td_err * self.Z_mix)
+        else:
+            self.Wq += self.lr * (td_err * np.transpose(all_et))
 
         # ==
         # Logging losses
@@ -124,6 +190,139 @@ class ExpectedTraceAgent(BaseLinearAgent):
             np.linalg.norm(et_err)
         )
 
+    def compute_expected_traces(self, phi_idxs, phi_vals,
+                                act=None) -> np.ndarray:
+        """
+        Helper function, compute the expected traces z(phi, a) = phi^T Wz[a]
+        from the active features
+        :param phi_idxs: (nnz, ) indices of the non-zero features
+        :param phi_vals: (nnz, ) non-zero feature values
+        :param act: action, or None for all actions
+        :return: (d, ) expected trace, or (|A|, d) for all actions
+        """
+        if self.et_param == 'full':
+            # Avoid copying the rows for dense features
+            if len(phi_idxs) == self.feature_dim:
+                Wz_rows = self.Wz
+            else:
+                Wz_rows = self.Wz[phi_idxs]  # (nnz, |A|, d)
+            if act is not None:
+                return phi_vals @ Wz_rows[:, act, :]
+            all_et = phi_vals @ np.reshape(Wz_rows, (len(phi_idxs), -1))
+            return np.reshape(all_et, (self.num_actions, self.feature_dim))
+
+        if self.et_param == 'diag':
+            acts = slice(None) if act is None else act
+            et = np.zeros(np.shape(self.Wz_diag[acts]), dtype=self.dtype)
+            et[..., phi_idxs] = phi_vals * self.Wz_diag[acts, phi_idxs]
+            return et
+
+        # Low-rank, phi^T U[a] V[a]^T
+        if act is not None:
+            phi_U = phi_vals @ self.Wz_U[act, phi_idxs, :]  # (k, )
+            return self.Wz_V[act] @ phi_U
+        phi_U = np.matmul(phi_vals, self.Wz_U[:, phi_idxs, :])  # (|A|, k)
+        return np.matmul(self.Wz_V, phi_U[:, :, None])[:, :, 0]
+
+    def _optimize_expected_trace(self, phi_idxs, phi_vals, act,
+                                 et_err) -> None:
+        """
+        SGD step on the squared expected trace error of an action, in
+        place and only over the parameters of the active features
+        """
+        if self.et_param == 'full':
+            self.Wz[phi_idxs, act, :] += self.et_lr * np.outer(
+                phi_vals, et_err
+            )
+        elif self.et_param == 'diag':
+            self.Wz_diag[act, phi_idxs] += self.et_lr * (
+                phi_vals * et_err[phi_idxs]
+            )
+        else:
+            phi_U = phi_vals @ self.Wz_U[act, phi_idxs, :]  # (k, )
+            err_V = et_err @ self.Wz_V[act]  # (k, )
+            self.Wz_U[act, phi_idxs, :] += self.et_lr * np.outer(
+                phi_vals, err_V
+            )
+            self.Wz_V[act] += self.et_lr * np.outer(et_err, phi_U)
+
+    def expected_update(self, model: dict) -> None:
+        """
+        Expected updates under the on-policy state distribution D. With
+        the trace operator M = Phi^T D (I - gamma lamb P)^-1, the rows of
+        M^T are d(s) E[z_t | s_t = s], so the expected traces regress as
+            Wz += et_lr * Phi^T (M^T - D Phi Wz)
+        and the value parameters follow the expected ET(lambda, eta) trace,
+        whose rows of (I - eta gamma lamb P^T)^-1 D ((1 - eta) Phi Wz +
+        eta Phi) are d(s) E[z_t | s_t = s], i.e.
+            Wq += lr * ((1 - eta) Wz^T + eta I) M_eta delta
+        with M_eta = Phi^T D (I - eta gamma lamb P)^-1 and delta the
+        expected TD errors of all states
+        :param model: dict from mdp_utils.get_expected_update_model
+        """
+        trace_op = self._expected_trace_operator(
+            model, self.gamma * self.lamb
+        )  # (d, N)
+        phiMat, d_vec = model['Phi'], model['d']
+
+        # ==
+        # Expected trace learning, error D (E[z | s] - Z_bar) weighted by d
+        et_mat = self.predict_expected_traces(phiMat)  # (N, d)
+        d_et_errs = trace_op.T - (d_vec[:, None] * et_mat)  # (N, d)
+        if self.et_param == 'full':
+            self.Wz[:, 0, :] += self.et_lr * (phiMat.T @ d_et_errs)
+        elif self.et_param == 'diag':
+            self.Wz_diag[0] += self.et_lr * np.sum(phiMat * d_et_errs,
+                                                   axis=0)
+        else:
+            phi_U = phiMat @ self.Wz_U[0]  # (N, k)
+            self.Wz_U[0] += self.et_lr * (
+                phiMat.T @ (d_et_errs @ self.Wz_V[0])
+            )
+            self.Wz_V[0] += self.et_lr * (d_et_errs.T @ phi_U)
+
+        # ==
+        # Value learning with the (eta-mixture) expected traces
+        v_vec = phiMat @ self.Wq[:, 0]  # (N, )
+        td_errs = model['R'] + self.gamma * (model['P'] @ v_vec) - v_vec
+        if self.eta > 0.0:
+            mix_op = self._expected_trace_operator(
+                model, self.eta * self.gamma * self.lamb
+            )  # (d, N)
+            phi_del = mix_op @ td_errs  # (d, )
+            # Wz^T phi_del, as the expected trace of the "feature" phi_del
+            del_w = (1 - self.eta) * self.predict_expected_traces(
+                phi_del[None, :]
+            )[0]
+            del_w += self.eta * phi_del
+        else:
+            et_mat = self.predict_expected_traces(phiMat)
+            del_w = (d_vec * td_errs) @ et_mat
+        self.Wq[:, 0] += self.lr * del_w
+
+        # ==
+        # Logging losses, ET error over the visited states only
+        visited = d_vec > 0.0
+        self.log_dict['value_errors'].append(
+            self._weighted_rms(td_errs, d_vec)
+        )
+        self.log_dict['et_error_norms'].append(np.sqrt(np.sum(
+            d_et_errs[visited] ** 2 / d_vec[visited, None]
+        )))
+
+    def predict_expected_traces(self, Phi, act=0) -> np.ndarray:
+        """
+        Expected traces of a matrix of (dense) features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, d) expected traces, z(Phi, act)
+        """
+        if self.et_param == 'full':
+            return Phi @ self.Wz[:, act, :]
+        if self.et_param == 'diag':
+            return Phi * self.Wz_diag[act]
+        return (Phi @ self.Wz_U[act]) @ np.transpose(self.Wz_V[act])
+
     def compute_Q_value(self, phi, act) -> float:
         """
         Helper function, compute the value given a state feature and action
@@ -135,6 +334,15 @@ class ExpectedTraceAgent(BaseLinearAgent):
         q_vec = phi @ self.Wq
         return q_vec[act]
 
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values, Q(Phi, act)
+        """
+        return Phi @ self.Wq[:, act]
+
     def _select_action(self, phi) -> int:
         """
         Selects action
@@ -0,0 +1,274 @@
+# =============================================================================
+# Least-squares (LSTD) successor lambda return agent. Same estimates as the
+# SFReturnAgent, but the SF, reward and value parameters are solved for
+# incrementally with recursive least-squares (Sherman-Morrison rank-1
+# inverse updates), so there are no step sizes to tune. O(d^2) per step.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
+
+
+class LSTDSFReturnAgent(BaseLinearAgent):
+    def __init__(self, feature_dim,
+                 num_actions,
+                 gamma=0.9,
+                 lamb=0.8,
+                 eta_trace=0.0,
+                 ridge_reg=1e-3,
+                 use_true_reward_params=False,
+                 use_true_sf_params=False,
+                 dtype=np.float64,
+                 seed=0):
+        """
+        TODO define arguments
+        :param feature_dim:
+        :param num_actions:
+        :param gamma:
+        :param lamb: discount for SF
+        :param eta_trace: value fn trace decay, i.e. LSTD(eta) for the value
+        :param ridge_reg: initial A = ridge_reg * I of each least-squares
+                          problem, i.e. a ridge penalty pulling the SF
+                          parameters to the identity and the reward / value
+                          parameters to zero
+        :param seed:
+        """
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=None,
+                         dtype=dtype, seed=seed)
+
+        self.lamb = lamb
+        self.eta_trace = eta_trace
+        self.ridge_reg = ridge_reg
+
+        # Weights
+        self.Wr = np.zeros(self.feature_dim, dtype=self.dtype)
+        self.Wv = np.zeros(self.feature_dim, dtype=self.dtype)
+        self.Ws = np.zeros((self.num_actions,
+                            self.feature_dim,
+                            self.feature_dim),
+                           dtype=self.dtype)  # |A| * d * D
+        ws_idxs = np.arange(self.feature_dim)
+        self.Ws[:, ws_idxs, ws_idxs] = 1.0
+
+        # Inverses of the least-squares A matrices, A = ridge_reg * I
+        inv_diag = 1.0 / self.ridge_reg
+        self.Ar_inv = np.zeros((self.feature_dim, self.feature_dim),
+                               dtype=self.dtype)
+        self.Ar_inv[ws_idxs, ws_idxs] = inv_diag
+        self.As_inv = np.zeros_like(self.Ws)
+        self.As_inv[:, ws_idxs, ws_idxs] = inv_diag
+        self.Av_inv = np.copy(self.Ar_inv)
+
+        # Trace
+        self.Zv = np.zeros(self.feature_dim, dtype=self.dtype)
+
+        # (Optional) Give agent the solved sf and/or reward parameters
+        self.use_true_sf_params = use_true_sf_params
+        self.use_true_reward_params = use_true_reward_params
+
+    def begin_episode(self, phi):
+        super().begin_episode(phi)
+
+        self.log_dict = {
+            'reward_errors': RunningStats(),
+            'sf_error_norms': RunningStats(),
+            'value_errors': RunningStats(),
+        }
+
+        # Reset trace
+        self.Zv = self.Zv * 0.0
+
+    def step(self, phi_t: np.array, reward: float, done: bool) -> int:
+        # Get new action based on state
+        new_act = self._select_action(phi_t)
+
+        # Save trajectory
+        if not done:
+            self.traj['phi'].append(phi_t)
+            self.traj['a'].append(new_act)
+        self.traj['r'].append(reward)
+
+        # ==
+        # Learning
+        if not self.use_true_reward_params:
+            self._optimize_reward_fn()
+        if not self.use_true_sf_params:
+            self._optimize_successor_features(done)
+        self._optimize_value_fn(done)
+
+        return new_act
+
+    @staticmethod
+    def _rls_update(A_inv, W, u, v, target) -> np.ndarray:
+        """
+        Recursive least-squares update of the solution W = A^-1 b, for
+        A <- A + u v^T and b <- b + u target^T, in place on A_inv and W
+        :param A_inv: (d, d) inverse of A
+        :param W: (d, ) or (d, m) solution
+        :param u: (d, ) vector
+        :param v: (d, ) vector
+        :param target: scalar or (m, ) target
+        :return: the error (target - v^T W) before the update
+        """
+        A_inv_u = A_inv @ u
+        v_A_inv = v @ A_inv
+        gain = A_inv_u / (1.0 + (v @ A_inv_u))  # (d, )
+
+        err = target - (v @ W)
+        if np.ndim(W) == 1:
+            W += gain * err
+        else:
+            W += np.outer(gain, err)
+        A_inv -= np.outer(gain, v_A_inv)  # Sherman-Morrison
+        return err
+
+    def _optimize_reward_fn(self) -> None:
+        # NOTE: as in the SFReturnAgent, we learn mapping phi_t -> r_{t+1}
+        t_idx = len(self.traj['r']) - 1
+        cur_phi = self.traj['phi'][t_idx]
+        cur_rew = self.traj['r'][t_idx]
+
+        rew_err = self._rls_update(self.Ar_inv, self.Wr,
+                                   cur_phi, cur_phi, cur_rew)
+
+        # (Log) Reward error
+        self.log_dict['reward_errors'].append(rew_err)
+
+    def _optimize_successor_features(self, done) -> None:
+        """
+        LSTD for the SF, phi^T Ws[a] = phi^T + lamb * gamma * phi'^T Ws[a'].
+        When a' != a the next SF is taken as a fixed regression target.
+        """
+        t_idx = len(self.traj['r']) - 1
+        cur_phi = self.traj['phi'][t_idx]
+        cur_act = self.traj['a'][t_idx]
+
+        # A += phi (phi - lamb * gamma * phi')^T, b += phi phi^T
+        v_vec = cur_phi
+        target = cur_phi
+        if not done:
+            nex_phi = self.traj['phi'][t_idx + 1]
+            nex_act = self.traj['a'][t_idx + 1]
+            if nex_act == cur_act:
+                v_vec = cur_phi - (self.lamb * self.gamma) * nex_phi
+            else:
+                target = cur_phi + (self.lamb * self.gamma) * (
+                    nex_phi @ self.Ws[nex_act]
+                )
+
+        # The error is the SF TD error
+        sf_td_err = self._rls_update(self.As_inv[cur_act], self.Ws[cur_act],
+                                     cur_phi, v_vec, target)
+
+        # (Log) Norm of the SF error vector
+        self.log_dict['sf_error_norms'].append(
+            np.linalg.norm(sf_td_err)
+        )
+
+    def _optimize_value_fn(self, done) -> None:
+        """
+        LSTD(eta) for the value with the lambda successor return target,
+        r + gamma * phi'^T Ws[a'] ((1-lamb) Wv + lamb Wr), using the current
+        SF and reward estimates
+        """
+        t_idx = len(self.traj['r']) - 1
+        cur_phi = self.traj['phi'][t_idx]
+        nex_rew = self.traj['r'][t_idx]
+
+        # Update trace (not action conditioned)
+        self.Zv = (self.eta_trace * self.gamma) * self.Zv + cur_phi
+
+        # A += z (phi - gamma * (1-lamb) * psi')^T, b += z r_slr
+        v_vec = cur_phi
+        target = nex_rew
+        if not done:
+            nex_phi = self.traj['phi'][t_idx + 1]
+            nex_act = self.traj['a'][t_idx + 1]
+            nex_sf = self.compute_successor_features(nex_phi, nex_act)
+            v_vec = cur_phi - (self.gamma * (1 - self.lamb)) * nex_sf
+            target = nex_rew + (self.gamma * self.lamb) * (nex_sf @ self.Wr)
+
+        # The error is the value TD error
+        v_td_err = self._rls_update(self.Av_inv, self.Wv,
+                                    self.Zv, v_vec, target)
+
+        # (Log) Value function error
+        self.log_dict['value_errors'].append(v_td_err)
+
+    def compute_successor_return(self, phi, act) -> float:
+        """
+        Helper function, compute the value estimate using the lambda
+        successor feature return
+        :param phi: state featureat time t
+        :param act: action
+        :return: value, Q(phi, act)_t
+        """
+        sf_T = self.compute_successor_features(phi, act)  # (d, )
+        slr_V = sf_T @ (
+                ((1-self.lamb) * self.Wv) + (self.lamb * self.Wr)
+        )
+        return slr_V
+
+    def predict_successor_returns(self, Phi, act=0) -> np.ndarray:
+        """
+        Lambda successor return value estimates of a matrix of features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values
+        """
+        sf_mat = self.compute_successor_features(Phi, act)  # (N, d)
+        return sf_mat @ (
+                ((1-self.lamb) * self.Wv) + (self.lamb * self.Wr)
+        )
+
+    def compute_successor_features(self, phi, act) -> np.ndarray:
+        """
+        Helper function, compute the successor features phi^T Ws[act]
+        :param phi: state feature (d, ), or (N, d) matrix of features
+        :param act: action
+        :return: (d, ) successor features, or (N, d) for matrix input
+        """
+        return phi @ self.Ws[act]
+
+    def set_sf_params(self, act, sf_mat) -> None:
+        """
+        Set the SF parameters of an action, e.g. to the solved parameters
+        when using use_true_sf_params
+        :param act: action
+        :param sf_mat: (d, d) SF parameter matrix
+        """
+        self.Ws[act] = sf_mat
+
+    def compute_Q_value(self, phi, act) -> float:
+        """
+        Helper function, compute the value given a state feature and action
+        using just the value function parameters
+        NOTE: using Q for compatibility but it should be V function
+
+        :return: value, Q(phi, act)
+        """
+        return np.dot(phi, self.Wv)
+
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features, using just the value
+        function parameters
+        :param Phi: (N, d) matrix of features
+        :param act: action (unused, V function)
+        :return: (N, ) values
+        """
+        return Phi @ self.Wv
+
+    def _select_action(self, phi) -> int:
+        # Policy evaluation only
+        return 0
+
+
+# ==
+# For testing purposes only
+if __name__ == "__main__":
+    pass
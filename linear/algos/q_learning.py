@@ -11,7 +11,9 @@ from gym import spaces
 import numpy as np
 
 from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
 from utils.optim import *
+import utils.jit_kernels as jk
 
 LogTupStruct = namedtuple(
     'LogTupStruct',
@@ -28,13 +30,19 @@ class QAgent(BaseLinearAgent):
                  lr=0.1,
                  policy_epsilon=0.3,
                  optim=None,
+                 use_jit=False,
+                 dtype=np.float64,
                  seed=0):
 
         """
         TODO define arguments
+        :param use_jit: use the (numba) compiled trace / TD error kernel
+                        if available
         """
-        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr, seed=seed)
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, seed=seed)
         self.lamb = lamb  # TODO implement?
+        self.use_jit = jk.check_use_jit(use_jit)
 
         self.policy_epsilon = policy_epsilon
 
@@ -47,12 +55,13 @@ class QAgent(BaseLinearAgent):
         self.Wq = self.rng.uniform(
             low=0.0, high=1e-5,
             size=(self.feature_dim, self.num_actions)
-        )
+        ).astype(self.dtype, copy=False)
         self.Wq_optim = optim_cls(self.Wq, lr=lr, **optim_kwargs)
 
         # ==
         # Initialize trace (TODO implement and check validity?)
-        self.Z = np.zeros((self.feature_dim, self.num_actions))
+        self.Z = np.zeros((self.feature_dim, self.num_actions),
+                          dtype=self.dtype)
 
         # ==
         # For logging
@@ -62,7 +71,7 @@ class QAgent(BaseLinearAgent):
         action = super().begin_episode(phi)
 
         self.log_dict = {
-            'value_errors': [],
+            'value_errors': RunningStats(),
         }
 
         # Reset eligibility trace  TODO implement?
@@ -81,6 +90,18 @@ class QAgent(BaseLinearAgent):
 
         # New action and storage
         new_act = self._select_action(phi_t)
+
+        # (Optional) compiled trace / TD error, from the current (S, A)
+        if self.use_jit:
+            td_err = jk.q_learning_trace_td(
+                self.Wq, self.Z, self.cur_phi, self.cur_act, phi_t, reward,
+                done, self.gamma, self.lamb
+            )
+            self.Wq = self.Wq + self.Wq_optim.step(td_err * self.Z)
+            self.log_dict['value_errors'].append(td_err)
+            self.cur_phi, self.cur_act = phi_t, new_act
+            return new_act
+
         if not done:
             self.traj['phi'].append(phi_t)
             self.traj['a'].append(new_act)
@@ -104,7 +125,7 @@ class QAgent(BaseLinearAgent):
 
         # ==
         # Update trace
-        act_vec = np.zeros(self.num_actions)
+        act_vec = np.zeros(self.num_actions, dtype=self.dtype)
         act_vec[cur_act] = 1.0
         grad_Qw = np.outer(cur_phi, act_vec)
 
@@ -141,6 +162,15 @@ class QAgent(BaseLinearAgent):
         q_vec = phi @ self.Wq
         return q_vec[act]
 
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values, Q(Phi, act)
+        """
+        return Phi @ self.Wq[:, act]
+
     def _select_action(self, phi) -> int:
         """
         Selects action
@@ -12,12 +12,13 @@ from gym import spaces
 import numpy as np
 
 from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
 from utils.optim import *
 
 LogTupStruct = namedtuple(
     'LogTupStruct',
     field_names=['lamb', 'eta_trace', 'lr', 'reward_lr', 'sf_lr',
-                 'policy_epsilon', 'use_lambda_q_control', 'optim',
+                 'policy_epsilon', 'use_lambda_q_control', 'sf_rank', 'optim',
                  'value_loss_avg', 'sf_loss_avg', 'reward_loss_avg']
 )
 
@@ -33,7 +34,10 @@ class LambdaSFQAgent(BaseLinearAgent):
                  sf_lr=None,
                  policy_epsilon=0.3,
                  use_lambda_q_control=False,
+                 sf_rank=None,
+                 cache_sf_proj=False,
                  optim=None,
+                 dtype=np.float64,
                  seed=0):
         """
         TODO define arguments
@@ -42,10 +46,16 @@ class LambdaSFQAgent(BaseLinearAgent):
         :param gamma:
         :param lamb:
         :param lr:
+        :param sf_rank: if not None, factorize the SF parameters as
+                        Ws[a] = I + U[a] @ V[a].T with rank sf_rank
+        :param cache_sf_proj: if True, cache the per-action projections
+                              Ws[a] @ Wq[a] and Ws[a] @ Wr so a lambda-Q
+                              query is O(|A| * d) (dense Ws only, and
+                              Ws[a] @ Wq[a] only with the SGD optim)
         :param seed:
         """
         super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
-                         seed=seed)
+                         dtype=dtype, seed=seed)
 
         self.lamb = lamb
         self.eta_trace = eta_trace  # value fn bwd trace
@@ -63,43 +73,77 @@ class LambdaSFQAgent(BaseLinearAgent):
 
         # Reward parameters
         self.Wr = self.rng.uniform(0.0, 1e-5,
-                                   size=self.feature_dim)
+                                   size=self.feature_dim
+                                   ).astype(self.dtype, copy=False)
         self.Wr_optim = optim_cls(self.Wr, lr=self.reward_lr, **optim_kwargs)
 
         # SF parameters
-        self.Ws = np.zeros(
-            (self.num_actions, self.feature_dim, self.feature_dim)
-        )  # |A| * d * D
-        ws_idxs = np.arange(self.feature_dim)
-        self.Ws[:, ws_idxs, ws_idxs] = 1.0  # identity initialization
-        self.Ws_optim = optim_cls(self.Ws, lr=self.sf_lr, **optim_kwargs)
+        self.sf_rank = sf_rank
+        self.reset_sf_params()
+        if self.sf_rank is None:
+            self.Ws_optim = optim_cls(self.Ws, lr=self.sf_lr, **optim_kwargs)
+        else:
+            self.Ws_U_optim = optim_cls(self.Ws_U, lr=self.sf_lr,
+                                        **optim_kwargs)
+            self.Ws_V_optim = optim_cls(self.Ws_V, lr=self.sf_lr,
+                                        **optim_kwargs)
 
         # Value parameters
         self.Wq = self.rng.uniform(
             0.0, 1e-5,
             size=(self.num_actions, self.feature_dim)
-        )
+        ).astype(self.dtype, copy=False)
         self.Wq_optim = optim_cls(self.Wq, lr=self.value_lr, **optim_kwargs)
 
         # ==
         # Trace  # TODO not tested for validity
-        self.Zq = np.zeros((self.num_actions, self.feature_dim))
+        self.Zq = np.zeros((self.num_actions, self.feature_dim),
+                           dtype=self.dtype)
+
+        # ==
+        # (Optional) Cached SF-to-value projections, (num_actions, d) each
+        if cache_sf_proj and (self.sf_rank is not None):
+            raise ValueError('cache_sf_proj requires sf_rank=None')
+        self.cache_sf_proj = cache_sf_proj
+        self.Pq_cache = None
+        self.Pr_cache = None
+
+        # The SGD steps of Wq are proportional to the trace, so Ws @ Wq is
+        # updated with the projected trace Mq[a] = Ws[a] @ Zq[a], kept
+        # alongside the trace. The adaptive steps are not, and Ws @ Wq is
+        # then computed from the active features on each query instead.
+        self.cache_q_proj = (self.cache_sf_proj and
+                             type(self.Wq_optim) is SGD)
+        self.Mq = np.zeros((self.num_actions, self.feature_dim),
+                           dtype=self.dtype)
+
+        # (Ws, Wr) arrays the cache was computed from, and the steps since
+        self._proj_params = None
+        self._proj_steps = 0
 
         # ==
         # For logging
         self.logTupStruct = LogTupStruct
 
     def begin_episode(self, phi):
+        # Re-compute the projections in full if the parameters were replaced
+        # from outside (e.g. reset_sf_params), and after every feature_dim
+        # steps to bound the round-off of the incremental updates (so the
+        # O(|A| * d^2) refresh is amortized to O(|A| * d) per step)
+        if self.cache_sf_proj and self._sf_proj_stale():
+            self._refresh_sf_proj_cache()
+
         action = super().begin_episode(phi)
 
         self.log_dict = {
-            'reward_errors': [],
-            'sf_error_norms': [],
-            'value_errors': [],
+            'reward_errors': RunningStats(),
+            'sf_error_norms': RunningStats(),
+            'value_errors': RunningStats(),
         }
 
         # Reset trace  TODO need to implement and check
         self.Zq *= 0.0
+        self.Mq *= 0.0
 
         return action
 
@@ -124,6 +168,7 @@ class LambdaSFQAgent(BaseLinearAgent):
             self._optimize_reward_fn()  # reward
             self._optimize_successor_features(done)  # sf
             self._optimize_value_fn(done)  # value fn
+            self._proj_steps += 1
 
         return new_act
 
@@ -134,11 +179,17 @@ class LambdaSFQAgent(BaseLinearAgent):
         cur_phi = self.traj['phi'][t_idx]
         cur_rew = self.traj['r'][t_idx]
 
-        # Update reward function
+        # Update reward function, the gradient is only non-zero over the
+        # active features
         rew_err = cur_rew - np.dot(cur_phi, self.Wr)
         d_Wr = rew_err * cur_phi
-        ada_d_Wr = self.Wr_optim.step(d_Wr)
-        self.Wr = self.Wr + ada_d_Wr
+        nz_idxs = np.flatnonzero(cur_phi)
+        ada_d_Wr = self.Wr_optim.step_block(d_Wr[nz_idxs], nz_idxs)
+        self.Wr[nz_idxs] += ada_d_Wr
+
+        # (Optional) Update cache, only over the changed entries of Wr
+        if self.cache_sf_proj:
+            self.Pr_cache += self.Ws[:, :, nz_idxs] @ ada_d_Wr
 
         # (Log) Reward error
         self.log_dict['reward_errors'].append(d_Wr)
@@ -154,20 +205,45 @@ class LambdaSFQAgent(BaseLinearAgent):
             nex_phi = self.traj['phi'][t_idx + 1]
             q_vec = self.compute_lambda_Q_function(nex_phi)
             nex_act = np.argmax(q_vec)
-            nex_sf = np.transpose(self.Ws[nex_act]) @ nex_phi
+            nex_sf = self.compute_successor_features(nex_phi, nex_act)
         else:
             nex_sf = 0.0
 
         # Compute SF TD errors
-        cur_sf = np.transpose(self.Ws[cur_act]) @ cur_phi  # (d, )
+        cur_sf = self.compute_successor_features(cur_phi, cur_act)  # (d, )
         sf_td_err = cur_phi + (self.lamb * self.gamma * nex_sf) - cur_sf  # (d, )
-        d_Ws = np.transpose(np.outer(sf_td_err, cur_phi))
 
-        # Update  NOTE future: can use soft actions?
-        del_Ws = np.zeros_like(self.Ws)
-        del_Ws[cur_act] = d_Ws
-        ada_del_Ws = self.Ws_optim.step(del_Ws)
-        self.Ws = self.Ws + ada_del_Ws
+        # The gradient is only non-zero over the rows of Ws[cur_act] (or
+        # its factors) which are active in the features
+        row_idxs = np.flatnonzero(cur_phi)
+
+        if self.sf_rank is None:
+            d_Ws_rows = np.outer(cur_phi[row_idxs], sf_td_err)
+
+            # Update  NOTE future: can use soft actions?
+            ada_d_Ws_rows = self.Ws_optim.step_block(d_Ws_rows,
+                                                     (cur_act, row_idxs))
+            self.Ws[cur_act, row_idxs] += ada_d_Ws_rows
+
+            # (Optional) Update cache, only the changed rows
+            if self.cache_sf_proj:
+                self.Pr_cache[cur_act, row_idxs] += ada_d_Ws_rows @ self.Wr
+            if self.cache_q_proj:
+                self.Pq_cache[cur_act, row_idxs] += (ada_d_Ws_rows
+                                                     @ self.Wq[cur_act])
+                self.Mq[cur_act, row_idxs] += (ada_d_Ws_rows
+                                               @ self.Zq[cur_act])
+        else:
+            # Low-rank, semi-gradient w.r.t. each of the factors
+            err_V = sf_td_err @ self.Ws_V[cur_act]  # (k, )
+            phi_U = cur_phi @ self.Ws_U[cur_act]  # (k, )
+
+            self.Ws_U[cur_act, row_idxs] += self.Ws_U_optim.step_block(
+                np.outer(cur_phi[row_idxs], err_V), (cur_act, row_idxs)
+            )
+            self.Ws_V[cur_act] += self.Ws_V_optim.step_block(
+                np.outer(sf_td_err, phi_U), cur_act
+            )
 
         # (Log) Norm of the SF error vector
         self.log_dict['sf_error_norms'].append(
@@ -184,12 +260,19 @@ class LambdaSFQAgent(BaseLinearAgent):
 
         # ==
         # Update trace TODO: need to test for validity
-        act_vec = np.zeros(self.num_actions)
+        act_vec = np.zeros(self.num_actions, dtype=self.dtype)
         act_vec[cur_act] = 1.0  # (num_actions, )
         grad_Wq = np.outer(act_vec, cur_phi)  # (num_actions, feature_dim)
 
         self.Zq = (self.lamb * self.gamma) * self.Zq + grad_Wq
 
+        # (Optional) Projected trace, Mq[a] = Ws[a] @ Zq[a]
+        if self.cache_q_proj:
+            nz_idxs = np.flatnonzero(cur_phi)
+            self.Mq *= (self.lamb * self.gamma)
+            self.Mq[cur_act] += (self.Ws[cur_act][:, nz_idxs]
+                                 @ cur_phi[nz_idxs])
+
         # ==
         # Compute the lambda value function return
         if not done:
@@ -209,20 +292,98 @@ class LambdaSFQAgent(BaseLinearAgent):
         ada_del_Wq = self.Wq_optim.step(del_Wq)
         self.Wq = self.Wq + ada_del_Wq
 
+        # (Optional) Update cache, the SGD step is lr * td_err * Zq
+        if self.cache_q_proj:
+            self.Pq_cache += (self.Wq_optim.lr * td_err) * self.Mq
+
         # (Log) Value function error
         self.log_dict['value_errors'].append(td_err)
 
+    def reset_sf_params(self) -> None:
+        """
+        (Re-)initialize the SF parameters to the identity for each action
+        """
+        if self.sf_rank is None:
+            self.Ws = np.zeros(
+                (self.num_actions, self.feature_dim, self.feature_dim),
+                dtype=self.dtype
+            )  # |A| * d * D
+            ws_idxs = np.arange(self.feature_dim)
+            self.Ws[:, ws_idxs, ws_idxs] = 1.0  # identity initialization
+        else:
+            # Low-rank, Ws[a] = I + Ws_U[a] @ Ws_V[a].T, each |A| * d * k
+            self.Ws_U, self.Ws_V = self._init_sf_factors(self.sf_rank)
+
+    def _sf_proj_stale(self) -> bool:
+        """
+        Whether the cached projections need a full re-computation
+        """
+        if self._proj_params is None:
+            return True
+        cached_Ws, cached_Wr = self._proj_params
+        return ((cached_Ws is not self.Ws) or (cached_Wr is not self.Wr) or
+                (self._proj_steps >= self.feature_dim))
+
+    def _refresh_sf_proj_cache(self) -> None:
+        """
+        Fully re-compute the cached projections Ws[a] @ Wq[a], Ws[a] @ Wr
+        """
+        if self.cache_q_proj:
+            self.Pq_cache = np.matmul(self.Ws, self.Wq[:, :, None])[:, :, 0]
+        self.Pr_cache = np.matmul(self.Ws, self.Wr)
+        self._proj_params = (self.Ws, self.Wr)
+        self._proj_steps = 0
+
+    def compute_successor_features(self, phi, act=None):
+        """
+        Helper function to compute the successor features
+        :param phi: feature, size (feature_dim, )
+        :param act: (optional) action, if None compute for every action
+        :return: SF, size (feature_dim, ) if act is given, otherwise
+                 (num_actions, feature_dim)
+        """
+        if self.sf_rank is None:
+            # Only over the rows of the active features, for sparse phi
+            nz_idxs = np.flatnonzero(phi)
+            if len(nz_idxs) < self.feature_dim:
+                if act is not None:
+                    return phi[nz_idxs] @ self.Ws[act, nz_idxs]
+                return np.matmul(phi[nz_idxs], self.Ws[:, nz_idxs, :])
+
+            if act is not None:
+                return np.transpose(self.Ws[act]) @ phi
+            return np.matmul(
+                np.transpose(self.Ws, (0, 2, 1)),  # transpose feature dims
+                phi
+            )  # (num_actions, feature_dim)
+
+        if act is not None:
+            phi_U = phi @ self.Ws_U[act]  # (k, )
+            return phi + (self.Ws_V[act] @ phi_U)
+
+        phi_U = np.matmul(phi, self.Ws_U)  # (num_actions, k)
+        sf = np.matmul(
+            self.Ws_V, phi_U[:, :, None]
+        )[:, :, 0]  # (num_actions, feature_dim)
+        return phi + sf
+
     def compute_lambda_Q_function(self, phi):
         """
         Helper function to compute the lambda-Q estimate
         :param phi: feature, size (featuer_dim, )
         :return: Q estimate, size (num_actions, )
         """
-
-        sf = np.matmul(
-            np.transpose(self.Ws, (0, 2, 1)),  # transpose feature dims
-            phi
-        )  # (num_actions, feature_dim)
+        if self.cache_q_proj:
+            q_vec = ((1 - self.lamb) * (self.Pq_cache @ phi)
+                     + (self.lamb * (self.Pr_cache @ phi)))
+            return q_vec
+        if self.cache_sf_proj:
+            sf = self.compute_successor_features(phi)  # (num_actions, d)
+            sf_theta = np.sum((sf * self.Wq), axis=1)  # (num_actions, )
+            return ((1 - self.lamb) * sf_theta
+                    + (self.lamb * (self.Pr_cache @ phi)))
+
+        sf = self.compute_successor_features(phi)  # (num_actions, feature_dim)
 
         sf_theta = np.sum((sf * self.Wq), axis=1)  # (num_actions, )
         sf_w = np.matmul(sf, self.Wr)  # (num_actions, )
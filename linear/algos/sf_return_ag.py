@@ -11,6 +11,8 @@ from gym import spaces
 import numpy as np
 
 from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
+import utils.jit_kernels as jk
 
 
 class SFReturnAgent(BaseLinearAgent):
@@ -24,6 +26,11 @@ class SFReturnAgent(BaseLinearAgent):
                  sf_lr=None,
                  use_true_reward_params=False,
                  use_true_sf_params=False,
+                 sparse_phi=False,
+                 sf_rank=None,
+                 use_jit=False,
+                 update_batch_size=1,
+                 dtype=np.float64,
                  seed=0):
         """
         TODO define arguments
@@ -32,9 +39,22 @@ class SFReturnAgent(BaseLinearAgent):
         :param gamma:
         :param lamb:
         :param lr:
+        :param sparse_phi: if True, features are handled as sparse
+                           (indices, values) tuples so the updates only
+                           touch the active rows, O(nnz * d) per step
+        :param sf_rank: if not None, factorize the SF parameters as
+                        Ws[a] = I + U[a] @ V[a].T with rank sf_rank, using
+                        O(|A| * d * k) memory instead of O(|A| * d^2)
+        :param use_jit: use the (numba) compiled update kernels if available,
+                        only for dense features and SF parameters
+        :param update_batch_size: apply the updates every K transitions in
+                                  a single batched (matrix-matrix) update,
+                                  K=1 is the usual per-step update
         :param seed:
         """
-        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr, seed=seed)
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, update_batch_size=update_batch_size,
+                         seed=seed)
 
         self.lamb = lamb
         self.eta_trace = eta_trace  # value fn bwd trace
@@ -43,40 +63,70 @@ class SFReturnAgent(BaseLinearAgent):
         self.sf_lr = lr if sf_lr is None else sf_lr
 
         # Weights
-        self.Wr = np.zeros(self.feature_dim)
-        self.Ws = np.zeros((self.num_actions,
-                            self.feature_dim,
-                            self.feature_dim))  # |A| * d * D
-        self.Wv = np.zeros(self.feature_dim)
+        self.Wr = np.zeros(self.feature_dim, dtype=self.dtype)
+        self.Wv = np.zeros(self.feature_dim, dtype=self.dtype)
 
         # Trace
-        self.Zv = np.zeros(self.feature_dim)
+        self.Zv = np.zeros(self.feature_dim, dtype=self.dtype)
 
         # (Optional?) Initialize the SF weights to identity for each action,
         # corresponding to the learned weights for self.lamb = 0
-        ws_idxs = np.arange(self.feature_dim)
-        self.Ws[:, ws_idxs, ws_idxs] = 1.0
+        self.sf_rank = sf_rank
+        if self.sf_rank is None:
+            self.Ws = np.zeros((self.num_actions,
+                                self.feature_dim,
+                                self.feature_dim),
+                               dtype=self.dtype)  # |A| * d * D
+            ws_idxs = np.arange(self.feature_dim)
+            self.Ws[:, ws_idxs, ws_idxs] = 1.0
+        else:
+            # Low-rank, Ws[a] = I + Ws_U[a] @ Ws_V[a].T, each |A| * d * k
+            self.Ws_U, self.Ws_V = self._init_sf_factors(self.sf_rank)
 
         # (Optional) Give agent the solved sf and/or reward parameters
         self.use_true_sf_params = use_true_sf_params
         self.use_true_reward_params = use_true_reward_params
 
+        # (Optional) Sparse feature updates
+        self.sparse_phi = sparse_phi
+
+        # (Optional) Compiled update kernels
+        self.use_jit = jk.check_use_jit(use_jit)
+        if self.use_jit and (self.sparse_phi or self.sf_rank is not None):
+            raise ValueError('use_jit requires dense features and SF params')
+        self._sf_buf = np.empty(self.feature_dim, dtype=self.dtype)
+        if self.update_batch_size > 1 and (
+                self.sparse_phi or self.sf_rank is not None or self.use_jit):
+            raise ValueError('update_batch_size > 1 requires dense features '
+                             'and SF params, without use_jit')
+
     def begin_episode(self, phi):
+        if self.sparse_phi:
+            phi = self._to_sparse_phi(phi)
         super().begin_episode(phi)
 
         self.log_dict = {
-            'reward_errors': [],
-            'sf_error_norms': [],
-            'value_errors': [],
+            'reward_errors': RunningStats(),
+            'sf_error_norms': RunningStats(),
+            'value_errors': RunningStats(),
         }
 
         # Reset trace
         self.Zv = self.Zv * 0.0
 
     def step(self, phi_t: np.array, reward: float, done: bool) -> int:
+        if self.sparse_phi:
+            phi_t = self._to_sparse_phi(phi_t)
+
         # Get new action based on state
         new_act = self._select_action(phi_t)
 
+        # (Optional) compiled updates, straight from the current (S, A)
+        if self.use_jit:
+            self._optimize_jit(phi_t, new_act, reward, done)
+            self.cur_phi, self.cur_act = phi_t, new_act
+            return new_act
+
         # Save trajectory
         if not done:
             self.traj['phi'].append(phi_t)
@@ -85,6 +135,10 @@ class SFReturnAgent(BaseLinearAgent):
 
         # ==
         # Learning
+        if self.update_batch_size > 1:
+            if self._add_pending_transition(done):
+                self._optimize_batch(done)
+            return new_act
 
         # Reward learning
         if (not self.use_true_reward_params) and (len(self.traj['r']) > 0):
@@ -100,6 +154,80 @@ class SFReturnAgent(BaseLinearAgent):
 
         return new_act
 
+    def _optimize_jit(self, nex_phi, nex_act, rew, done) -> None:
+        """
+        Reward, SF and value learning with a single compiled kernel call,
+        for the transition from the current (S, A)
+        """
+        rew_err, sf_err_norm, v_td_err = jk.sf_return_step(
+            self.Wr, self.Ws, self.Wv, self.Zv, self.cur_phi, self.cur_act,
+            nex_phi, nex_act, rew, done, self.gamma, self.lamb,
+            self.eta_trace, self.reward_lr, self.sf_lr, self.value_lr,
+            not self.use_true_reward_params, not self.use_true_sf_params,
+            self._sf_buf
+        )
+        if not self.use_true_reward_params:
+            self.log_dict['reward_errors'].append(rew_err)
+        if not self.use_true_sf_params:
+            self.log_dict['sf_error_norms'].append(sf_err_norm)
+        self.log_dict['value_errors'].append(v_td_err)
+
+    def _optimize_batch(self, done) -> None:
+        """
+        Deferred reward, SF and value learning over the K pending
+        transitions, each as a single matrix-matrix update. The errors are
+        computed with the parameters at the start of the batch (the value
+        uses the updated SF and reward parameters, as in the per-step case)
+        """
+        cur_phi, cur_act, rew, nex_phi, nex_act, nex_done = \
+            self._pop_pending_transitions(done)
+
+        # Reward learning
+        if not self.use_true_reward_params:
+            rew_errs = rew - (cur_phi @ self.Wr)  # (K, )
+            self.Wr = self.Wr + (self.reward_lr * (rew_errs @ cur_phi))
+            self.log_dict['reward_errors'].append(rew_errs)
+
+        # SF learning (terminal next features are zero)
+        if not self.use_true_sf_params:
+            nex_sf = self._compute_batch_sf(nex_phi, nex_act)
+            cur_sf = self._compute_batch_sf(cur_phi, cur_act)
+            sf_td_errs = cur_phi + (self.lamb * self.gamma * nex_sf) - cur_sf
+            for act in np.unique(cur_act):
+                rows = (cur_act == act)
+                self.Ws[act] += self.sf_lr * (
+                    np.transpose(cur_phi[rows]) @ sf_td_errs[rows]
+                )
+            self.log_dict['sf_error_norms'].append(
+                np.linalg.norm(sf_td_errs, axis=1)
+            )
+
+        # Value learning, traces after each of the transitions (K, d)
+        Zv_stack = np.empty_like(cur_phi)
+        for k in range(len(rew)):
+            self.Zv = (self.eta_trace * self.gamma) * self.Zv + cur_phi[k]
+            Zv_stack[k] = self.Zv
+
+        nex_sf = self._compute_batch_sf(nex_phi, nex_act)
+        slr_V = nex_sf @ (((1 - self.lamb) * self.Wv) + (self.lamb * self.Wr))
+        v_td_errs = rew + (self.gamma * slr_V) - (cur_phi @ self.Wv)
+        self.Wv += self.value_lr * (v_td_errs @ Zv_stack)
+        self.log_dict['value_errors'].append(v_td_errs)
+
+    def _compute_batch_sf(self, phis, acts) -> np.ndarray:
+        """
+        Helper for the batched updates, successor features of a batch of
+        (dense) features with one action each
+        :param phis: (K, d) features
+        :param acts: (K, ) actions
+        :return: (K, d) successor features
+        """
+        sfs = np.empty_like(phis)
+        for act in np.unique(acts):
+            rows = (acts == act)
+            sfs[rows] = phis[rows] @ self.Ws[act]
+        return sfs
+
     def _optimize_reward_fn(self) -> None:
         # NOTE: We learn apping phi_t -> r_{t+1} to properly account for all
         #       rewards, even though theory says we map phi_t -> r_t.
@@ -110,14 +238,26 @@ class SFReturnAgent(BaseLinearAgent):
         cur_rew = self.traj['r'][t_idx]
 
         # Update reward function
-        rew_err = cur_rew - np.dot(cur_phi, self.Wr)
-        d_Wr = rew_err * cur_phi
-        self.Wr = self.Wr + (self.reward_lr * d_Wr)
+        if self.sparse_phi:
+            phi_idxs, phi_vals = cur_phi
+            rew_err = cur_rew - np.dot(phi_vals, self.Wr[phi_idxs])
+            self.Wr[phi_idxs] += self.reward_lr * (rew_err * phi_vals)
+        else:
+            rew_err = cur_rew - np.dot(cur_phi, self.Wr)
+            d_Wr = rew_err * cur_phi
+            self.Wr = self.Wr + (self.reward_lr * d_Wr)
 
         # (Log) Reward error
         self.log_dict['reward_errors'].append(rew_err)
 
     def _optimize_successor_features(self, done) -> None:
+        if self.sf_rank is not None:
+            self._optimize_successor_factors(done)
+            return
+        if self.sparse_phi:
+            self._optimize_successor_features_sparse(done)
+            return
+
         # Get current experience tuple (S, A)
         t_idx = len(self.traj['r']) - 1
         cur_phi = self.traj['phi'][t_idx]
@@ -147,6 +287,80 @@ class SFReturnAgent(BaseLinearAgent):
             np.linalg.norm(sf_td_err)
         )
 
+    def _optimize_successor_features_sparse(self, done) -> None:
+        """
+        Same SF TD update as above, but with sparse (indices, values)
+        features so only the active rows of Ws[cur_act] are read and written
+        """
+        t_idx = len(self.traj['r']) - 1
+        cur_idxs, cur_vals = self.traj['phi'][t_idx]
+        cur_act = self.traj['a'][t_idx]
+
+        # Next SF, phi_{t+1}^T Ws[a'] only over the active rows
+        if not done:
+            nex_act = self.traj['a'][t_idx + 1]
+            nex_idxs, nex_vals = self.traj['phi'][t_idx + 1]
+            nex_sf = nex_vals @ self.Ws[nex_act, nex_idxs, :]  # (d, )
+        else:
+            nex_sf = 0.0
+
+        # Compute SF TD errors
+        cur_sf = cur_vals @ self.Ws[cur_act, cur_idxs, :]  # (d, )
+        sf_td_err = (self.lamb * self.gamma * nex_sf) - cur_sf  # (d, )
+        sf_td_err[cur_idxs] += cur_vals
+
+        # Update only the active rows, outer(cur_phi, sf_td_err)
+        self.Ws[cur_act, cur_idxs, :] += self.sf_lr * np.outer(
+            cur_vals, sf_td_err
+        )
+
+        # (Log) Norm of the SF error vector
+        self.log_dict['sf_error_norms'].append(
+            np.linalg.norm(sf_td_err)
+        )
+
+    def _optimize_successor_factors(self, done) -> None:
+        """
+        SF TD update for the low-rank parameters Ws[a] = I + U[a] @ V[a].T,
+        taking the semi-gradient step w.r.t. each of the factors. Costs
+        O(d * k) per step (O(nnz * k + d * k) with sparse features)
+        """
+        t_idx = len(self.traj['r']) - 1
+        cur_phi = self.traj['phi'][t_idx]
+        cur_act = self.traj['a'][t_idx]
+
+        if not done:
+            nex_act = self.traj['a'][t_idx + 1]
+            nex_phi = self.traj['phi'][t_idx + 1]
+            nex_sf = self.compute_successor_features(nex_phi, nex_act)
+        else:
+            nex_sf = 0.0
+
+        # Compute SF TD errors
+        cur_phi_U = self._project_phi_U(cur_phi, cur_act)  # (k, )
+        cur_sf = self.compute_successor_features(cur_phi, cur_act)
+        if self.sparse_phi:
+            sf_td_err = (self.lamb * self.gamma * nex_sf) - cur_sf
+            sf_td_err[cur_phi[0]] += cur_phi[1]
+        else:
+            sf_td_err = cur_phi + (self.lamb * self.gamma * nex_sf) - cur_sf
+
+        # Update factors, dU = outer(phi, V^T err), dV = outer(err, U^T phi)
+        err_V = sf_td_err @ self.Ws_V[cur_act]  # (k, )
+        if self.sparse_phi:
+            phi_idxs, phi_vals = cur_phi
+            self.Ws_U[cur_act, phi_idxs, :] += self.sf_lr * np.outer(
+                phi_vals, err_V
+            )
+        else:
+            self.Ws_U[cur_act] += self.sf_lr * np.outer(cur_phi, err_V)
+        self.Ws_V[cur_act] += self.sf_lr * np.outer(sf_td_err, cur_phi_U)
+
+        # (Log) Norm of the SF error vector
+        self.log_dict['sf_error_norms'].append(
+            np.linalg.norm(sf_td_err)
+        )
+
     def _optimize_value_fn(self, done) -> None:
         # ==
         # Unpack current feature
@@ -156,8 +370,12 @@ class SFReturnAgent(BaseLinearAgent):
 
         # ==
         # Update trace (not action conditioned)
-        grad_Vw = cur_phi
-        self.Zv = (self.eta_trace * self.gamma) * self.Zv + grad_Vw
+        if self.sparse_phi:
+            self.Zv *= (self.eta_trace * self.gamma)
+            self.Zv[cur_phi[0]] += cur_phi[1]
+        else:
+            grad_Vw = cur_phi
+            self.Zv = (self.eta_trace * self.gamma) * self.Zv + grad_Vw
 
         # ==
         # Compute the lambda SF value function return
@@ -172,7 +390,7 @@ class SFReturnAgent(BaseLinearAgent):
 
         # ==
         # TD learning using the SLR value
-        cur_v = cur_phi.T @ self.Wv
+        cur_v = self.compute_Q_value(cur_phi, 0)
         v_target = nex_rew + (self.gamma * slr_V)
         v_td_err = v_target - cur_v
         del_Wv = v_td_err * self.Zv
@@ -183,6 +401,60 @@ class SFReturnAgent(BaseLinearAgent):
         # (Log) Value function error
         self.log_dict['value_errors'].append(v_td_err)
 
+    def expected_update(self, model: dict) -> None:
+        """
+        Expected reward, SF and value updates under the on-policy state
+        distribution D, applied in the same order as the online updates:
+            Wr += reward_lr * Phi^T D (R - Phi Wr)
+            Ws += sf_lr * Phi^T D (Phi + gamma lamb P Psi - Psi)
+            Wv += value_lr * Phi^T D (I - gamma eta P)^-1 delta
+        where Psi = Phi Ws and delta are the expected TD errors of the
+        lambda successor return target
+        :param model: dict from mdp_utils.get_expected_update_model
+        """
+        trace_op = self._expected_trace_operator(
+            model, self.gamma * self.eta_trace
+        )  # (d, N)
+        phiMat, d_vec = model['Phi'], model['d']
+        d_phiMat = d_vec[:, None] * phiMat  # (N, d)
+
+        # Reward learning
+        if not self.use_true_reward_params:
+            rew_errs = model['R'] - (phiMat @ self.Wr)  # (N, )
+            self.Wr += self.reward_lr * (rew_errs @ d_phiMat)
+            self.log_dict['reward_errors'].append(
+                self._weighted_rms(rew_errs, d_vec)
+            )
+
+        # SF learning
+        if not self.use_true_sf_params:
+            sf_mat = self.compute_successor_features(phiMat, 0)  # (N, d)
+            sf_td_errs = phiMat + (
+                (self.lamb * self.gamma) * (model['P'] @ sf_mat)
+            ) - sf_mat
+            if self.sf_rank is None:
+                self.Ws[0] += self.sf_lr * (d_phiMat.T @ sf_td_errs)
+            else:
+                # Semi-gradient w.r.t. each of the factors, as online
+                phi_U = phiMat @ self.Ws_U[0]  # (N, k)
+                d_errs = d_vec[:, None] * sf_td_errs  # (N, d)
+                self.Ws_U[0] += self.sf_lr * (
+                    phiMat.T @ (d_errs @ self.Ws_V[0])
+                )
+                self.Ws_V[0] += self.sf_lr * (d_errs.T @ phi_U)
+            self.log_dict['sf_error_norms'].append(
+                self._weighted_rms(sf_td_errs, d_vec)
+            )
+
+        # Value learning
+        v_vec = phiMat @ self.Wv  # (N, )
+        slr_V = self.predict_successor_returns(phiMat, 0)  # (N, )
+        v_td_errs = model['R'] + self.gamma * (model['P'] @ slr_V) - v_vec
+        self.Wv += self.value_lr * (trace_op @ v_td_errs)
+        self.log_dict['value_errors'].append(
+            self._weighted_rms(v_td_errs, d_vec)
+        )
+
     def compute_successor_return(self, phi, act) -> float:
         """
         Helper function, compute the value estimate using the lambda
@@ -193,12 +465,74 @@ class SFReturnAgent(BaseLinearAgent):
         """
         # TODO this function name should be a value fn not a return
 
-        sf_T = phi.T @ self.Ws[act]  # (d, )  # NOTE transpose?
+        sf_T = self.compute_successor_features(phi, act)  # (d, )
         slr_V = sf_T @ (
                 ((1-self.lamb) * self.Wv) + (self.lamb * self.Wr)
         )
         return slr_V
 
+    def predict_successor_returns(self, Phi, act=0) -> np.ndarray:
+        """
+        Lambda successor return value estimates of a matrix of features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values
+        """
+        sf_mat = self.compute_successor_features(Phi, act)  # (N, d)
+        return sf_mat @ (
+                ((1-self.lamb) * self.Wv) + (self.lamb * self.Wr)
+        )
+
+    def compute_successor_features(self, phi, act) -> np.ndarray:
+        """
+        Helper function, compute the successor features phi^T Ws[act]
+        :param phi: state feature (d, ), or (N, d) matrix of features
+        :param act: action
+        :return: (d, ) successor features, or (N, d) for matrix input
+        """
+        if self.sf_rank is not None:
+            phi_U = self._project_phi_U(phi, act)  # (k, ) or (N, k)
+            sf = phi_U @ np.transpose(self.Ws_V[act])
+            if self._is_sparse(phi):
+                phi_idxs, phi_vals = self._to_sparse_phi(phi)
+                sf[phi_idxs] += phi_vals
+                return sf
+            return phi + sf
+
+        if self._is_sparse(phi):
+            phi_idxs, phi_vals = self._to_sparse_phi(phi)
+            return phi_vals @ self.Ws[act, phi_idxs, :]
+        return phi @ self.Ws[act]
+
+    def _project_phi_U(self, phi, act) -> np.ndarray:
+        """
+        Helper for the low-rank SFs, project the features onto U[act]
+        :return: (k, ) or (N, k) for matrix input
+        """
+        if self._is_sparse(phi):
+            phi_idxs, phi_vals = self._to_sparse_phi(phi)
+            return phi_vals @ self.Ws_U[act, phi_idxs, :]
+        return phi @ self.Ws_U[act]
+
+    def _is_sparse(self, phi) -> bool:
+        # Matrices of features (e.g. for evaluation) are always dense
+        return self.sparse_phi and (isinstance(phi, tuple) or phi.ndim == 1)
+
+    def set_sf_params(self, act, sf_mat) -> None:
+        """
+        Set the SF parameters of an action, e.g. to the solved parameters
+        when using use_true_sf_params. Low-rank parameters are set to the
+        best rank-k approximation.
+        :param act: action
+        :param sf_mat: (d, d) SF parameter matrix
+        """
+        if self.sf_rank is None:
+            self.Ws[act] = sf_mat
+        else:
+            self.Ws_U[act], self.Ws_V[act] = self._factorize_sf_param(
+                sf_mat, self.sf_rank
+            )
+
     def compute_Q_value(self, phi, act) -> float:
         """
         Helper function, compute the value given a state feature and action
@@ -207,8 +541,21 @@ class SFReturnAgent(BaseLinearAgent):
 
         :return: value, Q(phi, act)
         """
+        if self.sparse_phi:
+            phi_idxs, phi_vals = self._to_sparse_phi(phi)
+            return np.dot(phi_vals, self.Wv[phi_idxs])
         return np.dot(phi, self.Wv)
 
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features, using just the value
+        function parameters
+        :param Phi: (N, d) matrix of features
+        :param act: action (unused, V function)
+        :return: (N, ) values
+        """
+        return Phi @ self.Wv
+
     def _select_action(self, phi) -> int:
         # TODO: change this for control (set policy here)
         # for now only does policy eval 
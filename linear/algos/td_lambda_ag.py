@@ -11,6 +11,8 @@ from gym import spaces
 import numpy as np
 
 from algos.base import BaseLinearAgent
+from utils.running_stats import RunningStats
+import utils.jit_kernels as jk
 
 
 class SarsaLambdaAgent(BaseLinearAgent):
@@ -19,22 +21,35 @@ class SarsaLambdaAgent(BaseLinearAgent):
                  gamma=0.9,
                  lamb=0.8,
                  lr=0.1,
+                 use_jit=False,
+                 update_batch_size=1,
+                 dtype=np.float64,
                  seed=0):
 
         """
         TODO define arguments
+        :param use_jit: use the (numba) compiled update kernel if available
+        :param update_batch_size: apply the updates every K transitions in
+                                  a single batched update (K=1 per step)
         """
-        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr, seed=seed)
+        super().__init__(feature_dim, num_actions, gamma=gamma, lr=lr,
+                         dtype=dtype, update_batch_size=update_batch_size,
+                         seed=seed)
         self.lamb = lamb
+        self.use_jit = jk.check_use_jit(use_jit)
+        if self.use_jit and self.update_batch_size > 1:
+            raise ValueError('use_jit requires update_batch_size=1')
 
         # Initialize Q function and trace
-        self.Wq = np.zeros((self.feature_dim, self.num_actions))  # TODO check correct
-        self.Z = np.zeros((self.feature_dim, self.num_actions))  # TODO check correct
+        self.Wq = np.zeros((self.feature_dim, self.num_actions),
+                           dtype=self.dtype)  # TODO check correct
+        self.Z = np.zeros((self.feature_dim, self.num_actions),
+                          dtype=self.dtype)  # TODO check correct
 
     def begin_episode(self, phi):
         super().begin_episode(phi)
         self.log_dict = {
-            'value_errors': [],
+            'value_errors': RunningStats(),
         }
 
         # Reset eligibility trace
@@ -52,6 +67,16 @@ class SarsaLambdaAgent(BaseLinearAgent):
         # Get new action based on state
         new_act = self._select_action(phi_t)
 
+        # (Optional) compiled update, straight from the current (S, A)
+        if self.use_jit:
+            td_err = jk.sarsa_lambda_step(
+                self.Wq, self.Z, self.cur_phi, self.cur_act, phi_t, new_act,
+                reward, done, self.gamma, self.lamb, self.lr
+            )
+            self.log_dict['value_errors'].append(td_err)
+            self.cur_phi, self.cur_act = phi_t, new_act
+            return new_act
+
         # Save trajectory
         if not done:
             self.traj['phi'].append(phi_t)
@@ -61,7 +86,11 @@ class SarsaLambdaAgent(BaseLinearAgent):
         # ==
         # Learning (via trace)
         if len(self.traj['r']) > 0:
-            self._optimize_model(done)
+            if self.update_batch_size > 1:
+                if self._add_pending_transition(done):
+                    self._optimize_model_batch(done)
+            else:
+                self._optimize_model(done)
 
         return new_act
 
@@ -75,7 +104,7 @@ class SarsaLambdaAgent(BaseLinearAgent):
 
         # ==
         # Update trace
-        act_vec = np.zeros(self.num_actions)
+        act_vec = np.zeros(self.num_actions, dtype=self.dtype)
         act_vec[cur_act] = 1.0
         grad_Qw = np.outer(cur_phi, act_vec)
 
@@ -102,6 +131,61 @@ class SarsaLambdaAgent(BaseLinearAgent):
         self.log_dict['value_errors'].append(td_err)
         pass
 
+    def _optimize_model_batch(self, done) -> None:
+        """
+        Deferred update over the K pending transitions: the TD errors are
+        all computed with the parameters at the start of the batch, and
+        applied in a single update sum_k td_err_k * Z_k
+        """
+        cur_phi, cur_act, rew, nex_phi, nex_act, nex_done = \
+            self._pop_pending_transitions(done)
+        n_range = np.arange(len(rew))
+
+        # ==
+        # Traces after each of the transitions, (K, d, |A|)
+        Z_stack = np.empty((len(rew), self.feature_dim, self.num_actions),
+                           dtype=self.dtype)
+        for k in n_range:
+            self.Z *= (self.lamb * self.gamma)
+            self.Z[:, cur_act[k]] += cur_phi[k]
+            Z_stack[k] = self.Z
+
+        # ==
+        # Batched TD errors (terminal next features are zero)
+        cur_q = (cur_phi @ self.Wq)[n_range, cur_act]
+        nex_q = (nex_phi @ self.Wq)[n_range, nex_act]
+        td_errs = rew + (self.gamma * nex_q) - cur_q
+
+        # Parameter updates
+        del_Wq = np.tensordot(td_errs, Z_stack, axes=1)
+        self.Wq = self.Wq + (self.lr * del_Wq)
+
+        # ==
+        # Logging losses
+        self.log_dict['value_errors'].append(td_errs)
+
+    def expected_update(self, model: dict) -> None:
+        """
+        Expected TD(lambda) update under the on-policy state distribution:
+        Wq += lr * Phi^T D (I - gamma lamb P)^-1 (R + gamma P V - V)
+        :param model: dict from mdp_utils.get_expected_update_model
+        """
+        trace_op = self._expected_trace_operator(
+            model, self.gamma * self.lamb
+        )  # (d, N)
+
+        # Expected TD errors of all states
+        v_vec = model['Phi'] @ self.Wq[:, 0]  # (N, )
+        td_errs = model['R'] + self.gamma * (model['P'] @ v_vec) - v_vec
+
+        self.Wq[:, 0] += self.lr * (trace_op @ td_errs)
+
+        # ==
+        # Logging losses
+        self.log_dict['value_errors'].append(
+            self._weighted_rms(td_errs, model['d'])
+        )
+
     def compute_Q_value(self, phi, act) -> float:
         """
         Helper function, compute the value given a state feature and action
@@ -113,6 +197,15 @@ class SarsaLambdaAgent(BaseLinearAgent):
         q_vec = phi @ self.Wq
         return q_vec[act]
 
+    def predict_values(self, Phi, act=0) -> np.ndarray:
+        """
+        Value estimates of a matrix of features
+        :param Phi: (N, d) matrix of features
+        :param act: action
+        :return: (N, ) values, Q(Phi, act)
+        """
+        return Phi @ self.Wq[:, act]
+
     def _select_action(self, phi) -> int:
         """
         Selects action
@@ -0,0 +1,111 @@
+# =============================================================================
+# Vectorized (batched) interface of the linear environments, simulating B
+# independent copies of an environment at once. The copies are integer
+# state arrays sharing the environment's rng, and are stepped with array
+# operations instead of per-copy python branches.
+#
+# Also holds the precomputed (read-only) feature table of an environment,
+# so that step / reset return views of its rows instead of allocating a
+# new feature vector per step.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+# Max size of the precomputed feature tables, larger environments compute
+# their features on each call instead
+FEATURE_TABLE_MAX_BYTES = 2 ** 28
+
+
+class BatchEnvMixin(object):
+    """
+    Adds reset_batch / step_batch to an environment. The environment
+    implements the vectorized versions of its dynamics:
+        _start_states(n): (n, ) initial states, as in reset
+        _transition_batch(states): (next_states, rewards, dones) of one
+                                   step from each of the (B, ) states
+        _rewards_batch(states, next_states, rng): (B, ) rewards of the
+                                   transitions, drawn with rng (used by
+                                   _transition_batch and sample_rewards)
+        states_2_features(states): (B, d) features of the (B, ) states
+    """
+
+    # (B, ) integer states of the copies
+    states = None
+    # Row i of get_transition_matrix is state number
+    # i + matrix_state_offset
+    matrix_state_offset = 1
+    # (num_states, d) read-only feature table, row s holds the features of
+    # state number s (None if too large)
+    phi_table = None
+
+    def _init_feature_table(self, num_states: int) -> None:
+        """
+        Precompute the feature table of state numbers 0, ..., num_states-1,
+        once the attributes used by states_2_features are set
+        """
+        self.phi_table = None
+        table_bytes = num_states * self.feature_dim * self.dtype.itemsize
+        if table_bytes > FEATURE_TABLE_MAX_BYTES:
+            return
+
+        phi_table = self.states_2_features(np.arange(num_states))
+        phi_table.flags.writeable = False
+        self.phi_table = phi_table
+
+    def reset_batch(self, batch_size: int) -> np.ndarray:
+        """
+        Reset all copies
+        :param batch_size: number of copies B
+        :return: (B, d) initial features
+        """
+        self.states = self._start_states(batch_size)
+        return self.states_2_features(self.states)
+
+    def step_batch(self, actions=None):
+        """
+        Step all copies. Copies whose episode terminated are reset
+        (auto-reset), and their features are those of the new initial
+        state, so the done copies can directly begin the next episode.
+        :param actions: (B, ) actions (unused, single action)
+        :return: phi (B, d) features, reward (B, ) rewards, done (B, )
+                 boolean mask, info dict
+        """
+        self.states, rewards, dones = self._transition_batch(self.states)
+
+        if np.any(dones):
+            self.states[dones] = self._start_states(int(np.sum(dones)))
+
+        phi = self.states_2_features(self.states)
+        return phi, rewards, dones, {}
+
+    def sample_rewards(self, s_idxs, nex_s_idxs, rng) -> np.ndarray:
+        """
+        Draw the rewards of transitions between rows of the transition
+        matrix (e.g. sampled by the MarkovChainSampler), with the same
+        reward noise as stepping the environment
+        :param s_idxs: (B, ) row indices of the exited states
+        :param nex_s_idxs: (B, ) row indices of the next states, -1 where
+                           the episode terminated
+        :param rng: np.random.Generator
+        :return: (B, ) rewards
+        """
+        offset = self.matrix_state_offset
+        nex_states = np.where(nex_s_idxs >= 0, nex_s_idxs + offset, -1)
+        return self._rewards_batch(s_idxs + offset, nex_states, rng)
+
+    def _one_hot_features(self, s_idxs) -> np.ndarray:
+        """
+        Helper for the tabular environments, one-hot (B, d) features of
+        the state indices, all zero where out of range (e.g. terminal)
+        :param s_idxs: (B, ) integer feature indices
+        """
+        phi = np.zeros((len(s_idxs), self.feature_dim), dtype=self.dtype)
+        valid = (0 <= s_idxs) & (s_idxs < self.feature_dim)
+        phi[np.flatnonzero(valid), s_idxs[valid]] = 1.0
+        return phi
+
+
+if __name__ == "__main__":
+    print('hello world')
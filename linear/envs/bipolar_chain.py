@@ -8,8 +8,11 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from utils.sparse_utils import build_matrix, identity_matrix
 
-class BipolarChainEnv(gym.Env):
+
+class BipolarChainEnv(BatchEnvMixin, gym.Env):
     """
     Description: Bipolar Chain Environment with rich unsmooth rewards
 
@@ -18,7 +21,7 @@ class BipolarChainEnv(gym.Env):
     Action:
     """
 
-    def __init__(self, n_states=20, reward_magnitude=10, seed=0):
+    def __init__(self, n_states=20, reward_magnitude=10, dtype=np.float64, seed=0):
         """
         TODO write docs
         """
@@ -31,13 +34,18 @@ class BipolarChainEnv(gym.Env):
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)  # dummy
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(self.n_states + 2)
+
         self.state = 1  # first state
 
     def step(self, action):
@@ -94,9 +102,12 @@ class BipolarChainEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+
         # Simple tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Set index
         s_idx = state - 1
@@ -105,6 +116,45 @@ class BipolarChainEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        return self._one_hot_features(np.asarray(states) - 1)
+
+    def _start_states(self, n) -> np.ndarray:
+        return np.ones(n, dtype=int)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step, see step and get_current_reward
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        dones = states >= self.n_states
+        next_states = np.where(states <= self.n_states, states + 1, states)
+        rewards = self._rewards_batch(states, next_states, self.rng)
+
+        return next_states, rewards, dones
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized (deterministic) get_current_reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator (unused)
+        :return: (B, ) rewards
+        """
+        is_odd = (states % 2) == 1
+        rewards = np.where(is_odd, 1.0, -1.0) * self.reward_magnitude
+        rewards[states > self.n_states] = 0.0  # post-termination
+        return rewards
+
     def reset(self):
         self.state = 1
         phi = self.state_2_features(self.state)
@@ -118,19 +168,26 @@ class BipolarChainEnv(gym.Env):
         """
         return self.n_states
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.n_states) np matrix
         """
-        # Transition matrix
-        P_trans = np.zeros((self.n_states, self.n_states))
+        # Deterministic step to the next state
+        s_idxs = np.arange(self.n_states - 1)
 
-        # Fill
-        for s_idx in range(self.n_states-1):
-            P_trans[s_idx, s_idx+1] = 1.0
+        return build_matrix(s_idxs, (s_idxs + 1), 1.0,
+                            (self.n_states, self.n_states), sparse=sparse)
 
-        return P_trans
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states, ) vector
+        """
+        mu_0 = np.zeros(self.n_states)
+        mu_0[0] = 1.0
+        return mu_0
 
     def get_reward_function(self):
         """
@@ -147,12 +204,16 @@ class BipolarChainEnv(gym.Env):
 
         return R_fn
 
-    def get_feature_matrix(self):
+    def get_feature_matrix(self, sparse=False):
         """
         Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.feature_dim) np matrix
         """
-        phi_mat = np.identity(self.n_states)
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[1:(self.n_states + 1)].astype(np.float64)
+
+        phi_mat = identity_matrix(self.n_states, sparse=sparse)
 
         return phi_mat
 
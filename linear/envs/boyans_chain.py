@@ -8,8 +8,11 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from utils.sparse_utils import build_matrix
 
-class BoyansChainEnv(gym.Env):
+
+class BoyansChainEnv(BatchEnvMixin, gym.Env):
     """
     Description:
 
@@ -18,20 +21,25 @@ class BoyansChainEnv(gym.Env):
     Action:
     """
 
-    def __init__(self, seed=0):
+    def __init__(self, dtype=np.float64, seed=0):
         self.n_states = 13
         self.feature_dim = 4
 
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.array([0.0, 0.0, 0.0, 0.0]),
             high=np.array([1.0, 1.0, 1.0, 1.0]),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(self.n_states + 1)
+
         self.state = self.n_states
 
     def step(self, action):
@@ -68,6 +76,9 @@ class BoyansChainEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+
         # ==
         # Generate state indeces
         s_i = (13 - state) // 4
@@ -76,7 +87,7 @@ class BoyansChainEnv(gym.Env):
         # ==
         # Generate features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         if s_i < 3:
             phi[s_i] = 1 - (0.25 * s_j)
@@ -87,11 +98,66 @@ class BoyansChainEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        s_i = (13 - np.asarray(states)) // 4
+        s_j = (13 - np.asarray(states)) % 4
+
+        phi = np.zeros((len(s_i), self.feature_dim), dtype=self.dtype)
+
+        # Interpolate between the two neighbouring features
+        rows = np.flatnonzero(s_i < 3)
+        phi[rows, s_i[rows]] = 1 - (0.25 * s_j[rows])
+        phi[rows, s_i[rows] + 1] = (0.25 * s_j[rows])
+
+        rows = np.flatnonzero((s_i >= 3) & (s_j == 0))
+        phi[rows, s_i[rows]] = 1.0
+
+        return phi
+
+    # The transition matrix includes the terminal state 0
+    matrix_state_offset = 0
+
+    def _start_states(self, n) -> np.ndarray:
+        return np.full(n, self.n_states)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        s_deltas = np.where(states > 2,
+                            1 + self.rng.integers(2, size=len(states)),
+                            np.minimum(states, 1))  # -1 / -2, or -1 / 0
+        next_states = states - s_deltas
+        rewards = self._rewards_batch(states, next_states, self.rng)
+
+        return next_states, rewards, states <= 1
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized (deterministic) reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator (unused)
+        :return: (B, ) rewards
+        """
+        rewards = np.full(len(states), -3.0)
+        rewards[states == 2] = -2.0
+        rewards[states <= 1] = 0.0  # incl. the terminal state (row 0)
+        return rewards
+
     def reset(self):
         self.state = self.n_states
-        phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
-        phi[0] = 1.0
+        phi = self.state_2_features(self.state)
 
         return phi
 
@@ -103,21 +169,30 @@ class BoyansChainEnv(gym.Env):
         """
         return self.n_states + 1
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states+1, self.n_states+1) np matrix
         """
-        # Transition matrix
+        # Step one or two states down the chain w.p. 0.5
         p_n_states = self.n_states + 1
-        P_trans = np.zeros((p_n_states, p_n_states))
-        for i in reversed(range(3, p_n_states)):
-            P_trans[i, i - 1] = 0.5
-            P_trans[i, i - 2] = 0.5
-        P_trans[2, 1] = 1.0
-        P_trans[1, 0] = 1.0
+        s_idxs = np.arange(3, p_n_states)
+        rows = np.concatenate([s_idxs, s_idxs, [2, 1]])
+        cols = np.concatenate([(s_idxs - 1), (s_idxs - 2), [1, 0]])
+        vals = np.concatenate([np.full(2 * len(s_idxs), 0.5), [1.0, 1.0]])
 
-        return P_trans
+        return build_matrix(rows, cols, vals, (p_n_states, p_n_states),
+                            sparse=sparse)
+
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states+1, ) vector
+        """
+        mu_0 = np.zeros(self.n_states + 1)
+        mu_0[self.n_states] = 1.0
+        return mu_0
 
     def get_reward_function(self):
         """
@@ -135,6 +210,25 @@ class BoyansChainEnv(gym.Env):
 
         return R_fn
 
+    def get_feature_matrix(self, sparse=False):
+        """
+        Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
+        :return: (self.n_states+1, self.feature_dim) np matrix
+        """
+        p_n_states = self.n_states + 1
+        if self.phi_table is not None:
+            phi_mat = self.phi_table[:p_n_states].astype(np.float64)
+        else:
+            phi_mat = self.states_2_features(
+                np.arange(p_n_states)).astype(np.float64)
+        if not sparse:
+            return phi_mat
+
+        rows, cols = np.nonzero(phi_mat)
+        return build_matrix(rows, cols, phi_mat[rows, cols],
+                            (p_n_states, self.feature_dim), sparse=True)
+
     def solve_linear_reward_parameters(self):
         """
         Helper function to solve for the best-fit linear parameters for the
@@ -7,8 +7,13 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from envs.tree_features import tree_feature_dim, tree_feature_entries, \
+    tree_features
+from utils.sparse_utils import build_matrix, identity_matrix
 
-class FanInBinaryTreeEnv(gym.Env):
+
+class FanInBinaryTreeEnv(BatchEnvMixin, gym.Env):
     """
     Description: Fan in binary tree environment. Reward only at the end.
     State space: NOTE tabular for now
@@ -18,28 +23,39 @@ class FanInBinaryTreeEnv(gym.Env):
     def __init__(self,
                  depth=5,
                  terminal_reward_stdev=1.0,
+                 feature_type='tabular',
+                 dtype=np.float64,
                  seed=0):
         """
         TODO write docs
+        :param feature_type: 'tabular', or the compact 'depth' / 'path'
+                             features of envs.tree_features, e.g. for
+                             large depths (with the sparse env matrices)
         """
 
         # Attributes
         self.depth = depth
         self.n_states = 2**self.depth - 1
-        self.feature_dim = self.n_states  # tabular
+        self.feature_type = feature_type
+        self.feature_dim = tree_feature_dim(self.depth, self.feature_type)
 
         self.terminal_reward_stdev = terminal_reward_stdev
 
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)  # dummy
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(2 ** self.depth)
+
         self.state = (2**self.depth - 1
                       - self.rng.integers(2**(self.depth-1)))
 
@@ -84,9 +100,14 @@ class FanInBinaryTreeEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+        if self.feature_type != 'tabular':
+            return self.states_2_features(np.array([state]))[0]
+
         # Simple tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Set index
         s_idx = state - 1
@@ -95,6 +116,49 @@ class FanInBinaryTreeEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        if self.feature_type != 'tabular':
+            return tree_features(states, self.depth, self.feature_type,
+                                 dtype=self.dtype)
+        return self._one_hot_features(np.asarray(states) - 1)
+
+    def _start_states(self, n) -> np.ndarray:
+        # Uniform over the leaf nodes
+        return 2 ** self.depth - 1 - self.rng.integers(2 ** (self.depth - 1),
+                                                       size=n)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step, see step and get_current_reward
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        at_root = states <= 1  # root or absorbing nodes
+        next_states = np.where(at_root, 0, states // 2)
+        rewards = self._rewards_batch(states, next_states, self.rng)
+
+        return next_states, rewards, at_root
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized get_current_reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator
+        :return: (B, ) rewards
+        """
+        noise = rng.normal(scale=self.terminal_reward_stdev,
+                           size=len(states))
+        return np.where(states == 1, 1.0 + noise, 0.0)
+
     def reset(self):
         self.state = (2 ** self.depth - 1
                       - self.rng.integers(2 ** (self.depth - 1)))
@@ -109,19 +173,26 @@ class FanInBinaryTreeEnv(gym.Env):
         """
         return self.n_states
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.n_states) np matrix
         """
-        # Transition matrix
-        P_trans = np.zeros((self.n_states, self.n_states))
+        # Non-root states transition to their parent
+        s_nums = np.arange(2, (2**self.depth))
 
-        # Fill
-        for s_num in range(2, (2**self.depth)):
-            P_trans[(s_num - 1), (s_num//2 - 1)] = 1.0
+        return build_matrix((s_nums - 1), (s_nums//2 - 1), 1.0,
+                            (self.n_states, self.n_states), sparse=sparse)
 
-        return P_trans
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states, ) vector
+        """
+        mu_0 = np.zeros(self.n_states)
+        mu_0[(2 ** (self.depth - 1) - 1):] = 1.0 / (2 ** (self.depth - 1))
+        return mu_0  # uniform over the leaf nodes
 
     def get_reward_function(self):
         """
@@ -134,17 +205,25 @@ class FanInBinaryTreeEnv(gym.Env):
 
         return R_fn
 
-    def get_feature_matrix(self):
+    def get_feature_matrix(self, sparse=False):
         """
         Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.feature_dim) np matrix
         """
-        phi_mat = np.empty((self.n_states, self.feature_dim))
-        for s_idx in range(self.n_states):
-            cur_phi = self.state_2_features((s_idx+1))
-            phi_mat[s_idx, :] = cur_phi
-
-        return phi_mat
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[1:(self.n_states + 1)].astype(np.float64)
+
+        if self.feature_type != 'tabular':
+            rows, cols, vals = tree_feature_entries(
+                np.arange(1, self.n_states + 1), self.depth, self.feature_type
+            )
+            return build_matrix(rows, cols, vals,
+                                (self.n_states, self.feature_dim),
+                                sparse=sparse)
+
+        # Tabular features
+        return identity_matrix(self.n_states, sparse=sparse)
 
     def render(self):
         pass
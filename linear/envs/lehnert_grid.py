@@ -23,6 +23,7 @@ class LehnertGridWorldEnv(gym.Env):
                  episode_max_length=200,
                  start_switch_freq=None,
                  goal_switch_freq=None,
+                 dtype=np.float64,
                  seed=0):
         """
         TODO write docs
@@ -39,10 +40,11 @@ class LehnertGridWorldEnv(gym.Env):
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=4)
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
@@ -164,7 +166,7 @@ class LehnertGridWorldEnv(gym.Env):
 
         # Tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
         phi[s_idx] = 1.0
         # TODO: set last state to have zero feature?
         return phi
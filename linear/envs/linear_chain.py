@@ -7,8 +7,11 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from utils.sparse_utils import build_matrix, identity_matrix
 
-class SimpleLinearChainEnv(gym.Env):
+
+class SimpleLinearChainEnv(BatchEnvMixin, gym.Env):
     """
     Description: Simple linear chain with reward at the end.
     State space: NOTE tabular for now
@@ -19,6 +22,7 @@ class SimpleLinearChainEnv(gym.Env):
                  n_states=7,
                  skip_prob=0.1,
                  terminal_reward_stdev=0.1,
+                 dtype=np.float64,
                  seed=0):
         """
         TODO write docs
@@ -35,13 +39,18 @@ class SimpleLinearChainEnv(gym.Env):
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)  # dummy
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(self.n_states + 2)
+
         self.state = 1
 
     def step(self, action):
@@ -93,9 +102,12 @@ class SimpleLinearChainEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+
         # Simple tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Set index
         s_idx = state - 1
@@ -104,6 +116,51 @@ class SimpleLinearChainEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        return self._one_hot_features(np.asarray(states) - 1)
+
+    def _start_states(self, n) -> np.ndarray:
+        return np.ones(n, dtype=int)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step, see step and get_current_reward
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        # Advance by one, or skip a state w.p. skip_prob
+        s_deltas = 1 + (self.rng.random(len(states)) < self.skip_prob)
+        dones = states >= self.n_states  # end and absorbing nodes
+        next_states = np.where(
+            states == (self.n_states - 1), self.n_states, states + s_deltas
+        )
+        next_states = np.where(states == self.n_states, states + 1,
+                               np.where(dones, states, next_states))
+        rewards = self._rewards_batch(states, next_states, self.rng)
+
+        return next_states, rewards, dones
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized get_current_reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator
+        :return: (B, ) rewards
+        """
+        noise = rng.normal(scale=self.terminal_reward_stdev,
+                           size=len(states))
+        return np.where(states == self.n_states,
+                        self.terminal_reward_mean + noise, 0.0)
+
     def reset(self):
         self.state = 1
         phi = self.state_2_features(self.state)
@@ -117,26 +174,35 @@ class SimpleLinearChainEnv(gym.Env):
         """
         return self.n_states
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.n_states) np matrix
         """
-        # Transition matrix
-        P_trans = np.zeros((self.n_states, self.n_states))
-
-        # Fill
-        for i in range(self.n_states):
-            s_num = i + 1
-            if s_num >= self.n_states:
-                pass
-            elif s_num == (self.n_states - 1):
-                P_trans[i, i+1] = 1.0
-            else:
-                P_trans[i, i+1] = 1 - self.skip_prob
-                P_trans[i, i+2] = self.skip_prob
-
-        return P_trans
+        # Step to the next state, or skip one ahead with skip_prob (the
+        # second to last state always steps to the last)
+        step_idxs = np.arange(self.n_states - 1)
+        skip_idxs = np.arange(self.n_states - 2)
+        step_probs = np.full(len(step_idxs), (1 - self.skip_prob))
+        step_probs[-1] = 1.0
+
+        rows = np.concatenate([step_idxs, skip_idxs])
+        cols = np.concatenate([(step_idxs + 1), (skip_idxs + 2)])
+        vals = np.concatenate([step_probs,
+                               np.full(len(skip_idxs), self.skip_prob)])
+
+        return build_matrix(rows, cols, vals, (self.n_states, self.n_states),
+                            sparse=sparse)
+
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states, ) vector
+        """
+        mu_0 = np.zeros(self.n_states)
+        mu_0[0] = 1.0
+        return mu_0
 
     def get_reward_function(self):
         """
@@ -149,17 +215,17 @@ class SimpleLinearChainEnv(gym.Env):
 
         return R_fn
 
-    def get_feature_matrix(self):
+    def get_feature_matrix(self, sparse=False):
         """
         Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.feature_dim) np matrix
         """
-        phi_mat = np.empty((self.n_states, self.feature_dim))
-        for s_idx in range(self.n_states):
-            cur_phi = self.state_2_features((s_idx + 1))
-            phi_mat[s_idx, :] = cur_phi
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[1:(self.n_states + 1)].astype(np.float64)
 
-        return phi_mat
+        # Tabular features
+        return identity_matrix(self.n_states, sparse=sparse)
 
     def render(self):
         pass
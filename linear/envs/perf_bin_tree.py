@@ -8,8 +8,13 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from envs.tree_features import tree_feature_dim, tree_feature_entries, \
+    tree_features
+from utils.sparse_utils import build_matrix, identity_matrix
 
-class PerfBinaryTreeEnv(gym.Env):
+
+class PerfBinaryTreeEnv(BatchEnvMixin, gym.Env):
     """
     Description: Perfect Binary Tree environment, reward only at the leaf
                  nodes.
@@ -22,27 +27,38 @@ class PerfBinaryTreeEnv(gym.Env):
     def __init__(self,
                  depth=5,
                  terminal_high_rew_prob=0.2,
+                 feature_type='tabular',
+                 dtype=np.float64,
                  seed=0):
         """
         TODO write docs
+        :param feature_type: 'tabular', or the compact 'depth' / 'path'
+                             features of envs.tree_features, e.g. for
+                             large depths (with the sparse env matrices)
         """
 
         # Attributes
         self.depth = depth
         self.n_states = (2**self.depth) - 1
-        self.feature_dim = self.n_states  # tabular
+        self.feature_type = feature_type
+        self.feature_dim = tree_feature_dim(self.depth, self.feature_type)
         self.terminal_high_rew_prob = terminal_high_rew_prob
 
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)  # dummy
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table((2 ** self.depth) + 1)
+
         self.state = 1  # ancestor node
 
     def step(self, action):
@@ -103,9 +119,14 @@ class PerfBinaryTreeEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+        if self.feature_type != 'tabular':
+            return self.states_2_features(np.array([state]))[0]
+
         # Simple tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Set index
         s_idx = state - 1
@@ -114,6 +135,55 @@ class PerfBinaryTreeEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        if self.feature_type != 'tabular':
+            return tree_features(states, self.depth, self.feature_type,
+                                 dtype=self.dtype)
+        return self._one_hot_features(np.asarray(states) - 1)
+
+    def _start_states(self, n) -> np.ndarray:
+        return np.ones(n, dtype=int)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step, see step and get_current_reward
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        is_leaf = states >= 2 ** (self.depth - 1)  # leaf or absorbing nodes
+
+        # Random child node, or absorbing
+        child_idxs = self.rng.integers(2, size=len(states))
+        next_states = np.where(is_leaf, 2 ** self.depth,
+                               (states * 2) + child_idxs)
+        rewards = self._rewards_batch(states, next_states, self.rng)
+
+        return next_states, rewards, is_leaf
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized get_current_reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator
+        :return: (B, ) rewards
+        """
+        leaf_start = 2 ** (self.depth - 1)
+        is_leaf = (states >= leaf_start) & (states < 2 ** self.depth)
+
+        # High reward w.p. terminal_high_rew_prob at the leaf nodes
+        is_hig = rng.random(len(states)) < self.terminal_high_rew_prob
+        return np.where(is_leaf & is_hig, states - leaf_start,
+                        0).astype(np.float64)
+
     def reset(self):
         self.state = 1
         phi = self.state_2_features(self.state)
@@ -127,24 +197,29 @@ class PerfBinaryTreeEnv(gym.Env):
         """
         return self.n_states
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.n_states) np matrix
         """
-        # Transition matrix
-        P_trans = np.zeros((self.n_states, self.n_states))
+        # Non-leaf states transition to either child
+        s_nums = np.arange(1, (2**(self.depth-1)))
+        s_idxs = s_nums - 1
+        rows = np.concatenate([s_idxs, s_idxs])
+        cols = np.concatenate([(s_nums*2 - 1), (s_nums*2)])
 
-        # Fill
-        for s_num in range(1, (2**(self.depth-1))):
-            s_idx = s_num - 1
-            child1_idx = s_num*2 - 1
-            child2_idx = s_num*2
+        return build_matrix(rows, cols, 0.5, (self.n_states, self.n_states),
+                            sparse=sparse)
 
-            P_trans[s_idx, child1_idx] = 0.5
-            P_trans[s_idx, child2_idx] = 0.5
-
-        return P_trans
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states, ) vector
+        """
+        mu_0 = np.zeros(self.n_states)
+        mu_0[0] = 1.0  # root node
+        return mu_0
 
     def get_reward_function(self):
         """
@@ -155,28 +230,33 @@ class PerfBinaryTreeEnv(gym.Env):
         R_fn = np.zeros(self.n_states)
         p = self.terminal_high_rew_prob
 
-        # Iterate over leaf states
-        for l_state in range((2**(self.depth-1)), (2 ** self.depth)):
-            cur_hig_rew = l_state - (2**(self.depth-1))
-            cur_low_rew = 0.0
-            cur_avg_rew = (p * cur_hig_rew) + ((1-p) * cur_low_rew)
-
-            sIdx = l_state - 1
-            R_fn[sIdx] = cur_avg_rew
+        # Leaf states
+        l_states = np.arange((2**(self.depth-1)), (2 ** self.depth))
+        hig_rews = l_states - (2**(self.depth-1))
+        low_rew = 0.0
+        R_fn[l_states - 1] = (p * hig_rews) + ((1-p) * low_rew)
 
         return R_fn
 
-    def get_feature_matrix(self):
+    def get_feature_matrix(self, sparse=False):
         """
         Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states, self.feature_dim) np matrix
         """
-        phi_mat = np.empty((self.n_states, self.feature_dim))
-        for s_idx in range(self.n_states):
-            cur_phi = self.state_2_features((s_idx+1))
-            phi_mat[s_idx, :] = cur_phi
-
-        return phi_mat
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[1:(self.n_states + 1)].astype(np.float64)
+
+        if self.feature_type != 'tabular':
+            rows, cols, vals = tree_feature_entries(
+                np.arange(1, self.n_states + 1), self.depth, self.feature_type
+            )
+            return build_matrix(rows, cols, vals,
+                                (self.n_states, self.feature_dim),
+                                sparse=sparse)
+
+        # Tabular features
+        return identity_matrix(self.n_states, sparse=sparse)
 
     def solve_linear_reward_parameters(self):
         """
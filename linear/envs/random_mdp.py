@@ -11,8 +11,11 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from utils.sparse_utils import identity_matrix, sp_sparse
 
-class RandomMDPEnv(gym.Env):
+
+class RandomMDPEnv(BatchEnvMixin, gym.Env):
     """
     Description: MDP with randomly sampled transitions and rewards
 
@@ -21,21 +24,25 @@ class RandomMDPEnv(gym.Env):
     Action:
     """
 
-    def __init__(self, n_states=13, seed=0):
+    def __init__(self, n_states=13, dtype=np.float64, seed=0):
         self.n_states = n_states
         self.feature_dim = n_states
 
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.array([0.0]*self.feature_dim),
             high=np.array([1.0]*self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
 
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(self.n_states)
+
         # ==
         # Construct MDP
 
@@ -50,6 +57,9 @@ class RandomMDPEnv(gym.Env):
         # TODO: should it be sparse or rich here?
         self.rVec = self.rng.standard_normal(size=self.n_states)
 
+        # (Batched) transition CDFs, computed when first needed
+        self._offset_cdf = None
+
         # ==
         # Sample initial state uniformaly
         self.state = self.rng.choice(self.n_states)
@@ -81,13 +91,68 @@ class RandomMDPEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
-        phi = np.zeros(self.n_states)
+        if self.phi_table is not None:
+            return self.phi_table[state]
+
+        phi = np.zeros(self.n_states, dtype=self.dtype)
         phi[state] = 1.0
 
         # TODO: make not one-hot?
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        return self._one_hot_features(np.asarray(states) - 0)
+
+    # States are numbered as the rows of the transition matrix
+    matrix_state_offset = 0
+
+    def _start_states(self, n) -> np.ndarray:
+        return self.rng.integers(self.n_states, size=n)
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step, next states by inverse CDF sampling of all copies
+        with a single search over the row-offset CDFs of the transitions
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        if self._offset_cdf is None:
+            # Row i of the CDF is offset by i, so all rows are one sorted
+            # array and row i occupies [i, i + 1]
+            self._offset_cdf = np.ravel(
+                np.cumsum(self.pMat, axis=1) +
+                np.arange(self.n_states)[:, None]
+            )
+
+        u = self.rng.random(len(states))
+        next_states = np.searchsorted(self._offset_cdf, states + u,
+                                      side='right') - (states * self.n_states)
+        next_states = np.clip(next_states, 0, self.n_states - 1)
+
+        rewards = self._rewards_batch(states, next_states, self.rng)
+        dones = np.zeros(len(states), dtype=bool)  # continuing
+
+        return next_states, rewards, dones
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized (deterministic) state exit reward
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states (unused)
+        :param rng: np.random.Generator (unused)
+        :return: (B, ) rewards
+        """
+        return self.rVec[states]
+
     def reset(self):
         self.state = self.rng.choice(self.n_states)
         phi = self.state_2_features(self.state)
@@ -102,14 +167,25 @@ class RandomMDPEnv(gym.Env):
         """
         return self.n_states
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env
+        :param sparse: if True return a scipy.sparse CSR matrix (NOTE: the
+                       sampled transitions are dense)
         :return: (self.n_states, self.n_states) np matrix
         """
         # Transition matrix
+        if sparse:
+            return sp_sparse.csr_matrix(self.pMat)
         return self.pMat
 
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states, ) vector
+        """
+        return np.ones(self.n_states) / self.n_states
+
     def get_reward_function(self):
         """
         Helper function to get the (tabular) reward function for each state
@@ -119,6 +195,18 @@ class RandomMDPEnv(gym.Env):
         """
         return self.rVec
 
+    def get_feature_matrix(self, sparse=False):
+        """
+        Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
+        :return: (self.n_states, self.feature_dim) np matrix
+        """
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[:self.n_states].astype(np.float64)
+
+        # Tabular features
+        return identity_matrix(self.n_states, sparse=sparse)
+
     def solve_linear_reward_parameters(self):
         """
         NOTE DEC 20 not sure if valid. Recheck.
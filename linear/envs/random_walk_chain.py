@@ -7,8 +7,11 @@
 import gym
 import numpy as np
 
+from envs.batch_env import BatchEnvMixin
+from utils.sparse_utils import build_matrix, identity_matrix
 
-class RandomWalkChainEnv(gym.Env):
+
+class RandomWalkChainEnv(BatchEnvMixin, gym.Env):
     """
     Description:
 
@@ -17,20 +20,25 @@ class RandomWalkChainEnv(gym.Env):
     Action:
     """
 
-    def __init__(self, seed=0):
+    def __init__(self, dtype=np.float64, seed=0):
         self.n_states = 20  # NOTE fix for now and set to 20 for 19-state chain
         self.feature_dim = self.n_states-1  # NOTE: using tabular representation
 
         # ==
         # Initialize spaces
         self.action_space = gym.spaces.Discrete(n=1)
+        self.dtype = np.dtype(dtype)  # feature dtype
         self.observation_space = gym.spaces.Box(
             low=np.zeros(self.feature_dim),
             high=np.ones(self.feature_dim),
-            dtype=np.float
+            dtype=self.dtype
         )
 
         self.rng = np.random.default_rng(seed)
+
+        # Read-only feature table, returned (as views) by step and reset
+        self._init_feature_table(self.n_states + 1)
+
         self.state = int(self.n_states / 2)  # start in middle
 
     def step(self, action):
@@ -63,9 +71,12 @@ class RandomWalkChainEnv(gym.Env):
         :param state: integer index
         :return: feature vector
         """
+        if self.phi_table is not None:
+            return self.phi_table[state]
+
         # Simple tabular features
         phi = np.zeros((self.feature_dim,),
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Set index
         s_idx = state - 1
@@ -74,6 +85,49 @@ class RandomWalkChainEnv(gym.Env):
 
         return phi
 
+    def states_2_features(self, states) -> np.ndarray:
+        """
+        Vectorized state_2_features
+        :param states: (B, ) integer states
+        :return: (B, self.feature_dim) features
+        """
+        if self.phi_table is not None:
+            return self.phi_table[states]
+
+        return self._one_hot_features(np.asarray(states) - 1)
+
+    def _start_states(self, n) -> np.ndarray:
+        return np.full(n, int(self.n_states / 2))  # start in middle
+
+    def _transition_batch(self, states):
+        """
+        Vectorized step
+        :param states: (B, ) integer states
+        :return: next_states (B, ), rewards (B, ), dones (B, )
+        """
+        in_chain = (1 <= states) & (states < self.n_states)
+        trans = (2 * self.rng.integers(2, size=len(states))) - 1  # -1 / +1
+        next_states = np.where(in_chain, states + trans, states)
+
+        rewards = self._rewards_batch(states, next_states, self.rng)
+        dones = ~((1 <= next_states) & (next_states < self.n_states))
+
+        return next_states, rewards, dones
+
+    def _rewards_batch(self, states, next_states, rng):
+        """
+        Vectorized reward, 1 for exiting the right end of the chain
+        :param states: (B, ) integer states
+        :param next_states: (B, ) next states, -1 if terminated (from
+                            sample_rewards), i.e. the right end if exiting
+                            the last state of the chain
+        :param rng: np.random.Generator (unused)
+        :return: (B, ) rewards
+        """
+        exits_right = ((next_states == self.n_states) |
+                       ((next_states < 0) & (states == self.n_states - 1)))
+        return exits_right.astype(np.float64)
+
     def reset(self):
         self.state = int(self.n_states / 2)  # start in middle
 
@@ -88,22 +142,30 @@ class RandomWalkChainEnv(gym.Env):
         """
         return self.n_states - 1
 
-    def get_transition_matrix(self):
+    def get_transition_matrix(self, sparse=False):
         """
         Helper function to return the transition matrix for this env,
         excluding terminal states
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states-1, self.n_states-1) np matrix
         """
-        # Transition matrix
+        # Move left or right w.p. 0.5, the end states can also terminate
         p_n_states = self.n_states - 1
-        P_trans = np.zeros((p_n_states, p_n_states))
-        for i in range(1, (p_n_states-1)):
-            P_trans[i, i + 1] = 0.5
-            P_trans[i, i - 1] = 0.5
-        P_trans[0, 1] = 0.5
-        P_trans[p_n_states-1, p_n_states-2] = 0.5
+        s_idxs = np.arange(p_n_states)
+        rows = np.concatenate([s_idxs[:-1], s_idxs[1:]])  # right, left
+        cols = np.concatenate([s_idxs[1:], s_idxs[:-1]])
 
-        return P_trans
+        return build_matrix(rows, cols, 0.5, (p_n_states, p_n_states),
+                            sparse=sparse)
+
+    def get_start_distribution(self):
+        """
+        Helper function to get the distribution of the initial state
+        :return: (self.n_states-1, ) vector
+        """
+        mu_0 = np.zeros(self.n_states - 1)
+        mu_0[int(self.n_states / 2) - 1] = 1.0  # middle
+        return mu_0
 
     def get_reward_function(self):
         """
@@ -120,14 +182,18 @@ class RandomWalkChainEnv(gym.Env):
 
         return R_fn
 
-    def get_feature_matrix(self):
+    def get_feature_matrix(self, sparse=False):
         """
         Helper function to get the state to features mapping matrix
+        :param sparse: if True return a scipy.sparse CSR matrix
         :return: (self.n_states-1, self.feature_dim) np matrix
         """
+        if (self.phi_table is not None) and (not sparse):
+            return self.phi_table[1:self.n_states].astype(np.float64)
+
         # Tabular features
         p_n_states = self.n_states - 1
-        return np.identity(p_n_states)
+        return identity_matrix(p_n_states, sparse=sparse)
 
     def render(self):
         pass
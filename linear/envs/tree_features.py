@@ -0,0 +1,96 @@
+# =============================================================================
+# Compact (non-tabular) features of the binary tree environments, whose
+# nodes are numbered as a heap: root 1, children of s are 2s and 2s + 1.
+# With d = O(depth) instead of d = 2^depth - 1, these allow trees of depth
+# 20+ (together with the sparse environment matrices).
+#
+#   'tabular': one-hot node, d = 2^depth - 1
+#   'depth':   one-hot node depth, d = depth
+#   'path':    one-hot node depth followed by the branch (0 / 1) taken at
+#              each level from the root, d = 2 * depth - 1. Unique per node,
+#              and the leaf index is linear in the branch features.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+FEATURE_TYPES = ('tabular', 'depth', 'path')
+
+
+def tree_feature_dim(depth: int, feature_type: str) -> int:
+    """
+    :return: feature dimension d of a tree of the given depth
+    """
+    if feature_type == 'tabular':
+        return (2 ** depth) - 1
+    if feature_type == 'depth':
+        return depth
+    if feature_type == 'path':
+        return (2 * depth) - 1
+    raise ValueError(f'Unknown feature_type: {feature_type}, expected one '
+                     f'of {FEATURE_TYPES}')
+
+
+def node_depths(s_nums) -> np.ndarray:
+    """
+    :param s_nums: (B, ) heap node numbers (>= 1)
+    :return: (B, ) depth of each node, the root is at depth 0
+    """
+    return np.frexp(np.asarray(s_nums, dtype=np.float64))[1] - 1
+
+
+def tree_feature_entries(s_nums, depth: int, feature_type: str):
+    """
+    Non-zero entries of the features of a batch of (valid) tree nodes
+    :param s_nums: (B, ) heap node numbers, 1 <= s < 2^depth
+    :param depth: depth of the tree
+    :param feature_type: one of FEATURE_TYPES
+    :return: rows (nnz, ) indices into s_nums, cols (nnz, ) feature
+             indices and vals (nnz, ) feature values
+    """
+    s_nums = np.asarray(s_nums, dtype=np.int64)
+    rows = np.arange(len(s_nums))
+
+    if feature_type == 'tabular':
+        return rows, s_nums - 1, np.ones(len(s_nums))
+
+    # One-hot depth
+    k_vec = node_depths(s_nums)
+    row_list, col_list = [rows], [k_vec]
+
+    if feature_type == 'path':
+        # Branch taken at level i is bit (k - i) of the node number
+        for i in range(1, depth):
+            shift = np.maximum(k_vec - i, 0)
+            is_set = (k_vec >= i) & (((s_nums >> shift) & 1) == 1)
+            row_list.append(rows[is_set])
+            col_list.append(np.full(np.sum(is_set), depth + i - 1))
+    elif feature_type != 'depth':
+        tree_feature_dim(depth, feature_type)  # raises
+
+    rows = np.concatenate(row_list)
+    return rows, np.concatenate(col_list), np.ones(len(rows))
+
+
+def tree_features(s_nums, depth: int, feature_type: str,
+                  dtype=np.float64) -> np.ndarray:
+    """
+    Dense features of a batch of tree nodes, zero for the nodes outside
+    the tree (e.g. absorbing states)
+    :param s_nums: (B, ) heap node numbers
+    :return: (B, d) features
+    """
+    s_nums = np.asarray(s_nums)
+    valid = np.flatnonzero((1 <= s_nums) & (s_nums < (2 ** depth)))
+    rows, cols, vals = tree_feature_entries(s_nums[valid], depth,
+                                            feature_type)
+
+    phi = np.zeros((len(s_nums), tree_feature_dim(depth, feature_type)),
+                   dtype=dtype)
+    phi[valid[rows], cols] = vals
+    return phi
+
+
+if __name__ == "__main__":
+    print('hello world')
@@ -23,11 +23,12 @@ from algos.q_learning import QAgent
 from algos.sf_q_learning import LambdaSFQAgent
 from envs.lehnert_grid import LehnertGridWorldEnv
 import utils.mdp_utils as mut
+from utils.eval_schedule import get_eval_episodes
 
 LogTupStruct = namedtuple(
     'LogTupStruct',
     field_names=['num_episodes', 'envCls_name', 'env_kwargs', 'agentCls_name',
-                 'seed', 'episode_idx', 'total_steps', 'cumulative_reward',
+                 'seed', 'dtype', 'episode_idx', 'total_steps', 'cumulative_reward',
                  'gamma']
 )
 
@@ -59,6 +60,7 @@ def _initialize_environment(cfg: DictConfig) -> object:
     envCls = globals()[cfg.env.cls_string]  # hacky
     env_kwargs = OmegaConf.to_container(cfg.env.kwargs)  # convert to dict
     env_kwargs['seed'] = cfg.training.seed  # add global seed
+    env_kwargs['dtype'] = cfg.training.dtype
     environment = envCls(**env_kwargs)
     return environment
 
@@ -76,6 +78,7 @@ def _initialize_agent(cfg: DictConfig, environment) -> object:
     agentCls = globals()[cfg.agent.cls_string]  # hacky class init
     agent_kwargs = OmegaConf.to_container(cfg.agent.kwargs)  # convert to dict
     agent_kwargs['seed'] = cfg.training.seed
+    agent_kwargs['dtype'] = cfg.training.dtype
 
     # Initialize and return
     agent = agentCls(
@@ -102,28 +105,23 @@ def _extract_agent_log_dict(agent):
     if ag_dict is None:
         return log_dict
 
-    # Compute
-    # TODO: add more conditions to check if the list is empty?
+    # Compute (from the agents' streaming RunningStats)
     if 'value_errors' in ag_dict:
-        avg_value_loss = np.average(
-            np.square(ag_dict['value_errors'])
-        )
+        avg_value_loss = ag_dict['value_errors'].mean_sq
         log_dict['value_loss_avg'] = avg_value_loss
 
     if 'reward_errors' in ag_dict:
-        avg_rew_loss = np.average(
-            np.square(ag_dict['reward_errors'])
-        )
+        avg_rew_loss = ag_dict['reward_errors'].mean_sq
         log_dict['reward_loss_avg'] = avg_rew_loss
 
     if 'sf_error_norms' in ag_dict:
         # NOTE: it is already the norm so positive
-        avg_sf_loss = np.average(ag_dict['sf_error_norms'])
+        avg_sf_loss = ag_dict['sf_error_norms'].mean
         log_dict['sf_loss_avg'] = avg_sf_loss
 
     if 'et_error_norms' in ag_dict:
         # NOTE: it is already the norm so positive
-        avg_et_loss = np.average(ag_dict['et_error_norms'])
+        avg_et_loss = ag_dict['et_error_norms'].mean
         log_dict['et_loss_avg'] = avg_et_loss
 
     return log_dict
@@ -142,6 +140,7 @@ def write_post_episode_log(cfg: DictConfig,
         'env_kwargs': str(cfg.env.kwargs),
         'agentCls_name': cfg.agent.cls_string,
         'seed': cfg.training.seed,  # global seed
+        'dtype': cfg.training.dtype,
         'episode_idx': episode_dict['episode_idx'],  # episode-specific
         'total_steps': episode_dict['total_steps'],
         'cumulative_reward': episode_dict['cumulative_reward']
@@ -208,15 +207,11 @@ def post_episode_updates(cfg: DictConfig, episode_idx: int,
             if 'Wr' in attr_str_list:
                 agent.Wr = agent.rng.uniform(
                     0.0, 1e-5, size=agent.feature_dim
-                )
+                ).astype(agent.dtype, copy=False)
 
             # Optionally reset SF parameters
             if 'Ws' in attr_str_list:
-                agent.Ws = np.zeros(
-                    (agent.num_actions, agent.feature_dim, agent.feature_dim)
-                )
-                ws_idxs = np.arange(agent.feature_dim)
-                agent.Ws[:, ws_idxs, ws_idxs] = 1.0
+                agent.reset_sf_params()
 
 
 def run_single_linear_experiment(cfg: DictConfig,
@@ -229,6 +224,11 @@ def run_single_linear_experiment(cfg: DictConfig,
     # Initialize agent
     agent = _initialize_agent(cfg, environment)
 
+    # Episodes after which to log
+    eval_episodes = get_eval_episodes(cfg.training.eval_schedule,
+                                      cfg.training.num_episodes)
+    write_header = True
+
     # ==================================================
     # Run experiment
     for episode_idx in range(cfg.training.num_episodes):
@@ -251,19 +251,20 @@ def run_single_linear_experiment(cfg: DictConfig,
 
             if done:
                 # ==
-                # Log
-                post_epis_dict = {
-                    'episode_idx': episode_idx,
-                    'total_steps': steps,
-                    'cumulative_reward': cumulative_reward,
-                }
-                write_header = True if episode_idx == 0 else False
-                write_post_episode_log(cfg=cfg,
-                                       episode_dict=post_epis_dict,
-                                       environment=environment,
-                                       agent=agent,
-                                       logger=logger,
-                                       write_header=write_header)
+                # (Scheduled) log
+                if episode_idx in eval_episodes:
+                    post_epis_dict = {
+                        'episode_idx': episode_idx,
+                        'total_steps': steps,
+                        'cumulative_reward': cumulative_reward,
+                    }
+                    write_post_episode_log(cfg=cfg,
+                                           episode_dict=post_epis_dict,
+                                           environment=environment,
+                                           agent=agent,
+                                           logger=logger,
+                                           write_header=write_header)
+                    write_header = False  # only before the first log
 
                 # ==
                 # (Potential resets)
@@ -299,7 +300,7 @@ def save_checkpoint(cfg: DictConfig, agent, episode_idx):
     # Save key parameters of agents
     ckpt_dict['agent'] = {}
 
-    attri_list = ['Wq', 'Wz', 'Wr', 'Ws', 'Wv']
+    attri_list = ['Wq', 'Wz', 'Wz_diag', 'Wz_U', 'Wz_V', 'Wr', 'Ws', 'Ws_U', 'Ws_V', 'Wv']
     for att_str in attri_list:
         if hasattr(agent, att_str):
             cur_att = getattr(agent, att_str)
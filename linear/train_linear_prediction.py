@@ -19,15 +19,23 @@ from omegaconf import DictConfig, OmegaConf
 import numpy as np
 
 from algos.sf_return_ag import SFReturnAgent
+from algos.lstd_sf_ag import LSTDSFReturnAgent
 from algos.td_lambda_ag import SarsaLambdaAgent
 from algos.expt_trace_ag import ExpectedTraceAgent
+from algos.batched_ag import BatchedSFReturnAgent, BatchedSarsaLambdaAgent, \
+    BatchedExpectedTraceAgent
 from envs.bipolar_chain import BipolarChainEnv
 from envs.boyans_chain import BoyansChainEnv
 from envs.random_walk_chain import RandomWalkChainEnv
 from envs.perf_bin_tree import PerfBinaryTreeEnv
 from envs.fan_in_bin_tree import FanInBinaryTreeEnv
 from envs.linear_chain import SimpleLinearChainEnv
+from envs.random_mdp import RandomMDPEnv
 import utils.mdp_utils as mut
+import utils.gt_cache as gtc
+from utils.eval_schedule import get_eval_episodes
+from utils.markov_sampler import MarkovChainSampler, iter_episodes
+import utils.traj_dataset as tds
 
 
 @dataclasses.dataclass
@@ -37,6 +45,7 @@ class LogTupStruct:
     env_kwargs: str = None
     agentCls_name: str = None
     seed: int = None
+    dtype: str = None
     gamma: float = None
     lr: float = None
     sf_lr: float = None
@@ -45,6 +54,14 @@ class LogTupStruct:
     eta_trace: float = None
     use_true_reward_params: bool = None
     use_true_sf_params: bool = None
+    sparse_phi: bool = None
+    sf_rank: int = None
+    use_jit: bool = None
+    update_batch_size: int = None
+    ridge_reg: float = None
+    eta: float = None
+    et_param: str = None
+    et_rank: int = None
     episode_idx: int = None  # episodic-specific logs
     total_steps: int = None
     cumulative_reward: float = None
@@ -85,6 +102,7 @@ def _initialize_environment(cfg: DictConfig) -> object:
     envCls = globals()[cfg.env.cls_string]  # hacky
     env_kwargs = OmegaConf.to_container(cfg.env.kwargs)  # convert to dict
     env_kwargs['seed'] = cfg.training.seed  # add global seed
+    env_kwargs['dtype'] = cfg.training.dtype
     environment = envCls(**env_kwargs)
     return environment
 
@@ -102,6 +120,7 @@ def _initialize_agent(cfg: DictConfig, environment) -> object:
     agentCls = globals()[cfg.agent.cls_string]  # hacky class init
     agent_kwargs = OmegaConf.to_container(cfg.agent.kwargs)  # convert to dict
     agent_kwargs['seed'] = cfg.training.seed
+    agent_kwargs['dtype'] = cfg.training.dtype
 
     # Initialize and return
     agent = agentCls(
@@ -118,21 +137,130 @@ def _initialize_agent(cfg: DictConfig, environment) -> object:
         if cfg.agent.kwargs.use_true_sf_params:
             linear_sf_param = mut.solve_linear_sf_param(
                 env=environment,
-                gamma=(cfg.agent.kwargs.gamma * cfg.agent.kwargs.lamb)
+                gamma=(cfg.agent.kwargs.gamma * cfg.agent.kwargs.lamb),
+                dtype=agent.dtype
             )
-            agent.Ws[0] = linear_sf_param
+            agent.set_sf_params(0, linear_sf_param)
     # Initialize solved reward parameters
     if hasattr(cfg.agent.kwargs, 'use_true_reward_params'):
         if cfg.agent.kwargs.use_true_reward_params:
             linear_reward_param = mut.solve_linear_reward_param(
                 env=environment,
+                dtype=agent.dtype
             )
             agent.Wr = linear_reward_param
 
     return agent
 
 
-def _pre_compute(cfg: DictConfig, environment, agent) -> dict:
+def _initialize_batched_agent(cfg: DictConfig, environment) -> object:
+    """
+    Helper method to initialize a batched (multi-seed) agent object, with
+    one seed per entry of cfg.training.seed
+    :param cfg: hydra config dict, with a list of seeds
+    :param environment: gym environment (one of the copies)
+    :return: batched agent object
+    """
+    agentCls = globals()['Batched' + cfg.agent.cls_string]  # hacky
+    agent_kwargs = OmegaConf.to_container(cfg.agent.kwargs)
+    agent_kwargs['seeds'] = list(cfg.training.seed)
+    agent_kwargs['dtype'] = cfg.training.dtype
+
+    agent = agentCls(
+        feature_dim=environment.observation_space.shape[0],
+        num_actions=environment.action_space.n,
+        **agent_kwargs
+    )
+
+    # (Optional) Initialize true reward and SF functions for all seeds
+    if hasattr(cfg.agent.kwargs, 'use_true_sf_params'):
+        if cfg.agent.kwargs.use_true_sf_params:
+            linear_sf_param = mut.solve_linear_sf_param(
+                env=environment,
+                gamma=(cfg.agent.kwargs.gamma * cfg.agent.kwargs.lamb),
+                dtype=agent.dtype
+            )
+            agent.Ws[:, 0] = linear_sf_param
+    if hasattr(cfg.agent.kwargs, 'use_true_reward_params'):
+        if cfg.agent.kwargs.use_true_reward_params:
+            linear_reward_param = mut.solve_linear_reward_param(
+                env=environment,
+                dtype=agent.dtype
+            )
+            agent.Wr[:] = linear_reward_param
+
+    return agent
+
+
+def _env_matrix_key(environment) -> tuple:
+    """
+    Helper to identify an environment by its (dense) matrices, so that the
+    configs of a sweep over identical environments (e.g. seeds which do
+    not change the environment) share their ground truth
+    """
+    return (mut.array_fingerprint(environment.get_transition_matrix()),
+            mut.array_fingerprint(environment.get_reward_function()),
+            mut.array_fingerprint(environment.get_feature_matrix()))
+
+
+def _solve_sweep_ground_truth(cfg_list) -> dict:
+    """
+    Solve the (dense) ground truth of all the configs of a sweep at once.
+    The configs over the same environment share one solve_discount_batch
+    call over all of their distinct gamma (value functions) and one over
+    all of their gamma * lamb (successor features), instead of solving per
+    config. The configs with sparse_solve solve their own.
+
+    :param cfg_list: list of the sweep's configs, with a list of seeds
+                     for the batched configs
+    :return: dict of (env key, 'value_fn' / 'sf_mat', discount) -> solution
+    """
+    # Environments and their discounts
+    env_keys = {}  # env config -> env key
+    env_dict = {}  # env key -> (environment, value gammas, sf gammas)
+    for cfg in cfg_list:
+        if cfg.training.sparse_solve:
+            continue
+        c = OmegaConf.to_container(cfg)
+        seeds = c['training']['seed']
+        if not isinstance(seeds, list):
+            seeds = [seeds]
+        elif c['training']['batch_env']:
+            seeds = seeds[:1]  # all copies use the first seed's env
+
+        for s in seeds:
+            env_cfg = json.dumps([c['env'], s, c['training']['dtype']],
+                                 sort_keys=True)
+            if env_cfg not in env_keys:
+                c['training']['seed'] = s
+                environment = _initialize_environment(OmegaConf.create(c))
+                env_keys[env_cfg] = _env_matrix_key(environment)
+                if env_keys[env_cfg] not in env_dict:
+                    env_dict[env_keys[env_cfg]] = (environment, set(), set())
+
+            gamma = cfg.agent.kwargs.gamma
+            env_dict[env_keys[env_cfg]][1].add(gamma)
+            env_dict[env_keys[env_cfg]][2].add(gamma * cfg.agent.kwargs.lamb)
+
+    # One batched solve per environment
+    sweep_gt = {}
+    for env_key, (environment, v_gammas, sf_gammas) in env_dict.items():
+        v_gammas, sf_gammas = sorted(v_gammas), sorted(sf_gammas)
+        v_fns = mut.solve_discount_batch(environment, v_gammas,
+                                         value_fn=True,
+                                         sf_mat=False)['value_fn']
+        sf_mats = mut.solve_discount_batch(environment, sf_gammas,
+                                           value_fn=False,
+                                           sf_mat=True)['sf_mat']
+        for g, v_fn in zip(v_gammas, v_fns):
+            sweep_gt[(env_key, 'value_fn', g)] = v_fn
+        for g, sf_mat in zip(sf_gammas, sf_mats):
+            sweep_gt[(env_key, 'sf_mat', g)] = sf_mat
+
+    return sweep_gt
+
+
+def _pre_compute(cfg: DictConfig, environment, agent, sweep_gt=None) -> dict:
     """
     Pre-compute things before training begins, largely used to solve for the
     true value function to measure RMSE.
@@ -140,17 +268,58 @@ def _pre_compute(cfg: DictConfig, environment, agent) -> dict:
     :param cfg: config dict
     :param environment: enviornment object
     :param agent: agent object
+    :param sweep_gt: (optional) ground truth of the whole sweep, from
+                     _solve_sweep_ground_truth
     :return: dict of pre-computed items
     """
-    # Compute the true MDP value function
-    true_v_fn = mut.solve_value_fn(environment,
-                                   cfg.agent.kwargs.gamma)
-
-    # Compute the true MDP successor feature
-    true_sf_mat = mut.solve_successor_feature(
-        environment,
-        (cfg.agent.kwargs.gamma * cfg.agent.kwargs.lamb)
-    )
+    # Compute the true MDP value function and successor feature
+    gamma = cfg.agent.kwargs.gamma
+    sf_gamma = gamma * cfg.agent.kwargs.lamb
+    out_names = ['true_value_vec', 'true_sf_mat', 'true_reward_vec']
+
+    # (Optional) re-use the ground truth from the on-disk cache. The env
+    # matrices are part of the key in case they depend on the seed.
+    cache_dir = cfg.training.gt_cache_dir
+    if cache_dir is not None:
+        sparse = cfg.training.sparse_solve
+        key_dict = {
+            'envCls_name': cfg.env.cls_string,
+            'env_kwargs': OmegaConf.to_container(cfg.env.kwargs),
+            'gamma': gamma,
+            'sf_gamma': sf_gamma,
+            'sparse_solve': sparse,
+            'transition_matrix': mut.array_fingerprint(
+                environment.get_transition_matrix(sparse=sparse)
+            ),
+            'reward_vec': mut.array_fingerprint(
+                environment.get_reward_function()
+            ),
+            'feature_matrix': mut.array_fingerprint(
+                environment.get_feature_matrix(sparse=sparse)
+            ),
+        }
+        cache_key = gtc.cache_key(key_dict)
+        out_dict = gtc.load_arrays(cache_dir, cache_key, out_names)
+        if out_dict is not None:
+            return out_dict
+
+    if cfg.training.sparse_solve:
+        # Large environments, sparse matrices and solvers
+        true_v_fn = mut.solve_value_fn(environment, gamma, sparse=True)
+        true_sf_mat = mut.solve_successor_feature(environment, sf_gamma,
+                                                  sparse=True)
+    elif sweep_gt is not None:
+        # This config's slice of the batched solves of the sweep
+        env_key = _env_matrix_key(environment)
+        true_v_fn = sweep_gt[(env_key, 'value_fn', gamma)]
+        true_sf_mat = sweep_gt[(env_key, 'sf_mat', sf_gamma)]
+    else:
+        true_v_fn = mut.solve_discount_batch(
+            environment, [gamma], value_fn=True, sf_mat=False
+        )['value_fn'][0]
+        true_sf_mat = mut.solve_discount_batch(
+            environment, [sf_gamma], value_fn=False, sf_mat=True
+        )['sf_mat'][0]
 
     true_reward_vec = environment.get_reward_function()
 
@@ -160,6 +329,9 @@ def _pre_compute(cfg: DictConfig, environment, agent) -> dict:
         'true_reward_vec': true_reward_vec,
     }
 
+    if cache_dir is not None:
+        gtc.save_arrays(cache_dir, cache_key, out_dict, key_dict=key_dict)
+
     return out_dict
 
 
@@ -184,28 +356,23 @@ def _extract_agent_log_dict(agent):
     if ag_dict is None:
         return log_dict
 
-    # Compute
-    # TODO: add more conditions to check if the list is empty?
+    # Compute (from the agents' streaming RunningStats)
     if 'value_errors' in ag_dict:
-        avg_value_loss = np.average(
-            np.square(ag_dict['value_errors'])
-        )
+        avg_value_loss = ag_dict['value_errors'].mean_sq
         log_dict['value_loss_avg'] = avg_value_loss
 
     if 'reward_errors' in ag_dict:
-        avg_rew_loss = np.average(
-            np.square(ag_dict['reward_errors'])
-        )
+        avg_rew_loss = ag_dict['reward_errors'].mean_sq
         log_dict['reward_loss_avg'] = avg_rew_loss
 
     if 'sf_error_norms' in ag_dict:
         # NOTE: it is already the norm so positive
-        avg_sf_loss = np.average(ag_dict['sf_error_norms'])
+        avg_sf_loss = ag_dict['sf_error_norms'].mean
         log_dict['sf_loss_avg'] = avg_sf_loss
 
     if 'et_error_norms' in ag_dict:
         # NOTE: it is already the norm so positive
-        avg_et_loss = np.average(ag_dict['et_error_norms'])
+        avg_et_loss = ag_dict['et_error_norms'].mean
         log_dict['et_loss_avg'] = avg_et_loss
 
     return log_dict
@@ -222,6 +389,7 @@ def write_post_episode_log(cfg: DictConfig,
         'env_kwargs': str(cfg.env.kwargs),
         'agentCls_name': cfg.agent.cls_string,
         'seed': cfg.training.seed,  # global seed
+        'dtype': cfg.training.dtype,
         'lr': cfg.agent.lr,
     }
 
@@ -233,23 +401,26 @@ def write_post_episode_log(cfg: DictConfig,
     # Learning RMSEs
 
     # For the value function
+    sparse = cfg.training.sparse_solve
     log_dict['v_fn_rmse'] = mut.evaluate_value_rmse(
-        environment, agent, pre_comput_dict['true_value_vec']
+        environment, agent, pre_comput_dict['true_value_vec'], sparse=sparse
     )
 
     # (Optional) for SF matrix (NOTE: hard-coded)
-    if cfg.agent.cls_string == 'SFReturnAgent':
+    if cfg.agent.cls_string in ['SFReturnAgent', 'LSTDSFReturnAgent']:
         # For LSF value function
         log_dict['sf_G_rmse'] = mut.evaluate_sf_ret_rmse(
-            environment, agent, pre_comput_dict['true_value_vec']
+            environment, agent, pre_comput_dict['true_value_vec'],
+            sparse=sparse
         )
 
         log_dict['sf_matrix_rmse'] = mut.evaluate_sf_mat_rmse(
-            environment, agent, pre_comput_dict['true_sf_mat']
+            environment, agent, pre_comput_dict['true_sf_mat'], sparse=sparse
         )
 
         log_dict['reward_vec_rmse'] = mut.evaluate_reward_rmse(
-            environment, agent, pre_comput_dict['true_reward_vec']
+            environment, agent, pre_comput_dict['true_reward_vec'],
+            sparse=sparse
         )
 
     # ==
@@ -280,7 +451,8 @@ def write_post_episode_log(cfg: DictConfig,
 
 
 def run_single_linear_experiment(cfg: DictConfig,
-                                 logger=None):
+                                 logger=None,
+                                 sweep_gt=None):
     # ==================================================
     # Initialize environment
     environment = _initialize_environment(cfg)
@@ -291,7 +463,11 @@ def run_single_linear_experiment(cfg: DictConfig,
 
     # ==================================================
     # Pre-compute items like the true value
-    pre_comput_dict = _pre_compute(cfg, environment, agent)
+    pre_comput_dict = _pre_compute(cfg, environment, agent, sweep_gt)
+
+    # Episodes after which to evaluate and log
+    eval_episodes = get_eval_episodes(cfg.training.eval_schedule,
+                                      cfg.training.num_episodes)
 
     # ==================================================
     # Run experiment
@@ -315,18 +491,19 @@ def run_single_linear_experiment(cfg: DictConfig,
 
             if done:
                 # ==
-                # Log
-                post_epis_dict = {
-                    'episode_idx': episode_idx,
-                    'total_steps': steps,
-                    'cumulative_reward': cumulative_reward,
-                }
-                write_post_episode_log(cfg=cfg,
-                                       pre_comput_dict=pre_comput_dict,
-                                       episode_dict=post_epis_dict,
-                                       environment=environment,
-                                       agent=agent,
-                                       logger=logger)
+                # (Scheduled) evaluation and log
+                if episode_idx in eval_episodes:
+                    post_epis_dict = {
+                        'episode_idx': episode_idx,
+                        'total_steps': steps,
+                        'cumulative_reward': cumulative_reward,
+                    }
+                    write_post_episode_log(cfg=cfg,
+                                           pre_comput_dict=pre_comput_dict,
+                                           episode_dict=post_epis_dict,
+                                           environment=environment,
+                                           agent=agent,
+                                           logger=logger)
 
                 # ==
                 # Terminate
@@ -339,6 +516,367 @@ def run_single_linear_experiment(cfg: DictConfig,
                 save_checkpoint(cfg, agent, episode_idx)
 
 
+def run_continuing_linear_experiment(cfg: DictConfig,
+                                     logger=None,
+                                     sweep_gt=None):
+    """
+    Continuing-task training loop, for a fixed budget of
+    cfg.training.num_steps steps (e.g. on the RandomMDPEnv, which never
+    terminates). Evaluation is logged every cfg.training.eval_freq steps,
+    with episode_idx as the checkpoint index and the agent losses averaged
+    since the previous checkpoint. Memory is constant in the number of steps.
+    If the environment does terminate, a new episode is started.
+    """
+    # ==================================================
+    # Initialize environment, agent and pre-compute items
+    environment = _initialize_environment(cfg)
+    agent = _initialize_agent(cfg, environment)
+    pre_comput_dict = _pre_compute(cfg, environment, agent, sweep_gt)
+
+    # ==================================================
+    # Run experiment
+    obs = environment.reset()
+    action = agent.begin_episode(obs)
+
+    eval_idx = 0
+    cumulative_reward = 0.0  # since the last evaluation checkpoint
+
+    for step_idx in range(cfg.training.num_steps):
+        # Interact with environment
+        obs, reward, done, info = environment.step(action)
+        action = agent.step(obs, reward, done)
+
+        # Tracker variables
+        cumulative_reward += reward
+
+        # (Episodic environment) start the next episode
+        if done:
+            obs = environment.reset()
+            action = agent.begin_episode(obs)
+
+        if ((step_idx + 1) % cfg.training.eval_freq == 0) or \
+                ((step_idx + 1) == cfg.training.num_steps):
+            # ==
+            # Log
+            post_epis_dict = {
+                'episode_idx': eval_idx,
+                'total_steps': step_idx + 1,
+                'cumulative_reward': cumulative_reward,
+            }
+            write_post_episode_log(cfg=cfg,
+                                   pre_comput_dict=pre_comput_dict,
+                                   episode_dict=post_epis_dict,
+                                   environment=environment,
+                                   agent=agent,
+                                   logger=logger)
+
+            # (Optional) Write matrices
+            if cfg.training.save_checkpoint is not None:
+                if ((cfg.training.save_checkpoint > 0) and
+                        (eval_idx % cfg.training.save_checkpoint == 0)):
+                    save_checkpoint(cfg, agent, eval_idx)
+
+            # Reset the trackers and the agent's (streaming) logs
+            eval_idx += 1
+            cumulative_reward = 0.0
+            for log_stats in agent.log_dict.values():
+                log_stats.reset()
+
+
+def run_expected_linear_experiment(cfg: DictConfig,
+                                   logger=None,
+                                   sweep_gt=None):
+    """
+    Expected-update training loop: instead of sampling transitions, each
+    step applies the agent's expected update under the on-policy state
+    distribution (agent.expected_update), giving deterministic, noise-free
+    learning curves. An "episode" is the expected episode length (rounded)
+    in steps, or cfg.training.eval_freq steps for continuing environments,
+    with the expected (undiscounted) return as cumulative_reward.
+    """
+    # ==================================================
+    # Initialize environment, agent and pre-compute items
+    environment = _initialize_environment(cfg)
+    agent = _initialize_agent(cfg, environment)
+    pre_comput_dict = _pre_compute(cfg, environment, agent, sweep_gt)
+
+    # Model of the environment the expected updates are taken under
+    model = mut.get_expected_update_model(environment)
+    if model['episode_length'] is None:
+        steps_per_episode = cfg.training.eval_freq
+        episode_return = steps_per_episode * float(
+            model['d'] @ model['R']
+        )
+    else:
+        steps_per_episode = max(1, int(round(model['episode_length'])))
+        episode_return = model['episode_return']
+
+    # Episodes after which to evaluate and log
+    eval_episodes = get_eval_episodes(cfg.training.eval_schedule,
+                                      cfg.training.num_episodes)
+
+    # ==================================================
+    # Run experiment
+    for episode_idx in range(cfg.training.num_episodes):
+        # Resets the agent's logs
+        agent.begin_episode(environment.reset())
+
+        for _ in range(steps_per_episode):
+            agent.expected_update(model)
+
+        # ==
+        # (Scheduled) evaluation and log
+        if episode_idx in eval_episodes:
+            post_epis_dict = {
+                'episode_idx': episode_idx,
+                'total_steps': steps_per_episode,
+                'cumulative_reward': episode_return,
+            }
+            write_post_episode_log(cfg=cfg,
+                                   pre_comput_dict=pre_comput_dict,
+                                   episode_dict=post_epis_dict,
+                                   environment=environment,
+                                   agent=agent,
+                                   logger=logger)
+
+        # (Optional) Write matrices
+        if cfg.training.save_checkpoint is not None:
+            if ((cfg.training.save_checkpoint > 0) and
+                    (episode_idx % cfg.training.save_checkpoint == 0)):
+                save_checkpoint(cfg, agent, episode_idx)
+
+
+def _sampled_episodes(cfg: DictConfig, environment):
+    """
+    Episodes for run_sampled_linear_experiment, either sampled in chunks
+    or replayed from the seed's pre-generated dataset
+    :return: generator of (states, rewards, truncated) per episode
+    """
+    sparse = cfg.training.sparse_solve
+    sampler = MarkovChainSampler.from_env(environment, sparse=sparse)
+
+    # (Optional) replay the dataset shared by all configs of a sweep
+    dataset_dir = cfg.training.dataset_dir
+    if dataset_dir is not None:
+        key_dict = {
+            'envCls_name': cfg.env.cls_string,
+            'env_kwargs': OmegaConf.to_container(cfg.env.kwargs),
+            'seed': cfg.training.seed,
+            'num_episodes': cfg.training.num_episodes,
+            'sampler_chunk': cfg.training.sampler_chunk,
+            'transition_matrix': mut.array_fingerprint(
+                environment.get_transition_matrix(sparse=sparse)
+            ),
+            'reward_vec': mut.array_fingerprint(
+                environment.get_reward_function()
+            ),
+            # Datasets of expected rewards (older samplers) are not reused
+            'reward_mode': ('expected' if sampler.reward_fn is None
+                            else 'sampled'),
+        }
+        traj = tds.load_or_generate_dataset(
+            dataset_dir, key_dict, sampler, cfg.training.num_episodes,
+            environment.rng, cfg.training.sampler_chunk
+        )
+        yield from iter_episodes(traj)
+        return
+
+    for chunk_start in range(0, cfg.training.num_episodes,
+                             cfg.training.sampler_chunk):
+        num_chunk = min(cfg.training.sampler_chunk,
+                        cfg.training.num_episodes - chunk_start)
+        yield from iter_episodes(sampler.sample(num_chunk, environment.rng))
+
+
+def run_sampled_linear_experiment(cfg: DictConfig,
+                                  logger=None,
+                                  sweep_gt=None):
+    """
+    Same as run_single_linear_experiment, but the episodes are sampled in
+    bulk (cfg.training.sampler_chunk episodes at a time) from the
+    environment's transition matrix with the MarkovChainSampler, instead
+    of stepping the environment. The rewards are drawn per transition by
+    the environment's sample_rewards, with the same reward noise as
+    stepping it.
+
+    With cfg.training.dataset_dir, each seed's episodes are generated once
+    into an on-disk dataset, and replayed by all the agent configs of the
+    sweep (the same episodes for every config).
+    """
+    # ==================================================
+    # Initialize environment, agent and pre-compute items
+    environment = _initialize_environment(cfg)
+    agent = _initialize_agent(cfg, environment)
+    pre_comput_dict = _pre_compute(cfg, environment, agent, sweep_gt)
+
+    phiMat = np.asarray(environment.get_feature_matrix(),
+                        dtype=cfg.training.dtype)  # (N, d)
+    terminal_phi = np.zeros(phiMat.shape[1], dtype=phiMat.dtype)
+
+    # Episodes after which to evaluate and log
+    eval_episodes = get_eval_episodes(cfg.training.eval_schedule,
+                                      cfg.training.num_episodes)
+
+    # ==================================================
+    # Run experiment
+    episode_iter = _sampled_episodes(cfg, environment)
+    for episode_idx, (ep_states, ep_rewards, truncated) in \
+            enumerate(episode_iter):
+        # The next state of a truncated episode is not stored, so its last
+        # step can be neither bootstrapped nor treated as terminal
+        if truncated:
+            raise ValueError(f'episode {episode_idx} was truncated, but the '
+                             f'sampled episodes must run to termination')
+        agent.begin_episode(phiMat[ep_states[0]])
+        for t in range(len(ep_states)):
+            done = (t + 1) == len(ep_states)
+            nex_phi = terminal_phi if done else phiMat[ep_states[t + 1]]
+            agent.step(nex_phi, ep_rewards[t], done)
+
+        # ==
+        # (Scheduled) evaluation and log
+        if episode_idx in eval_episodes:
+            post_epis_dict = {
+                'episode_idx': episode_idx,
+                'total_steps': len(ep_states),
+                'cumulative_reward': float(np.sum(ep_rewards)),
+            }
+            write_post_episode_log(cfg=cfg,
+                                   pre_comput_dict=pre_comput_dict,
+                                   episode_dict=post_epis_dict,
+                                   environment=environment,
+                                   agent=agent,
+                                   logger=logger)
+
+        # (Optional) Write matrices
+        if cfg.training.save_checkpoint is not None:
+            if ((cfg.training.save_checkpoint > 0) and
+                    (episode_idx % cfg.training.save_checkpoint == 0)):
+                save_checkpoint(cfg, agent, episode_idx)
+
+
+def run_batched_linear_experiment(cfg: DictConfig,
+                                  logger=None,
+                                  sweep_gt=None):
+    """
+    Run all seeds in cfg.training.seed at once, with N independent
+    environment copies stepped by a single batched agent. Logs are written
+    per-seed exactly as in run_single_linear_experiment.
+
+    With cfg.training.batch_env the copies are instead simulated by the
+    vectorized env (step_batch) of the first seed's environment, and only
+    the sampled trajectories and agent initializations differ between the
+    seeds. This requires an environment that does not depend on the seed
+    (e.g. not RandomMDPEnv), otherwise the per-seed logs would be of the
+    first seed's environment.
+    """
+    # ==================================================
+    # Per-seed configs and environments
+    seed_cfgs = []
+    for s in cfg.training.seed:
+        c = OmegaConf.to_container(cfg)
+        c['training']['seed'] = s
+        seed_cfgs.append(OmegaConf.create(c))
+    num_seeds = len(seed_cfgs)
+    batch_env = cfg.training.batch_env
+    if batch_env:
+        environments = [_initialize_environment(seed_cfgs[0])] * num_seeds
+        env_key = _env_matrix_key(environments[0])
+        for c in seed_cfgs[1:]:
+            if _env_matrix_key(_initialize_environment(c)) != env_key:
+                raise ValueError(f'batch_env requires an environment which '
+                                 f'does not depend on the seed, but '
+                                 f'{cfg.env.cls_string} differs between '
+                                 f'seeds {seed_cfgs[0].training.seed} and '
+                                 f'{c.training.seed}')
+    else:
+        environments = [_initialize_environment(c) for c in seed_cfgs]
+
+    # ==================================================
+    # Initialize batched agent
+    agent = _initialize_batched_agent(cfg, environments[0])
+
+    # ==================================================
+    # Pre-compute items like the true value
+    pre_comput_dicts = [_pre_compute(c, env, None, sweep_gt)
+                        for c, env in zip(seed_cfgs, environments)]
+
+    # Episodes after which to evaluate and log
+    eval_episodes = get_eval_episodes(cfg.training.eval_schedule,
+                                      cfg.training.num_episodes)
+
+    # ==================================================
+    # Run experiment
+    episode_idxs = np.zeros(num_seeds, dtype=int)
+    cumulative_rewards = np.zeros(num_seeds)
+    steps = np.zeros(num_seeds, dtype=int)
+    active = np.ones(num_seeds, dtype=bool)
+
+    if batch_env:
+        obs = environments[0].reset_batch(num_seeds)
+    else:
+        obs = np.stack([env.reset() for env in environments])
+    actions = agent.begin_episode(obs)
+
+    while np.any(active):
+        # Interact with the (active) environments
+        if batch_env:
+            # (Auto-reset) obs of the done copies are their next episode's
+            obs, rewards, dones, info = environments[0].step_batch(actions)
+            dones = dones | (~active)
+        else:
+            rewards = np.zeros(num_seeds)
+            dones = np.ones(num_seeds, dtype=bool)
+            for s_i in np.flatnonzero(active):
+                obs[s_i], rewards[s_i], dones[s_i], info = \
+                    environments[s_i].step(actions[s_i])
+        actions = agent.step(obs, rewards, dones, mask=active)
+
+        # Tracker variables
+        cumulative_rewards[active] += rewards[active]
+        steps[active] += 1
+
+        # Handle the terminated episodes
+        reset_mask = np.zeros(num_seeds, dtype=bool)
+        for s_i in np.flatnonzero(dones & active):
+            seed_agent = agent.get_agent(s_i)
+            if episode_idxs[s_i] in eval_episodes:
+                post_epis_dict = {
+                    'episode_idx': episode_idxs[s_i],
+                    'total_steps': steps[s_i],
+                    'cumulative_reward': cumulative_rewards[s_i],
+                }
+                write_post_episode_log(cfg=seed_cfgs[s_i],
+                                       pre_comput_dict=pre_comput_dicts[s_i],
+                                       episode_dict=post_epis_dict,
+                                       environment=environments[s_i],
+                                       agent=seed_agent,
+                                       logger=logger)
+
+            # (Optional) Write matrices
+            if cfg.training.save_checkpoint is not None:
+                if ((cfg.training.save_checkpoint > 0) and
+                        (episode_idxs[s_i] %
+                         cfg.training.save_checkpoint == 0)):
+                    save_checkpoint(seed_cfgs[s_i], seed_agent,
+                                    episode_idxs[s_i])
+
+            # Next episode or finish
+            episode_idxs[s_i] += 1
+            cumulative_rewards[s_i] = 0.0
+            steps[s_i] = 0
+            if episode_idxs[s_i] >= cfg.training.num_episodes:
+                active[s_i] = False
+            else:
+                if not batch_env:
+                    obs[s_i] = environments[s_i].reset()
+                reset_mask[s_i] = True
+
+        if np.any(reset_mask):
+            new_actions = agent.begin_episode(obs, mask=reset_mask)
+            actions[reset_mask] = new_actions[reset_mask]
+
+
 def save_checkpoint(cfg: DictConfig, agent, episode_idx):
     """
     Helper method to manually write to file
@@ -355,7 +893,7 @@ def save_checkpoint(cfg: DictConfig, agent, episode_idx):
     # Save key parameters of agents
     ckpt_dict['agent'] = {}
 
-    attri_list = ['Wq', 'Wz', 'Wr', 'Ws', 'Wv']
+    attri_list = ['Wq', 'Wz', 'Wz_diag', 'Wz_U', 'Wz_V', 'Wr', 'Ws', 'Ws_U', 'Ws_V', 'Wv']
     for att_str in attri_list:
         if hasattr(agent, att_str):
             cur_att = getattr(agent, att_str)
@@ -421,13 +959,53 @@ def run_experiments(cfg: DictConfig, logger=None):
     cfg_dict = OmegaConf.to_container(cfg)
     cfg_dict_list = dict_2_dict_list(cfg_dict)
 
+    # (Optional) keep the list of seeds together for the batched agents
+    batch_seeds = cfg_dict['training'].get('batch_seeds', False)
+    continuing = cfg_dict['training'].get('num_steps', None) is not None
+    expected_update = cfg_dict['training'].get('expected_update', False)
+    bulk_sampler = (cfg_dict['training'].get('bulk_sampler', False) or
+                    cfg_dict['training'].get('dataset_dir') is not None)
+    if batch_seeds and continuing:
+        raise ValueError('Continuing tasks are not batched')
+    if expected_update and (batch_seeds or continuing):
+        raise ValueError('Expected updates run over num_episodes '
+                         'of a single (deterministic) agent')
+    if bulk_sampler and (batch_seeds or continuing or expected_update):
+        raise ValueError('The bulk sampler / datasets only replace '
+                         'the episodes of run_single_linear_experiment')
+    if batch_seeds:
+        cfg_dict_list['training']['seed'] = [
+            cfg_dict_list['training']['seed']
+        ]
+        cfg_dict_list['training']['batch_seeds'] = [True]
+
+    # ==
+    # Solve the ground truth of the whole sweep at once, e.g. the successor
+    # features of all the lamb values, instead of per config (unless
+    # re-used from the disk cache)
+    cfg_combs = list(gen_combinations(cfg_dict_list))
+    sweep_gt = None
+    if cfg_dict['training'].get('gt_cache_dir') is None:
+        sweep_gt = _solve_sweep_ground_truth(
+            [OmegaConf.create(c) for c in cfg_combs]
+        )
+
     # ==
     # Iterate over product of possible param combinations
-    for c in gen_combinations(cfg_dict_list):
+    for c in cfg_combs:
         print(c)
         cur_cfg = OmegaConf.create(c)
         # run individual experiments
-        run_single_linear_experiment(cur_cfg, logger)
+        if batch_seeds:
+            run_batched_linear_experiment(cur_cfg, logger, sweep_gt)
+        elif expected_update:
+            run_expected_linear_experiment(cur_cfg, logger, sweep_gt)
+        elif bulk_sampler:
+            run_sampled_linear_experiment(cur_cfg, logger, sweep_gt)
+        elif continuing:
+            run_continuing_linear_experiment(cur_cfg, logger, sweep_gt)
+        else:
+            run_single_linear_experiment(cur_cfg, logger, sweep_gt)
 
 
 @hydra.main(config_path="conf", config_name="config")
@@ -0,0 +1,46 @@
+# =============================================================================
+# Evaluation schedules for the training drivers, i.e. after which episodes
+# to compute the evaluation metrics and write a log line. Training runs
+# uninterrupted in between.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+
+def get_eval_episodes(sched_cfg, num_episodes: int) -> set:
+    """
+    Episode indices to evaluate after, from the training.eval_schedule
+    config. Schedule types:
+        'every': every `freq` episodes (freq=1 evaluates after all episodes)
+        'geometric': `num_evals` geometrically spaced episodes, dense early
+                     in training and sparse later on
+        'list': the `episodes` in a ';'-separated string, e.g. '0;9;99'
+    The final episode is always evaluated for the 'every' and 'geometric'
+    schedules.
+
+    :param sched_cfg: eval_schedule config, or None to evaluate every episode
+    :param num_episodes: total number of training episodes
+    :return: set of (0-indexed) episode indices
+    """
+    if sched_cfg is None:
+        return set(range(num_episodes))
+
+    sched_type = sched_cfg.type
+    if sched_type == 'every':
+        eval_idxs = set(range(0, num_episodes, sched_cfg.freq))
+    elif sched_type == 'geometric':
+        geo_points = np.geomspace(1, num_episodes, num=sched_cfg.num_evals)
+        eval_idxs = set(int(e) - 1 for e in np.round(geo_points))
+    elif sched_type == 'list':
+        return set(int(e) for e in str(sched_cfg.episodes).split(';'))
+    else:
+        raise ValueError(f'Unknown evaluation schedule type: {sched_type}')
+
+    eval_idxs.add(num_episodes - 1)
+    return eval_idxs
+
+
+if __name__ == "__main__":
+    print('hello world')
@@ -0,0 +1,108 @@
+# =============================================================================
+# On-disk, content-addressed cache of the ground-truth quantities (true value
+# vector, SF matrix, reward vector) used to measure the RMSEs. Entries are
+# keyed by a hash of the environment config and discounts, stored as .npy
+# files and memory-mapped when re-used.
+#
+# Writes are atomic (write to a temporary file, then os.replace), so that
+# concurrent jobs on one machine can share a cache directory. A partially
+# written entry is never read; at worst two jobs compute the same entry.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from utils.sparse_utils import is_sparse, sp_sparse
+
+
+def cache_key(key_dict: dict) -> str:
+    """
+    Content address of a cache entry
+    :param key_dict: json-serializable dict identifying the entry, e.g. env
+                     class, env kwargs and discounts
+    :return: hex digest
+    """
+    key_str = json.dumps(key_dict, sort_keys=True, default=str)
+    return hashlib.sha256(key_str.encode()).hexdigest()[:32]
+
+
+def _atomic_write(path: str, write_fn) -> None:
+    """
+    Write a file atomically, write_fn(file_obj) writes to a temporary file
+    in the same directory which then replaces path
+    """
+    dir_path = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _array_path(entry_dir: str, name: str, sparse: bool) -> str:
+    return os.path.join(entry_dir, name + ('.npz' if sparse else '.npy'))
+
+
+def load_arrays(cache_dir: str, key: str, names) -> dict:
+    """
+    Load a cache entry, dense arrays are memory-mapped (read-only)
+    :param cache_dir: cache root directory
+    :param key: entry key from cache_key
+    :param names: names of the arrays in the entry
+    :return: dict of name -> array, or None if the entry is incomplete
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    out_dict = {}
+    for name in names:
+        npy_path = _array_path(entry_dir, name, sparse=False)
+        npz_path = _array_path(entry_dir, name, sparse=True)
+        if os.path.exists(npy_path):
+            out_dict[name] = np.load(npy_path, mmap_mode='r')
+        elif os.path.exists(npz_path):
+            out_dict[name] = sp_sparse.load_npz(npz_path)
+        else:
+            return None
+    return out_dict
+
+
+def save_arrays(cache_dir: str, key: str, arr_dict: dict,
+                key_dict: dict = None) -> None:
+    """
+    Save a cache entry, one (atomically written) file per array
+    :param cache_dir: cache root directory
+    :param key: entry key from cache_key
+    :param arr_dict: dict of name -> np array or scipy.sparse matrix
+    :param key_dict: (optional) the dict the key was computed from, saved
+                     alongside for reference
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    os.makedirs(entry_dir, exist_ok=True)
+
+    if key_dict is not None:
+        key_str = json.dumps(key_dict, sort_keys=True, default=str, indent=2)
+        _atomic_write(os.path.join(entry_dir, 'key.json'),
+                      lambda f: f.write(key_str.encode()))
+
+    for name, arr in arr_dict.items():
+        if is_sparse(arr):
+            _atomic_write(_array_path(entry_dir, name, sparse=True),
+                          lambda f: sp_sparse.save_npz(f, arr))
+        else:
+            _atomic_write(_array_path(entry_dir, name, sparse=False),
+                          lambda f: np.save(f, np.asarray(arr)))
+
+
+if __name__ == "__main__":
+    print('hello world')
@@ -0,0 +1,333 @@
+# =============================================================================
+# (Optional) Numba-compiled per-step update kernels for the linear agents.
+# Each kernel does the trace update, TD error and parameter update of one
+# agent step with explicit loops, updating the parameter arrays in place.
+# Zero feature entries are skipped, so one-hot features cost O(d) per step.
+#
+# Numba is optional: if it is not installed NUMBA_AVAILABLE is False and the
+# agents fall back to their numpy implementations.
+#
+# The compiled kernels are only cached on disk when NUMBA_CACHE_DIR is set
+# (e.g. NUMBA_CACHE_DIR=~/.cache/numba), otherwise they are compiled once per
+# process. Numba's default cache location is the package's __pycache__,
+# which fails on read-only installs and is shared by all the processes of a
+# parallel sweep.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import math
+import warnings
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    numba = None
+    NUMBA_AVAILABLE = False
+
+# On-disk caching of the compiled kernels, only with NUMBA_CACHE_DIR
+NUMBA_CACHE = NUMBA_AVAILABLE and bool(numba.config.CACHE_DIR)
+
+
+def _njit(fn):
+    if NUMBA_AVAILABLE:
+        return numba.njit(cache=NUMBA_CACHE)(fn)
+    return fn
+
+
+def check_use_jit(use_jit: bool) -> bool:
+    """
+    Helper to resolve an agent's use_jit flag, warning when numba is
+    requested but not installed
+    :param use_jit: requested flag
+    :return: whether the compiled kernels can be used
+    """
+    if use_jit and not NUMBA_AVAILABLE:
+        warnings.warn('numba is not installed, falling back to numpy '
+                      'updates (use_jit=False)')
+        return False
+    return use_jit
+
+
+@_njit
+def _update_action_trace(Z, cur_phi, cur_act, decay):
+    """
+    Z = decay * Z + outer(phi, one_hot(act)), Z of shape (d, |A|)
+    """
+    d, n_act = Z.shape
+    for i in range(d):
+        for a in range(n_act):
+            Z[i, a] = decay * Z[i, a]
+        Z[i, cur_act] += cur_phi[i]
+
+
+@_njit
+def _phi_dot_col(phi, W, col):
+    """
+    phi @ W[:, col], skipping zero features
+    """
+    out = 0.0
+    for i in range(phi.shape[0]):
+        if phi[i] != 0.0:
+            out += phi[i] * W[i, col]
+    return out
+
+
+@_njit
+def sarsa_lambda_step(Wq, Z, cur_phi, cur_act, nex_phi, nex_act, rew, done,
+                      gamma, lamb, lr):
+    """
+    SarsaLambdaAgent._optimize_model, in place on Wq and Z (d, |A|)
+    :return: TD error
+    """
+    _update_action_trace(Z, cur_phi, cur_act, lamb * gamma)
+
+    nex_q = 0.0
+    if not done:
+        nex_q = _phi_dot_col(nex_phi, Wq, nex_act)
+    cur_q = _phi_dot_col(cur_phi, Wq, cur_act)
+    td_err = rew + (gamma * nex_q) - cur_q
+
+    d, n_act = Wq.shape
+    for i in range(d):
+        for a in range(n_act):
+            Wq[i, a] += lr * (td_err * Z[i, a])
+    return td_err
+
+
+@_njit
+def q_learning_trace_td(Wq, Z, cur_phi, cur_act, nex_phi, rew, done, gamma,
+                        lamb):
+    """
+    Trace update and TD error of QAgent._optimize_model, in place on Z. The
+    parameter update is left to the agent's optimizer.
+    :return: TD error
+    """
+    _update_action_trace(Z, cur_phi, cur_act, lamb * gamma)
+
+    nex_q = 0.0
+    if not done:
+        n_act = Wq.shape[1]
+        nex_q = _phi_dot_col(nex_phi, Wq, 0)
+        for a in range(1, n_act):
+            nex_q = max(nex_q, _phi_dot_col(nex_phi, Wq, a))
+    cur_q = _phi_dot_col(cur_phi, Wq, cur_act)
+    return rew + (gamma * nex_q) - cur_q
+
+
+@_njit
+def expected_trace_step(Wq, Z, Z_mix, Wz, cur_phi, cur_act, nex_phi, nex_act,
+                        rew, done, gamma, lamb, eta, lr, et_lr, et_buf):
+    """
+    ExpectedTraceAgent._optimize_model, in place on Wq, Z, Z_mix (d, |A|)
+    and Wz (d, |A|, d)
+    :param et_buf: (d, ) scratch buffer
+    :return: TD error, norm of the expected trace error
+    """
+    d, n_act = Wq.shape
+    _update_action_trace(Z, cur_phi, cur_act, lamb * gamma)
+
+    # Supervised learning of the expected trace
+    for j in range(d):
+        et_buf[j] = Z[j, cur_act]
+    for i in range(d):
+        if cur_phi[i] != 0.0:
+            for j in range(d):
+                et_buf[j] -= cur_phi[i] * Wz[i, cur_act, j]
+    et_err_sq = 0.0
+    for j in range(d):
+        et_err_sq += et_buf[j] * et_buf[j]
+    for i in range(d):
+        if cur_phi[i] != 0.0:
+            for j in range(d):
+                Wz[i, cur_act, j] += et_lr * (cur_phi[i] * et_buf[j])
+
+    # TD error
+    nex_q = 0.0
+    if not done:
+        nex_q = _phi_dot_col(nex_phi, Wq, nex_act)
+    cur_q = _phi_dot_col(cur_phi, Wq, cur_act)
+    td_err = rew + (gamma * nex_q) - cur_q
+
+    # Parameter updates with the expected trace of every action
+    if eta == 0.0:
+        for i in range(d):
+            if cur_phi[i] != 0.0:
+                for a in range(n_act):
+                    for j in range(d):
+                        Wq[j, a] += lr * td_err * cur_phi[i] * Wz[i, a, j]
+        return td_err, math.sqrt(et_err_sq)
+
+    # Or with the (recursive) eta-mixture trace
+    for j in range(d):
+        for a in range(n_act):
+            Z_mix[j, a] *= eta * lamb * gamma
+        Z_mix[j, cur_act] += eta * cur_phi[j]
+    for i in range(d):
+        if cur_phi[i] != 0.0:
+            for a in range(n_act):
+                for j in range(d):
+                    Z_mix[j, a] += (1.0 - eta) * cur_phi[i] * Wz[i, a, j]
+    for j in range(d):
+        for a in range(n_act):
+            Wq[j, a] += lr * td_err * Z_mix[j, a]
+    return td_err, math.sqrt(et_err_sq)
+
+
+@_njit
+def sf_reward_step(Wr, cur_phi, rew, lr):
+    """
+    SFReturnAgent._optimize_reward_fn, in place on Wr (d, )
+    :return: reward error
+    """
+    rew_err = rew
+    for i in range(cur_phi.shape[0]):
+        if cur_phi[i] != 0.0:
+            rew_err -= cur_phi[i] * Wr[i]
+    for i in range(cur_phi.shape[0]):
+        if cur_phi[i] != 0.0:
+            Wr[i] += lr * (rew_err * cur_phi[i])
+    return rew_err
+
+
+@_njit
+def _add_phi_W(out, phi, W, scale):
+    """
+    out += scale * (phi @ W), skipping zero features, W of shape (d, d)
+    """
+    for i in range(phi.shape[0]):
+        if phi[i] != 0.0:
+            for j in range(W.shape[1]):
+                out[j] += scale * phi[i] * W[i, j]
+
+
+@_njit
+def sf_feature_step(Ws, cur_phi, cur_act, nex_phi, nex_act, done,
+                    lamb_gamma, lr, sf_buf):
+    """
+    SFReturnAgent._optimize_successor_features, in place on Ws (|A|, d, d)
+    :param sf_buf: (d, ) scratch buffer
+    :return: norm of the SF TD error
+    """
+    d = cur_phi.shape[0]
+    for j in range(d):
+        sf_buf[j] = cur_phi[j]
+    if not done:
+        _add_phi_W(sf_buf, nex_phi, Ws[nex_act], lamb_gamma)
+    _add_phi_W(sf_buf, cur_phi, Ws[cur_act], -1.0)
+
+    err_sq = 0.0
+    for j in range(d):
+        err_sq += sf_buf[j] * sf_buf[j]
+    for i in range(d):
+        if cur_phi[i] != 0.0:
+            for j in range(d):
+                Ws[cur_act, i, j] += lr * (cur_phi[i] * sf_buf[j])
+    return math.sqrt(err_sq)
+
+
+@_njit
+def sf_value_step(Wv, Zv, Ws, Wr, cur_phi, nex_phi, nex_act, rew, done,
+                  gamma, lamb, eta_trace, lr):
+    """
+    SFReturnAgent._optimize_value_fn, in place on Wv and Zv (d, )
+    :return: value TD error
+    """
+    d = cur_phi.shape[0]
+    decay = eta_trace * gamma
+    for i in range(d):
+        Zv[i] = decay * Zv[i] + cur_phi[i]
+
+    # Lambda successor return of the next state
+    slr_V = 0.0
+    if not done:
+        for i in range(d):
+            if nex_phi[i] != 0.0:
+                for j in range(d):
+                    slr_V += nex_phi[i] * Ws[nex_act, i, j] * (
+                        ((1 - lamb) * Wv[j]) + (lamb * Wr[j])
+                    )
+
+    cur_v = 0.0
+    for i in range(d):
+        if cur_phi[i] != 0.0:
+            cur_v += cur_phi[i] * Wv[i]
+    v_td_err = rew + (gamma * slr_V) - cur_v
+
+    for i in range(d):
+        Wv[i] += lr * (v_td_err * Zv[i])
+    return v_td_err
+
+
+@_njit
+def sf_return_step(Wr, Ws, Wv, Zv, cur_phi, cur_act, nex_phi, nex_act, rew,
+                   done, gamma, lamb, eta_trace, reward_lr, sf_lr, value_lr,
+                   learn_reward, learn_sf, sf_buf):
+    """
+    One SFReturnAgent step (reward, SF and value learning) in a single
+    kernel call, see sf_reward_step, sf_feature_step and sf_value_step
+    :param learn_reward: whether to update the reward parameters
+    :param learn_sf: whether to update the SF parameters
+    :return: reward error, norm of the SF TD error, value TD error (the
+             errors of the parameters not learned are 0)
+    """
+    rew_err = 0.0
+    if learn_reward:
+        rew_err = sf_reward_step(Wr, cur_phi, rew, reward_lr)
+    sf_err_norm = 0.0
+    if learn_sf:
+        sf_err_norm = sf_feature_step(Ws, cur_phi, cur_act, nex_phi,
+                                      nex_act, done, lamb * gamma, sf_lr,
+                                      sf_buf)
+    v_td_err = sf_value_step(Wv, Zv, Ws, Wr, cur_phi, nex_phi, nex_act, rew,
+                             done, gamma, lamb, eta_trace, value_lr)
+    return rew_err, sf_err_norm, v_td_err
+
+
+if __name__ == "__main__":
+    # Agent step throughput, numpy vs compiled kernels, on recorded episodes
+    # (run from linear/ as `python -m utils.jit_kernels`)
+    import time
+    from envs.random_walk_chain import RandomWalkChainEnv
+    from algos.td_lambda_ag import SarsaLambdaAgent
+    from algos.sf_return_ag import SFReturnAgent
+    from algos.expt_trace_ag import ExpectedTraceAgent
+
+    print('numba available:', NUMBA_AVAILABLE)
+
+    env = RandomWalkChainEnv()
+    episodes = []
+    for _ in range(200):
+        ep = [(env.reset(), 0.0, False)]
+        while not ep[-1][2]:
+            obs, rew, done, _ = env.step(0)
+            ep.append((obs, rew, done))
+        episodes.append(ep)
+    d = len(episodes[0][0][0])
+
+    def steps_per_sec(make_agent):
+        for rep in range(2):  # first pass compiles the kernels
+            agent, n_steps = make_agent(), 0
+            t_start = time.perf_counter()
+            for ep in episodes:
+                agent.begin_episode(ep[0][0])
+                for obs, rew, done in ep[1:]:
+                    agent.step(obs, rew, done)
+                    n_steps += 1
+        return n_steps / (time.perf_counter() - t_start)
+
+    agent_makers = {
+        'sarsa': lambda j: SarsaLambdaAgent(d, 1, lamb=0.8, lr=0.05,
+                                            use_jit=j),
+        'sf_return': lambda j: SFReturnAgent(d, 1, lamb=0.8, eta_trace=0.3,
+                                             lr=0.05, use_jit=j),
+        'expected_trace': lambda j: ExpectedTraceAgent(d, 1, lamb=0.8,
+                                                       lr=0.05, eta=0.5,
+                                                       use_jit=j),
+    }
+    for name, make in agent_makers.items():
+        np_rate = steps_per_sec(lambda: make(False))
+        jit_rate = steps_per_sec(lambda: make(True))
+        print('%-15s numpy %8.0f steps/s  jit %8.0f steps/s  %5.1fx' %
+              (name, np_rate, jit_rate, jit_rate / np_rate))
@@ -0,0 +1,278 @@
+# =============================================================================
+# Bulk trajectory sampler for the single-action prediction environments,
+# whose dynamics are the (sub-stochastic) transition matrix, the start
+# distribution and the reward function. Samples many complete episodes at
+# once by advancing all of them one step per iteration, with a single
+# vectorized categorical draw (search in the cumulative transition tables)
+# per step.
+#
+# Episodes are returned packed: the visited state indices of all episodes
+# concatenated, with the start offset of each episode.
+#
+# The rewards are drawn per transition by the environment's vectorized
+# reward function (sample_rewards), with the same reward noise as stepping
+# the environment. Without one, the rewards are the expected rewards of
+# get_reward_function (correct means, but no reward noise).
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+from utils.sparse_utils import is_sparse
+
+# Row sums above 1 - ROW_SUM_TOL are treated as non-terminating
+ROW_SUM_TOL = 1e-9
+
+
+class MarkovChainSampler:
+    """
+    Samples episodes of the Markov reward process (P, R, mu_0). The missing
+    probability mass 1 - sum_j P[i, j] of each row is the probability of
+    terminating from state i.
+    """
+
+    def __init__(self, P_trans, rew_vec, start_dist, reward_fn=None):
+        """
+        :param P_trans: (N, N) transition matrix, np array or scipy.sparse
+        :param rew_vec: (N, ) (expected) reward of exiting each state
+        :param start_dist: (N, ) distribution of the initial state
+        :param reward_fn: (optional) reward_fn(states, nex_states, rng)
+                          drawing the (B, ) rewards of the transitions
+                          (next state -1 if terminated), instead of the
+                          expected rewards rew_vec
+        """
+        self.n_states = P_trans.shape[0]
+        self.rew_vec = np.asarray(rew_vec, dtype=np.float64)
+        self.reward_fn = reward_fn
+        self.start_cdf = np.cumsum(start_dist)
+
+        self._init_cdf_tables(P_trans)
+
+    @classmethod
+    def from_env(cls, env, sparse=False):
+        """
+        :param env: gym environment with get_transition_matrix,
+                    get_reward_function and get_start_distribution, and
+                    (optionally) sample_rewards, see BatchEnvMixin
+        :param sparse: use the scipy.sparse transition matrix, e.g. for
+                       large environments
+        """
+        return cls(env.get_transition_matrix(sparse=sparse),
+                   env.get_reward_function(),
+                   env.get_start_distribution(),
+                   reward_fn=getattr(env, 'sample_rewards', None))
+
+    def _init_cdf_tables(self, P_trans) -> None:
+        """
+        Flatten the CDFs of all rows (over their non-zero entries and a
+        final terminal outcome) into one sorted array, with row i offset to
+        [i, i + 1]. A single searchsorted of i + u then samples the next
+        state of every current state i at once.
+        """
+        n = self.n_states
+        if is_sparse(P_trans):
+            P_trans = P_trans.tocsr()
+            P_trans.sort_indices()
+            counts = np.diff(P_trans.indptr)
+            rows = np.repeat(np.arange(n), counts)
+            cols, vals = P_trans.indices, P_trans.data
+        else:
+            rows, cols = np.nonzero(P_trans)  # row-major order
+            vals = P_trans[rows, cols]
+            counts = np.bincount(rows, minlength=n)
+        row_ends = np.cumsum(counts)
+        row_starts = row_ends - counts
+
+        # Within-row CDFs, full rows end at exactly 1
+        row_cums = np.cumsum(vals)
+        row_cums -= np.concatenate([[0.0], row_cums])[row_starts][rows]
+        row_sums = np.zeros(n)
+        has_entries = counts > 0
+        row_sums[has_entries] = row_cums[row_ends[has_entries] - 1]
+        full_rows = np.flatnonzero(row_sums >= (1.0 - ROW_SUM_TOL))
+        row_cums[row_ends[full_rows] - 1] = 1.0
+        row_cums = np.minimum(row_cums, 1.0)
+        self.terminates = len(full_rows) < n
+
+        # Each row's entries followed by its terminal outcome (column -1)
+        self._flat_cdf = np.empty(len(vals) + n)
+        self._flat_cols = np.empty(len(vals) + n, dtype=np.int64)
+        entry_pos = np.arange(len(vals)) + rows
+        self._flat_cdf[entry_pos] = rows + row_cums
+        self._flat_cols[entry_pos] = cols
+        term_pos = row_ends + np.arange(n)
+        self._flat_cdf[term_pos] = np.arange(n) + 1.0
+        self._flat_cols[term_pos] = -1
+
+    def _sample_next(self, states, rng) -> np.ndarray:
+        """
+        :param states: (B, ) current state indices
+        :return: (B, ) next state indices, -1 where terminated
+        """
+        u = rng.random(len(states))
+        pos = np.searchsorted(self._flat_cdf, states + u, side='right')
+        return self._flat_cols[np.minimum(pos, len(self._flat_cdf) - 1)]
+
+    def sample(self, num_episodes, rng, max_steps=None) -> dict:
+        """
+        Sample complete episodes
+        :param num_episodes: number of episodes E
+        :param rng: np.random.Generator
+        :param max_steps: (optional) truncate the episodes after max_steps
+                          steps, required if the chain never terminates
+        :return: dict with
+                 'states': (T, ) packed state indices of all episodes
+                 'rewards': (T, ) reward of exiting each of the states
+                            (drawn with reward_fn, if given)
+                 'offsets': (E + 1, ) episode e is [offsets[e], offsets[e+1])
+                 'truncated': (E, ) boolean, episode cut at max_steps
+        """
+        if (max_steps is None) and (not self.terminates):
+            raise ValueError('max_steps is required for a non-terminating '
+                             'chain')
+
+        u = rng.random(num_episodes)
+        cur_states = np.minimum(np.searchsorted(self.start_cdf, u,
+                                                side='right'),
+                                self.n_states - 1)
+        ep_idxs = np.arange(num_episodes)
+
+        # Advance all live episodes by one step per iteration
+        step_states, step_rewards, step_ep_idxs = [], [], []
+        lengths = np.zeros(num_episodes, dtype=np.int64)
+        truncated = np.zeros(num_episodes, dtype=bool)
+        while len(cur_states) > 0:
+            nex_states = self._sample_next(cur_states, rng)
+            if self.reward_fn is not None:
+                step_rewards.append(self.reward_fn(cur_states, nex_states,
+                                                   rng))
+            step_states.append(cur_states)
+            step_ep_idxs.append(ep_idxs)
+            lengths[ep_idxs] += 1
+            live = nex_states >= 0
+            if (max_steps is not None) and (len(step_states) >= max_steps):
+                # Episodes which terminated on this very step are not cut
+                truncated[ep_idxs[live]] = True
+                break
+
+            cur_states, ep_idxs = nex_states[live], ep_idxs[live]
+
+        # Pack, step t of episode e goes to offsets[e] + t
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        states = np.empty(offsets[-1], dtype=np.int64)
+        for t, (t_states, t_ep_idxs) in enumerate(zip(step_states,
+                                                      step_ep_idxs)):
+            states[offsets[t_ep_idxs] + t] = t_states
+
+        if self.reward_fn is None:
+            rewards = self.rew_vec[states]
+        else:
+            rewards = np.empty(offsets[-1], dtype=np.float64)
+            for t, (t_rewards, t_ep_idxs) in enumerate(zip(step_rewards,
+                                                           step_ep_idxs)):
+                rewards[offsets[t_ep_idxs] + t] = t_rewards
+
+        return {
+            'states': states,
+            'rewards': rewards,
+            'offsets': offsets,
+            'truncated': truncated,
+        }
+
+
+def iter_episodes(traj: dict):
+    """
+    Iterate over the episodes of packed trajectories
+    :param traj: dict from MarkovChainSampler.sample
+    :return: generator of (states, rewards, truncated) per episode, states
+             and rewards are views into the packed arrays
+    """
+    offsets = traj['offsets']
+    for e in range(len(offsets) - 1):
+        ep_slice = slice(offsets[e], offsets[e + 1])
+        yield (traj['states'][ep_slice], traj['rewards'][ep_slice],
+               traj['truncated'][e])
+
+
+if __name__ == "__main__":
+    # Statistical check of the sampled episodes against stepping the
+    # environment: state visit frequencies, episode lengths, and the mean
+    # and variance of the (undiscounted) returns
+    # (run from linear/ as `python -m utils.markov_sampler`)
+    from envs.perf_bin_tree import PerfBinaryTreeEnv
+    from envs.fan_in_bin_tree import FanInBinaryTreeEnv
+    from envs.linear_chain import SimpleLinearChainEnv
+    from envs.random_walk_chain import RandomWalkChainEnv
+
+    num_episodes = 10000
+    rng = np.random.default_rng(0)
+
+    def episode_stats(ep_states, ep_returns, n_states):
+        visits = np.bincount(np.concatenate(ep_states), minlength=n_states)
+        lengths = np.array([len(s) for s in ep_states])
+        return visits / np.sum(visits), lengths, np.array(ep_returns)
+
+    for env in [PerfBinaryTreeEnv(seed=1), FanInBinaryTreeEnv(seed=1),
+                SimpleLinearChainEnv(seed=1), RandomWalkChainEnv(seed=1)]:
+        sampler = MarkovChainSampler.from_env(env)
+        n_states = sampler.n_states
+
+        # Sampled episodes, with per-transition and with expected rewards
+        smp_eps = list(iter_episodes(sampler.sample(num_episodes, rng)))
+        smp_visits, smp_lengths, smp_returns = episode_stats(
+            [s for s, _, _ in smp_eps], [np.sum(r) for _, r, _ in smp_eps],
+            n_states
+        )
+        exp_traj = MarkovChainSampler(
+            env.get_transition_matrix(), env.get_reward_function(),
+            env.get_start_distribution()
+        ).sample(num_episodes, rng)
+        exp_returns = np.add.reduceat(exp_traj['rewards'],
+                                      exp_traj['offsets'][:-1])
+
+        # Stepped episodes, states as rows of the transition matrix
+        env_states, env_returns = [], []
+        for _ in range(num_episodes):
+            env.reset()
+            states, ep_return, done = [], 0.0, False
+            while not done:
+                states.append(env.state - env.matrix_state_offset)
+                _, reward, done, _ = env.step(0)
+                ep_return += reward
+            env_states.append(np.array(states))
+            env_returns.append(ep_return)
+        env_visits, env_lengths, env_returns = episode_stats(
+            env_states, env_returns, n_states
+        )
+
+        ret_se = np.sqrt((np.var(smp_returns) + np.var(env_returns)) /
+                         num_episodes)
+        print(type(env).__name__)
+        print('  %-22s %10s %10s' % ('', 'sampler', 'env.step'))
+        print('  %-22s %10.4f %10.4f' % ('mean episode length',
+                                         np.mean(smp_lengths),
+                                         np.mean(env_lengths)))
+        print('  %-22s %10.4f %10.4f  (z = %.2f)' % (
+            'return mean', np.mean(smp_returns), np.mean(env_returns),
+            (np.mean(smp_returns) - np.mean(env_returns)) / ret_se))
+        print('  %-22s %10.4f %10.4f  (expected rewards: %.4f)' % (
+            'return variance', np.var(smp_returns), np.var(env_returns),
+            np.var(exp_returns)))
+        print('  %-22s %10.4f' % ('max visit freq diff',
+                                  np.max(np.abs(smp_visits - env_visits))))
+
+        # Truncation: the same episodes cut at max_steps, where only the
+        # episodes still running after max_steps steps are truncated
+        full_traj = sampler.sample(num_episodes, np.random.default_rng(1))
+        full_lengths = np.diff(full_traj['offsets'])
+        max_steps = int(np.median(full_lengths))
+        cut_traj = sampler.sample(num_episodes, np.random.default_rng(1),
+                                  max_steps=max_steps)
+        assert np.array_equal(np.diff(cut_traj['offsets']),
+                              np.minimum(full_lengths, max_steps))
+        assert np.array_equal(cut_traj['truncated'],
+                              full_lengths > max_steps)
+        print('  %-22s %10d %10d' % ('truncated / ended at',
+                                     np.sum(cut_traj['truncated']),
+                                     np.sum(full_lengths == max_steps)))
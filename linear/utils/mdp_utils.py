@@ -1,12 +1,314 @@
 # =============================================================================
 # Utility functions for solving MDPs
 #
+# NOTE: the solvers always work in float64 (for exactness checks), the
+#       solved parameters can be cast to the agent dtype via `dtype`
+#
+# The linear systems are solved with (cached) LU / Cholesky factorizations
+# rather than explicit inverses. Factorizations are keyed by the content of
+# the environment matrices and the discount, so the repeated solves of a
+# config sweep over the same environment only factorize once. Uses scipy if
+# available, otherwise falls back to (un-cached) np.linalg.solve. Sweeps
+# over many discounts can instead use solve_discount_batch, which decomposes
+# the transition matrix (eigen / Schur) once for all discounts.
+#
+# For large environments, solve_value_fn and solve_successor_feature can
+# instead use the scipy.sparse environment matrices (sparse=True), solved
+# with a sparse LU or ILU-preconditioned GMRES.
+#
+# get_expected_update_model collects the environment matrices and on-policy
+# state distribution for the agents' expected (synchronous) updates.
+#
 # Author: Anthony G. Chen
 # =============================================================================
 
+import collections
+import hashlib
+import inspect
+import warnings
+
 import gym
 import numpy as np
 
+from utils.sparse_utils import is_sparse, sp_sparse, to_dense
+
+try:
+    import scipy.linalg as sp_linalg
+    import scipy.sparse.linalg as sp_sparse_linalg
+    SCIPY_AVAILABLE = True
+    # The gmres tolerance is named rtol from scipy 1.12 on, tol before
+    GMRES_TOL_KWARG = ('rtol' if 'rtol' in inspect.signature(
+        sp_sparse_linalg.gmres).parameters else 'tol')
+except ImportError:
+    sp_linalg = None
+    sp_sparse_linalg = None
+    SCIPY_AVAILABLE = False
+    GMRES_TOL_KWARG = None
+
+
+# ==
+# Factorization cache
+
+# Maximum number of cached factorizations, least recently used are evicted
+FACTOR_CACHE_SIZE = 32
+# Eigenvector condition number above which the spectral solver treats the
+# transition matrix as (numerically) non-diagonalizable
+SPECTRAL_COND_MAX = 1e8
+# Approximate cost of the spectral decomposition, in units of n^3 flops
+# (measured, the eigendecomposition takes about as long as 24 LU
+# factorizations of the same matrix)
+SPECTRAL_SETUP_COST = 16.0
+# Relative residual tolerance of the (sparse) GMRES solver
+GMRES_RTOL = 1e-10
+# Max number of dense entries per block of columns for sparse right hand sides
+SPARSE_RHS_BLOCK_SIZE = 2 ** 18
+# Number of states per block when evaluating with the sparse feature matrix
+EVAL_BLOCK_ROWS = 2 ** 14
+_factor_cache = collections.OrderedDict()
+
+
+def clear_factor_cache() -> None:
+    """
+    Empty the cache of matrix factorizations
+    """
+    _factor_cache.clear()
+
+
+def array_fingerprint(arr) -> str:
+    """
+    Helper to identify a matrix by its content, so that separately
+    constructed but identical environments share cache entries
+    :param arr: np array or scipy.sparse matrix
+    :return: hex digest of the shape, dtype and values
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if is_sparse(arr):
+        arr = sp_sparse.csr_matrix(arr, copy=True)
+        arr.sum_duplicates()  # canonical format
+        h.update(str(('csr', arr.shape, arr.dtype.str)).encode())
+        for part in (arr.indptr, arr.indices, arr.data):
+            h.update(np.ascontiguousarray(part).tobytes())
+        return h.hexdigest()
+
+    arr = np.ascontiguousarray(arr)
+    h.update(str((arr.shape, arr.dtype.str)).encode())
+    h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def _cached(key, build_fn):
+    """
+    Helper to get an item from the factorization cache, building it with
+    build_fn() on a cache miss
+    """
+    if key in _factor_cache:
+        _factor_cache.move_to_end(key)
+        return _factor_cache[key]
+
+    item = build_fn()
+    _factor_cache[key] = item
+    while len(_factor_cache) > FACTOR_CACHE_SIZE:
+        _factor_cache.popitem(last=False)
+    return item
+
+
+def _get_factor(key, mat_fn, pos_def=False):
+    """
+    Get the (cached) factorization of a square matrix
+    :param key: hashable cache key identifying the matrix
+    :param mat_fn: callable returning the matrix, only called on cache miss
+    :param pos_def: if True the matrix is symmetric positive definite and
+                    the Cholesky factorization is used, otherwise LU
+    :return: factorization, to be used with _factor_solve
+    """
+    if not SCIPY_AVAILABLE:
+        return mat_fn()
+
+    if pos_def:
+        return _cached((key, pos_def),
+                       lambda: sp_linalg.cho_factor(mat_fn()))
+    return _cached((key, pos_def), lambda: sp_linalg.lu_factor(mat_fn()))
+
+
+def _factor_solve(factor, rhs, pos_def=False, trans=False) -> np.ndarray:
+    """
+    Solve A x = rhs given the factorization of A from _get_factor
+    :param rhs: (n, ) or (n, m) right hand side
+    :param trans: if True solve the transposed system A^T x = rhs instead
+    :return: solution of the same shape as rhs
+    """
+    if not SCIPY_AVAILABLE:
+        return np.linalg.solve(factor.T if trans else factor, rhs)
+    if pos_def:
+        return sp_linalg.cho_solve(factor, rhs)  # symmetric
+    return sp_linalg.lu_solve(factor, rhs, trans=int(trans))
+
+
+def _discounted_factor(P_trans, gamma):
+    """
+    Factorization of (I - gamma * P), cached by (P, gamma)
+    :param P_trans: (N, N) transition matrix
+    :param gamma: discount factor
+    """
+    key = ('I-gP', array_fingerprint(P_trans), float(gamma))
+    return _get_factor(
+        key, lambda: np.identity(len(P_trans)) - (gamma * P_trans)
+    )
+
+
+def _spectral_decomposition(P_trans):
+    """
+    (Cached) decomposition of the transition matrix, to solve
+    (I - gamma P) X = B for many gamma. Uses the eigendecomposition
+    P = V diag(mu) V^-1 when V is well conditioned, otherwise (e.g. P not
+    diagonalizable) the complex Schur decomposition P = Q T Q^H.
+    :param P_trans: (N, N) transition matrix
+    :return: tuple of ('eig', (mu, V, LU of V)) or ('schur', (T, Q))
+    """
+    def _decompose():
+        mu, V = np.linalg.eig(P_trans)
+        V = V.astype(np.complex128, copy=False)
+        with warnings.catch_warnings():
+            # V is (near) singular if P is not diagonalizable, checked below
+            warnings.simplefilter('ignore', sp_linalg.LinAlgWarning)
+            V_lu = sp_linalg.lu_factor(V)
+        rcond, _ = sp_linalg.lapack.zgecon(V_lu[0], np.linalg.norm(V, 1),
+                                           norm='1')
+        if rcond > (1.0 / SPECTRAL_COND_MAX):
+            return 'eig', (mu, V, V_lu)
+        T, Q = sp_linalg.schur(P_trans, output='complex')
+        return 'schur', (T, Q)
+
+    key = ('spectral', array_fingerprint(P_trans))
+    return _cached(key, _decompose)
+
+
+def _use_spectral(P_trans, num_gammas, num_cols) -> bool:
+    """
+    Rough flop count comparison of solving num_gammas discounts with one
+    (cached) spectral decomposition vs. one LU factorization per discount.
+    The spectral solve only pays off for many discounts with few right
+    hand side columns, e.g. value functions, or when already decomposed.
+    """
+    n = len(P_trans)
+    lu_cost = num_gammas * ((2.0 / 3.0) * n ** 3 + 2.0 * num_cols * n ** 2)
+    spectral_cost = (2 + 4 * num_gammas) * num_cols * n ** 2
+    if ('spectral', array_fingerprint(P_trans)) not in _factor_cache:
+        spectral_cost += SPECTRAL_SETUP_COST * n ** 3
+    return spectral_cost < lu_cost
+
+
+def _solve_discounted_batch(P_trans, gammas, rhs) -> np.ndarray:
+    """
+    Solve (I - gamma P) X = rhs for each gamma in gammas
+    :param P_trans: (N, N) transition matrix
+    :param gammas: (G, ) discount factors
+    :param rhs: (N, ) or (N, m) right hand side
+    :return: (G, N) or (G, N, m) solutions
+    """
+    gammas = np.asarray(gammas, dtype=np.float64)
+    rhs_2d = np.reshape(rhs, (len(P_trans), -1))  # (N, m)
+
+    if not (SCIPY_AVAILABLE and
+            _use_spectral(P_trans, len(gammas), rhs_2d.shape[1])):
+        return np.stack([
+            _factor_solve(_discounted_factor(P_trans, g), rhs)
+            for g in gammas
+        ])
+
+    method, decomp = _spectral_decomposition(P_trans)
+    if method == 'eig':
+        # X = V diag(1 / (1 - gamma mu)) V^-1 rhs, P is real so only the
+        # real part of the product is needed
+        mu, V, V_lu = decomp
+        n, m = rhs_2d.shape
+        V_inv_rhs = sp_linalg.lu_solve(V_lu, rhs_2d)  # (N, m)
+        scale = 1.0 / (1.0 - mu[:, None] * gammas[None, :])  # (N, G)
+        scaled = np.reshape(scale[:, :, None] * V_inv_rhs[:, None, :],
+                            (n, -1))  # (N, G * m), one matrix product
+        sol = (V.real @ scaled.real) - (V.imag @ scaled.imag)
+        sol = np.transpose(np.reshape(sol, (n, len(gammas), m)), (1, 0, 2))
+    else:
+        # X = Q (I - gamma T)^-1 Q^H rhs, triangular solve per gamma
+        T, Q = decomp
+        Qh_rhs = np.conj(Q.T) @ rhs_2d
+        eye = np.identity(len(T))
+        sol = np.real(np.stack([
+            Q @ sp_linalg.solve_triangular(eye - g * T, Qh_rhs)
+            for g in gammas
+        ]))
+
+    return np.reshape(sol, (len(gammas), *np.shape(rhs)))
+
+
+def _sparse_discounted_solve(P_trans, gamma, rhs,
+                             method='direct') -> np.ndarray:
+    """
+    Solve (I - gamma P) X = rhs for a scipy.sparse transition matrix
+    :param P_trans: (N, N) sparse transition matrix
+    :param gamma: discount factor
+    :param rhs: (N, ) or (N, m) right hand side, dense or sparse
+    :param method: 'direct' for a (cached) sparse LU factorization, or
+                   'gmres' for GMRES with a (cached) incomplete LU
+                   preconditioner, which needs less memory when the LU
+                   factors fill in
+    :return: solution, a CSC matrix if rhs is sparse
+    """
+    if not SCIPY_AVAILABLE:
+        raise ImportError('scipy is required for the sparse solvers')
+
+    n = P_trans.shape[0]
+    key = (array_fingerprint(P_trans), float(gamma))
+
+    def _c_mat():
+        return (sp_sparse.identity(n, format='csc')
+                - (gamma * P_trans)).tocsc()
+
+    if method == 'direct':
+        sp_lu = _cached(('sparse_lu', *key),
+                        lambda: sp_sparse_linalg.splu(_c_mat()))
+        solve_fn = sp_lu.solve
+    elif method == 'gmres':
+        def _c_mat_ilu():
+            c_mat = _c_mat()
+            return c_mat, sp_sparse_linalg.spilu(c_mat)
+
+        c_mat, ilu = _cached(('sparse_ilu', *key), _c_mat_ilu)
+        precond = sp_sparse_linalg.LinearOperator((n, n), matvec=ilu.solve)
+
+        def _gmres_vec(b):
+            x, info = sp_sparse_linalg.gmres(
+                c_mat, b, M=precond, **{GMRES_TOL_KWARG: GMRES_RTOL}
+            )
+            if info > 0:
+                warnings.warn(f'GMRES did not converge in {info} iterations')
+            return x
+
+        def solve_fn(b):
+            if b.ndim == 1:
+                return _gmres_vec(b)
+            return np.stack([_gmres_vec(b[:, j])
+                             for j in range(b.shape[1])], axis=1)
+    else:
+        raise ValueError(f'Unknown sparse solver method: {method}')
+
+    if not is_sparse(rhs):
+        return solve_fn(np.asarray(rhs, dtype=np.float64))
+
+    # Sparse right hand side (e.g. tabular features), solve in blocks of
+    # columns to bound the dense memory
+    rhs = sp_sparse.csc_matrix(rhs)
+    block = max(1, SPARSE_RHS_BLOCK_SIZE // n)
+    sol_blocks = []
+    for j in range(0, rhs.shape[1], block):
+        sol = solve_fn(rhs[:, j:(j + block)].toarray())
+        sol_blocks.append(sp_sparse.csc_matrix(sol))
+    return sp_sparse.hstack(sol_blocks, format='csc')
+
+
+# ==
+# Solvers
+
 
 def compute_rmse(vec_a, vec_b) -> float:
     """
@@ -15,52 +317,73 @@ def compute_rmse(vec_a, vec_b) -> float:
     :param vec_b: np array of shape (N, )
     :return: scalar
     """
+    # Accumulate in float64 in case of lower precision estimates
+    vec_a = np.asarray(to_dense(vec_a), dtype=np.float64)
+    vec_b = np.asarray(to_dense(vec_b), dtype=np.float64)
     sq_err = (vec_a - vec_b) ** 2
     return np.sqrt(np.mean(sq_err))
 
 
-def solve_value_fn(env: gym.Env, gamma: float) -> np.ndarray:
+def solve_value_fn(env: gym.Env, gamma: float, sparse=False,
+                   method='direct') -> np.ndarray:
     """
     Solve the value function for each state in an environment
     :param env: gym environment
     :param gamma: discount factor
+    :param sparse: if True use the env's sparse transition matrix and the
+                   sparse solvers, for large environments
+    :param method: (sparse only) 'direct' or 'gmres'
     :return:
     """
-    # Transition matrix
-    n_states = env.get_num_states()
-    P_trans = env.get_transition_matrix()
-
     # Reward function
     R_fn = env.get_reward_function()
 
-    # Solve and return
-    c_mat = (np.identity(n_states) - (gamma * P_trans))
-    v_fn = np.linalg.inv(c_mat) @ R_fn
+    if sparse:
+        P_trans = env.get_transition_matrix(sparse=True)
+        return _sparse_discounted_solve(P_trans, gamma, R_fn, method=method)
+
+    # Transition matrix
+    P_trans = env.get_transition_matrix()
+
+    # Solve (I - gamma P) v = R and return
+    c_factor = _discounted_factor(P_trans, gamma)
+    v_fn = _factor_solve(c_factor, R_fn)
 
     return v_fn
 
 
-def solve_successor_feature(env: gym.Env, gamma: float) -> np.ndarray:
+def solve_successor_feature(env: gym.Env, gamma: float, sparse=False,
+                            method='direct') -> np.ndarray:
     """
     Analytically solve for the successor feature
     :param env: gym environment
     :param gamma: discount factor
-    :return: (N, d) numpy matrix of successor feature for each state
+    :param sparse: if True use the env's sparse transition and feature
+                   matrices and the sparse solvers, for large environments
+    :param method: (sparse only) 'direct' or 'gmres'
+    :return: (N, d) numpy matrix of successor feature for each state, CSC
+             matrix if sparse
     """
+    if sparse:
+        P_trans = env.get_transition_matrix(sparse=True)
+        Phi_mat = env.get_feature_matrix(sparse=True)
+        return _sparse_discounted_solve(P_trans, gamma, Phi_mat,
+                                        method=method)
+
     # Transition matrix
-    n_states = env.get_num_states()
     P_trans = env.get_transition_matrix()
 
     # Feature matrix
     Phi_mat = env.get_feature_matrix()
 
-    # Solve and return
-    c_mat = (np.identity(n_states) - (gamma * P_trans))
-    sf_mat = np.linalg.inv(c_mat) @ Phi_mat
+    # Solve (I - gamma P) Psi = Phi and return
+    c_factor = _discounted_factor(P_trans, gamma)
+    sf_mat = _factor_solve(c_factor, Phi_mat)
     return sf_mat
 
 
-def solve_linear_sf_param(env: gym.Env, gamma: float) -> np.ndarray:
+def solve_linear_sf_param(env: gym.Env, gamma: float,
+                          dtype=np.float64) -> np.ndarray:
     """
     Solve for the linear successor feature parameter matrix. Given an
     environment, extract the transition and feature matrices. Solve the
@@ -68,81 +391,224 @@ def solve_linear_sf_param(env: gym.Env, gamma: float) -> np.ndarray:
 
     :param env: gym environment
     :param gamma: float discount factor
+    :param dtype: dtype of the returned parameters
     :return: np.array of (d, d) successor matrix
     """
     phiMat = env.get_feature_matrix()  # (N, d) feature mat
     transMat = env.get_transition_matrix()  # (N, N) trans mat
-    p_n_states = np.shape(transMat)[0]  # N
 
     # Project and solve
-    cMat = np.identity(p_n_states) - (gamma * transMat)
-    proj_cMat = phiMat.T @ cMat @ phiMat
-    Z = np.linalg.inv(proj_cMat) @ (phiMat.T @ phiMat)
+    def _proj_cMat():
+        cMat = np.identity(np.shape(transMat)[0]) - (gamma * transMat)
+        return phiMat.T @ cMat @ phiMat  # (d, d)
+
+    key = ('proj_I-gP', array_fingerprint(transMat),
+           array_fingerprint(phiMat), float(gamma))
+    proj_factor = _get_factor(key, _proj_cMat)
+    Z = _factor_solve(proj_factor, phiMat.T @ phiMat)
 
-    return Z
+    return Z.astype(dtype, copy=False)
 
 
-def solve_linear_reward_param(env: gym.Env) -> np.ndarray:
+def solve_linear_reward_param(env: gym.Env, dtype=np.float64) -> np.ndarray:
     """
     Solve for the linear (one-step) reward parameter vector.
     :param env:  gym environment
+    :param dtype: dtype of the returned parameters
     :return: (d, ) reward function parameters
     """
     phiMat = env.get_feature_matrix()  # (N, d) feature mat
     rewVec = env.get_reward_function()  # (N, 1) reward vec
 
-    # Project and solve
-    solMat = np.linalg.inv((phiMat.T @ phiMat))
-    Wr = solMat @ phiMat.T @ rewVec
+    # Project and solve the normal equations
+    key = ('PhiTPhi', array_fingerprint(phiMat))
+    gram_factor = _get_factor(key, lambda: phiMat.T @ phiMat, pos_def=True)
+    Wr = _factor_solve(gram_factor, phiMat.T @ rewVec, pos_def=True)
 
-    return Wr
+    return Wr.astype(dtype, copy=False)
 
 
-def evaluate_value_rmse(env: gym.Env, agent, true_v_fn) -> float:
+def solve_discount_batch(env: gym.Env, gammas, value_fn=True,
+                         sf_mat=True, sf_param=False,
+                         dtype=np.float64) -> dict:
     """
-    Compute the RMSE for the value function of a given agent
-    and environment
+    Solve the value functions, successor features and / or linear SF
+    parameters for a whole vector of discounts at once. When cheaper than
+    one LU factorization per discount (many discounts, few right hand side
+    columns, e.g. the value functions of a long sweep), the transition
+    matrix is decomposed (and cached) once, so that each discount only
+    costs matrix products / triangular solves.
 
-    :return: scalar RMSE
+    :param env: gym environment
+    :param gammas: (G, ) discount factors, e.g. gamma * lamb of a lamb sweep
+    :param value_fn: whether to solve the value functions
+    :param sf_mat: whether to solve the successor feature matrices
+    :param sf_param: whether to solve the linear SF parameters
+    :param dtype: dtype of the returned SF parameters
+    :return: dict with (G, N) 'value_fn', (G, N, d) 'sf_mat' and
+             (G, d, d) 'sf_param', each only if requested
     """
+    P_trans = env.get_transition_matrix()
+    out_dict = {}
 
-    phiMat = env.get_feature_matrix()  # (N, d) feature mat
-    n_states = np.shape(phiMat)[0]
-    esti_v_fn = np.empty(n_states)
+    if value_fn:
+        out_dict['value_fn'] = _solve_discounted_batch(
+            P_trans, gammas, env.get_reward_function()
+        )
+
+    if sf_mat:
+        out_dict['sf_mat'] = _solve_discounted_batch(
+            P_trans, gammas, env.get_feature_matrix()
+        )
+
+    if sf_param:
+        # Projected systems are only (d, d), solve them stacked
+        phiMat = env.get_feature_matrix()  # (N, d)
+        gram_mat = phiMat.T @ phiMat
+        proj_pMat = phiMat.T @ P_trans @ phiMat
+        proj_cMats = (gram_mat[None, :, :] -
+                      np.asarray(gammas)[:, None, None] * proj_pMat)
+        Z = np.linalg.solve(proj_cMats,
+                            np.broadcast_to(gram_mat, proj_cMats.shape))
+        out_dict['sf_param'] = Z.astype(dtype, copy=False)
+
+    return out_dict
+
+
+# ==
+# Expected (synchronous) updates
+
+def solve_state_distribution(env: gym.Env) -> np.ndarray:
+    """
+    Solve for the on-policy state distribution. For episodic environments
+    this is the normalized expected number of visits per episode,
+    mu_0^T (I - P)^-1; for continuing environments (all rows of P sum to
+    one) the stationary distribution d^T P = d^T.
+    :param env: gym environment with get_transition_matrix, and
+                get_start_distribution if episodic
+    :return: (N, ) state distribution
+    """
+    P_trans = env.get_transition_matrix()
+    n_states = len(P_trans)
+
+    if np.allclose(P_trans.sum(axis=1), 1.0):
+        # Stationary distribution: (I - P)^T d = 0 subject to sum(d) = 1
+        a_mat = np.vstack([(np.identity(n_states) - P_trans).T,
+                           np.ones((1, n_states))])
+        b_vec = np.zeros(n_states + 1)
+        b_vec[-1] = 1.0
+        d_vec = np.linalg.lstsq(a_mat, b_vec, rcond=None)[0]
+    else:
+        c_factor = _discounted_factor(P_trans, 1.0)
+        d_vec = _factor_solve(c_factor, env.get_start_distribution(),
+                              trans=True)
+
+    d_vec = np.clip(d_vec, 0.0, None)
+    return d_vec / np.sum(d_vec)
 
-    for s_n in range(n_states):
-        # Get state features
-        s_phi = phiMat[s_n, :]
 
-        # Compute the value estimate TODO change this
-        # NOTE: assumes only a single action is available
-        # TODO: make it into compute V function to marginalize over actions?
-        esti_v_fn[s_n] = agent.compute_Q_value(s_phi, 0)
+def get_expected_update_model(env: gym.Env) -> dict:
+    """
+    Everything the agents need to apply their expected updates, see
+    BaseLinearAgent.expected_update
+    :param env: gym environment with get_transition_matrix,
+                get_reward_function, get_feature_matrix and
+                get_start_distribution
+    :return: dict with the (N, N) transition matrix 'P', (N, ) reward
+             vector 'R', (N, d) feature matrix 'Phi', (N, ) on-policy state
+             distribution 'd', and the expected 'episode_length' and
+             (undiscounted) 'episode_return', both None if continuing
+    """
+    P_trans = env.get_transition_matrix()
+    rewVec = env.get_reward_function()
+    d_vec = solve_state_distribution(env)
+
+    episode_length, episode_return = None, None
+    if not np.allclose(P_trans.sum(axis=1), 1.0):
+        # Expected number of visits to each state in an episode
+        c_factor = _discounted_factor(P_trans, 1.0)
+        visits = _factor_solve(c_factor, env.get_start_distribution(),
+                               trans=True)
+        episode_length = float(np.sum(visits))
+        episode_return = float(visits @ rewVec)
+
+    return {
+        'P': P_trans,
+        'R': rewVec,
+        'Phi': env.get_feature_matrix(),
+        'd': d_vec,
+        'episode_length': episode_length,
+        'episode_return': episode_return,
+    }
+
+
+def solve_expected_trace_operator(model: dict, decay: float) -> np.ndarray:
+    """
+    Solve for the expected trace operator Phi^T D (I - decay P)^-1, which
+    maps the expected TD errors (N, ) to the expected TD(lambda) update
+    direction (d, ), with decay = gamma * lambda. Row s of its transpose is
+    the expected eligibility trace in state s times d(s).
+    :param model: dict from get_expected_update_model
+    :param decay: trace decay (gamma * lambda)
+    :return: (d, N) operator
+    """
+    c_factor = _discounted_factor(model['P'], decay)
+    d_phi = model['d'][:, None] * model['Phi']  # (N, d)
+    return _factor_solve(c_factor, d_phi, trans=True).T
+
+
+def _feature_blocks(env, sparse=False):
+    """
+    Helper to evaluate the agents on all states, yields the feature matrix
+    as dense (rows, d) blocks: a single block, or blocks of EVAL_BLOCK_ROWS
+    states of the sparse feature matrix (so that large environments never
+    form the dense (N, d) matrix)
+    """
+    if not sparse:
+        yield env.get_feature_matrix()  # (N, d) feature mat
+        return
+
+    phiMat = sp_sparse.csr_matrix(env.get_feature_matrix(sparse=True))
+    for start in range(0, phiMat.shape[0], EVAL_BLOCK_ROWS):
+        yield phiMat[start:(start + EVAL_BLOCK_ROWS)].toarray()
+
+
+def evaluate_value_rmse(env: gym.Env, agent, true_v_fn,
+                        sparse=False) -> float:
+    """
+    Compute the RMSE for the value function of a given agent
+    and environment
+
+    :param sparse: evaluate blocks of the sparse feature matrix
+    :return: scalar RMSE
+    """
+    # NOTE: assumes only a single action is available
+    # TODO: make it into compute V function to marginalize over actions?
+    esti_v_fn = np.concatenate([
+        agent.predict_values(phi_block, 0)
+        for phi_block in _feature_blocks(env, sparse)
+    ])  # (N, )
 
     return compute_rmse(esti_v_fn, true_v_fn)
 
 
-def evaluate_sf_ret_rmse(env, agent, true_v_fn) -> float:
+def evaluate_sf_ret_rmse(env, agent, true_v_fn, sparse=False) -> float:
     """
     Compute RMSE for the lambda successor return, if possible
     :return: scalar RMSE
     """
-    if not hasattr(agent, 'compute_successor_return'):
+    if not hasattr(agent, 'predict_successor_returns'):
         return None
 
-    phiMat = env.get_feature_matrix()  # (N, d) feature mat
-    n_states = np.shape(phiMat)[0]
-    esti_v_fn = np.empty(n_states)
-
-    for s_n in range(n_states):
-        s_phi = phiMat[s_n, :]  # state features
-        esti_v_fn[s_n] = agent.compute_successor_return(
-            s_phi, 0
-        )  # compute value
+    esti_v_fn = np.concatenate([
+        agent.predict_successor_returns(phi_block, 0)
+        for phi_block in _feature_blocks(env, sparse)
+    ])  # (N, )
+
     return compute_rmse(esti_v_fn, true_v_fn)
 
 
-def evaluate_sf_mat_rmse(env, agent, true_sf_mat) -> float:
+def evaluate_sf_mat_rmse(env, agent, true_sf_mat, sparse=False) -> float:
     """
     Compute the RMSE for the successor feature matrix
     :param env:
@@ -150,17 +616,16 @@ def evaluate_sf_mat_rmse(env, agent, true_sf_mat) -> float:
     :param true_sf_mat:  (N, d) true successor feature matrix
     :return:
     """
-    # NOTE: assumes only single action, and assumes parameter name is Ws
-    #       potential TODO make more general
-    sf_param = agent.Ws[0]  # (d, d)
-    phiMat = env.get_feature_matrix()  # (N, d) feature mat
-
-    esti_sf_mat = phiMat @ sf_param
+    # NOTE: assumes only single action
+    esti_sf_mat = np.concatenate([
+        agent.compute_successor_features(phi_block, 0)
+        for phi_block in _feature_blocks(env, sparse)
+    ])  # (N, d)
 
     return compute_rmse(esti_sf_mat, true_sf_mat)
 
 
-def evaluate_reward_rmse(env, agent, true_rew_vec) -> float:
+def evaluate_reward_rmse(env, agent, true_rew_vec, sparse=False) -> float:
     """
     Compute the RMSE for the (instantenous) reward estimates
     :param env:
@@ -170,9 +635,10 @@ def evaluate_reward_rmse(env, agent, true_rew_vec) -> float:
 
     # NOTE: assumes parameter is available
     rew_param = agent.Wr  # (d,) vec
-    phiMat = env.get_feature_matrix()  # (N, d) feature mat
 
-    esti_rew_vec = phiMat @ rew_param
+    esti_rew_vec = np.concatenate([
+        phi_block @ rew_param for phi_block in _feature_blocks(env, sparse)
+    ])
     return compute_rmse(esti_rew_vec, true_rew_vec)
 
 
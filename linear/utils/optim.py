@@ -16,6 +16,7 @@ class SGD:
     def __init__(self, param_like, lr=0.01):
         self.param_like = param_like
         self.lr = lr
+        self.dtype = np.asarray(param_like).dtype  # dtype of the steps
 
     def step(self, grad):
         """
@@ -23,12 +24,26 @@ class SGD:
         :param grad: gradient of parameters
         :return: gradient step to take
         """
-        return self.lr * grad
+        return (self.lr * grad).astype(self.dtype, copy=False)
+
+    def step_block(self, grad_block, idx):
+        """
+        SGD step for a block of the parameters, where the gradient is zero
+        outside of the block
+        :param grad_block: gradient of the parameters at param[idx]
+        :param idx: numpy index (int, slice, index arrays or tuple of
+                    these) of the block, must not contain duplicates
+        :return: gradient step to take for param[idx]
+        """
+        return self.step(grad_block)
 
 
 class RMSProp(SGD):
     """
-    RMSProp with bias correction
+    RMSProp with bias correction. Block steps update the mean squared
+    gradients lazily: entries outside of the block are only decayed when
+    they are next touched (or at the next full step), which is equivalent
+    to the full update with zero gradients outside of the block.
     """
 
     def __init__(self, param_like, lr=0.01, smoothing_alpha=0.99, eps=1e-8):
@@ -41,7 +56,18 @@ class RMSProp(SGD):
 
         self.num_steps = 0
 
+        # (Lazy) number of steps each entry of ms_grads is up to date with,
+        # only allocated once step_block is used
+        self.ms_steps = None
+
     def step(self, grad):
+        # Catch up on the decay of entries skipped by the block steps
+        if self.ms_steps is not None:
+            self.ms_grads *= self.smoothing_alpha ** (
+                self.num_steps - self.ms_steps
+            )
+            self.ms_steps[...] = self.num_steps + 1
+
         # Exponential update of mean squared gradients
         self.ms_grads = ((self.smoothing_alpha * self.ms_grads)
                          + (1 - self.smoothing_alpha) * (grad ** 2))
@@ -55,12 +81,46 @@ class RMSProp(SGD):
 
         # Compute the delta for the parameter updates
         ada_grad = self.lr * (grad / (denom + self.eps))
+        ada_grad = ada_grad.astype(self.dtype, copy=False)
 
         # Update counter states
         self.num_steps += 1
 
         return ada_grad
 
+    def step_block(self, grad_block, idx):
+        """
+        RMSProp step for a block of the parameters, costing O(block size)
+        :param grad_block: gradient of the parameters at param[idx]
+        :param idx: numpy index (int, slice, index arrays or tuple of
+                    these) of the block, must not contain duplicates
+        :return: gradient step to take for param[idx]
+        """
+        if self.ms_steps is None:
+            self.ms_steps = np.full(np.shape(self.ms_grads), self.num_steps)
+
+        # Decay for the steps the block entries were skipped, then the
+        # exponential update of mean squared gradients
+        ms_block = self.ms_grads[idx] * (
+            self.smoothing_alpha ** (self.num_steps - self.ms_steps[idx])
+        )
+        ms_block = ((self.smoothing_alpha * ms_block)
+                    + (1 - self.smoothing_alpha) * (grad_block ** 2))
+        self.ms_grads[idx] = ms_block
+        self.ms_steps[idx] = self.num_steps + 1
+
+        # Adaptive step with the (global) initial bias correction
+        denom = np.sqrt(
+            ms_block /
+            (1 - (self.smoothing_alpha ** (self.num_steps + 1)))
+        )
+        ada_grad = self.lr * (grad_block / (denom + self.eps))
+        ada_grad = ada_grad.astype(self.dtype, copy=False)
+
+        self.num_steps += 1
+
+        return ada_grad
+
 
 if __name__ == "__main__":
     print('hello world')
@@ -0,0 +1,126 @@
+# =============================================================================
+# Streaming statistics for the per-step agent logs. Replaces growing lists
+# of errors with O(1) memory and O(1) update per step.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+
+class RunningStats:
+    """
+    Running count, sum, sum of squares, min and max of a stream of scalars
+    (arrays are treated as a stream of their elements)
+    """
+
+    def __init__(self, welford=False):
+        """
+        :param welford: if True, additionally track the variance with
+                        Welford's (numerically stable) algorithm
+        """
+        self.welford = welford
+
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+        # Welford running mean and sum of squared deviations
+        self._w_mean = 0.0
+        self._w_m2 = 0.0
+
+    def append(self, x) -> None:
+        """
+        Add item(s) to the stream, same call as for the list logs
+        :param x: scalar or np.ndarray
+        """
+        # NOTE: python floats skip the (comparatively slow) checks, this is
+        #       called every step
+        if type(x) is not float:
+            if np.ndim(x) > 0:
+                self._append_array(np.ravel(x))
+                return
+            x = float(x)
+
+        self.count += 1
+        self.sum += x
+        self.sum_sq += x * x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+        if self.welford:
+            delta = x - self._w_mean
+            self._w_mean += delta / self.count
+            self._w_m2 += delta * (x - self._w_mean)
+
+    def _append_array(self, x) -> None:
+        """
+        Add a batch of items at once, merging the Welford statistics with
+        Chan et al.'s parallel update
+        :param x: (n, ) np.ndarray
+        """
+        n = len(x)
+        if n == 0:
+            return
+
+        old_count = self.count
+        self.count += n
+        self.sum += float(np.sum(x))
+        self.sum_sq += float(np.dot(x, x))
+        self.min = min(self.min, float(np.min(x)))
+        self.max = max(self.max, float(np.max(x)))
+
+        if self.welford:
+            x_mean = float(np.mean(x))
+            x_m2 = float(np.sum((x - x_mean) ** 2))
+            delta = x_mean - self._w_mean
+            self._w_mean += delta * n / self.count
+            self._w_m2 += x_m2 + (delta ** 2) * old_count * n / self.count
+
+    def __len__(self):
+        return self.count
+
+    def reset(self) -> None:
+        """
+        Clear the stream, e.g. between the evaluation checkpoints of a
+        continuing task
+        """
+        self.__init__(welford=self.welford)
+
+    @property
+    def mean(self) -> float:
+        if self.count == 0:
+            return np.nan
+        return self.sum / self.count
+
+    @property
+    def mean_sq(self) -> float:
+        """
+        :return: mean of the squared items
+        """
+        if self.count == 0:
+            return np.nan
+        return self.sum_sq / self.count
+
+    @property
+    def var(self) -> float:
+        """
+        :return: (population) variance of the items
+        """
+        if self.count == 0:
+            return np.nan
+        if self.welford:
+            return self._w_m2 / self.count
+        return max(self.mean_sq - (self.mean ** 2), 0.0)
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(self.var)
+
+
+if __name__ == "__main__":
+    print('hello world')
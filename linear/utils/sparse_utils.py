@@ -0,0 +1,72 @@
+# =============================================================================
+# Helpers for the (optional) scipy.sparse versions of the environment
+# matrices, used to solve for the ground truth of large environments
+# without forming dense N x N matrices.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+try:
+    import scipy.sparse as sp_sparse
+    SCIPY_SPARSE_AVAILABLE = True
+except ImportError:
+    sp_sparse = None
+    SCIPY_SPARSE_AVAILABLE = False
+
+
+def _check_sparse_available() -> None:
+    if not SCIPY_SPARSE_AVAILABLE:
+        raise ImportError('scipy is required for sparse=True')
+
+
+def is_sparse(mat) -> bool:
+    """
+    :return: whether mat is a scipy.sparse matrix / array
+    """
+    return SCIPY_SPARSE_AVAILABLE and sp_sparse.issparse(mat)
+
+
+def build_matrix(rows, cols, vals, shape, sparse=False):
+    """
+    Build a matrix from its non-zero entries
+    :param rows: (nnz, ) row indices
+    :param cols: (nnz, ) column indices
+    :param vals: (nnz, ) values, or scalar for all entries
+    :param shape: (n_rows, n_cols)
+    :param sparse: if True return a scipy.sparse CSR matrix, otherwise a
+                   dense np array
+    :return: matrix of the given shape
+    """
+    vals = np.broadcast_to(np.asarray(vals, dtype=np.float64), np.shape(rows))
+    if sparse:
+        _check_sparse_available()
+        return sp_sparse.csr_matrix((vals, (rows, cols)), shape=shape)
+
+    mat = np.zeros(shape)
+    mat[rows, cols] = vals
+    return mat
+
+
+def identity_matrix(n, sparse=False):
+    """
+    (n, n) identity, e.g. the tabular feature matrix
+    """
+    if sparse:
+        _check_sparse_available()
+        return sp_sparse.identity(n, format='csr')
+    return np.identity(n)
+
+
+def to_dense(mat) -> np.ndarray:
+    """
+    :return: mat as a dense np array (no-op if already dense)
+    """
+    if is_sparse(mat):
+        return mat.toarray()
+    return np.asarray(mat)
+
+
+if __name__ == "__main__":
+    print('scipy.sparse available:', SCIPY_SPARSE_AVAILABLE)
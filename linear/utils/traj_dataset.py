@@ -0,0 +1,74 @@
+# =============================================================================
+# Pre-generated trajectory datasets for the prediction sweeps. The data
+# stream of a prediction environment does not depend on the agent, so each
+# seed's episodes are sampled once (MarkovChainSampler) into an on-disk
+# dataset, which every agent config of a sweep then replays (memory-mapped).
+# Besides saving the simulation, the configs see the same episodes (common
+# random numbers), lowering the variance of their comparisons.
+#
+# Datasets are stored with the (atomic, content-addressed) gt_cache helpers.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+import utils.gt_cache as gtc
+
+DATASET_ARRAYS = ['states', 'rewards', 'offsets', 'truncated']
+
+
+def generate_dataset(sampler, num_episodes, rng, chunk_size) -> dict:
+    """
+    Sample episodes chunk_size at a time (the same stream as sampling them
+    on the fly in chunks) and pack them into a single dataset
+    :param sampler: MarkovChainSampler
+    :param num_episodes: total number of episodes
+    :param rng: np.random.Generator
+    :param chunk_size: number of episodes per sampler call
+    :return: dict of packed arrays, as MarkovChainSampler.sample
+    """
+    chunks = []
+    for chunk_start in range(0, num_episodes, chunk_size):
+        num_chunk = min(chunk_size, num_episodes - chunk_start)
+        chunks.append(sampler.sample(num_chunk, rng))
+
+    # Shift the offsets of each chunk by the steps of the previous ones
+    chunk_steps = np.cumsum([0] + [c['offsets'][-1] for c in chunks])
+    offsets = np.concatenate(
+        [[0]] + [c['offsets'][1:] + chunk_steps[i]
+                 for i, c in enumerate(chunks)]
+    )
+
+    return {
+        'states': np.concatenate([c['states'] for c in chunks]),
+        'rewards': np.concatenate([c['rewards'] for c in chunks]),
+        'offsets': offsets,
+        'truncated': np.concatenate([c['truncated'] for c in chunks]),
+    }
+
+
+def load_or_generate_dataset(dataset_dir, key_dict, sampler, num_episodes,
+                             rng, chunk_size) -> dict:
+    """
+    Load the dataset identified by key_dict, generating (and saving) it on
+    the first use
+    :param dataset_dir: root directory of the datasets
+    :param key_dict: json-serializable dict identifying the dataset, e.g.
+                     env class, env kwargs, seed, number of episodes and
+                     how the rewards are sampled
+    :param rng: np.random.Generator, only used if generating
+    :return: dict of packed (memory-mapped) arrays
+    """
+    key = gtc.cache_key(key_dict)
+    traj = gtc.load_arrays(dataset_dir, key, DATASET_ARRAYS)
+    if traj is not None:
+        return traj
+
+    traj = generate_dataset(sampler, num_episodes, rng, chunk_size)
+    gtc.save_arrays(dataset_dir, key, traj, key_dict=key_dict)
+    return gtc.load_arrays(dataset_dir, key, DATASET_ARRAYS)
+
+
+if __name__ == "__main__":
+    print('hello world')
@@ -0,0 +1,104 @@
+# =============================================================================
+# Preallocated trajectory storage for the linear agents. Buffers are indexed
+# by the absolute time step within the episode (as a list would be), but are
+# backed by a single numpy array which is re-used across episodes.
+#
+# Author: Anthony G. Chen
+# =============================================================================
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-window buffer, only the most recent `window` items are kept
+    """
+
+    def __init__(self, window, item_shape=(), dtype=float):
+        self.window = window
+        self.data = np.zeros((window, *item_shape), dtype=dtype)
+        self.num_items = 0
+
+    def append(self, item):
+        self.data[self.num_items % self.window] = item
+        self.num_items += 1
+
+    def __getitem__(self, t_idx):
+        if not ((self.num_items - self.window) <= t_idx < self.num_items):
+            raise IndexError(f'Time step {t_idx} not in buffer window')
+        return self.data[t_idx % self.window]
+
+    def __len__(self):
+        return self.num_items
+
+    def reset(self):
+        self.num_items = 0
+
+
+class GrowableBuffer:
+    """
+    Contiguous buffer of the full episode, capacity doubles when full
+    """
+
+    def __init__(self, capacity=64, item_shape=(), dtype=float):
+        self.data = np.zeros((capacity, *item_shape), dtype=dtype)
+        self.num_items = 0
+
+    def append(self, item):
+        if self.num_items == len(self.data):
+            new_data = np.zeros((2 * len(self.data), *self.data.shape[1:]),
+                                dtype=self.data.dtype)
+            new_data[:self.num_items] = self.data
+            self.data = new_data
+        self.data[self.num_items] = item
+        self.num_items += 1
+
+    def __getitem__(self, t_idx):
+        if not (0 <= t_idx < self.num_items):
+            raise IndexError(f'Time step {t_idx} not in buffer')
+        return self.data[t_idx]
+
+    def __len__(self):
+        return self.num_items
+
+    def as_array(self) -> np.ndarray:
+        """
+        :return: (num_items, *item_shape) view of the stored items
+        """
+        return self.data[:self.num_items]
+
+    def reset(self):
+        self.num_items = 0
+
+
+def init_trajectory(phi_0, window=2, rew_dtype=float) -> dict:
+    """
+    Initialize the (phi, a, r) trajectory buffers, with the feature buffer
+    shaped after the first feature. Sparse (indices, values) features are
+    stored as objects.
+    :param phi_0: first feature of the episode
+    :param window: number of time steps to keep, or None to keep the full
+                   episode in a growable contiguous array
+    :param rew_dtype: dtype of the reward buffer
+    :return: dict of buffers
+    """
+    if isinstance(phi_0, tuple):
+        phi_shape, phi_dtype = (), object
+    else:
+        phi_shape, phi_dtype = np.shape(phi_0), np.asarray(phi_0).dtype
+
+    if window is None:
+        return {
+            'phi': GrowableBuffer(item_shape=phi_shape, dtype=phi_dtype),
+            'a': GrowableBuffer(dtype=int),
+            'r': GrowableBuffer(dtype=rew_dtype),
+        }
+    return {
+        'phi': RingBuffer(window, item_shape=phi_shape, dtype=phi_dtype),
+        'a': RingBuffer(window, dtype=int),
+        'r': RingBuffer(window, dtype=rew_dtype),
+    }
+
+
+if __name__ == "__main__":
+    print('hello world')